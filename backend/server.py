@@ -1,17 +1,20 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.gzip import GZipMiddleware
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument, UpdateOne, UpdateMany
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from bson import ObjectId
 import json
 
 # Performance imports
 import asyncio
-from cachetools import TTLCache
+from cachetools import LRUCache, TTLCache
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
@@ -32,15 +35,26 @@ import uuid
 from datetime import datetime, timedelta
 import stripe
 import hashlib
+import calendar
+import csv
 import secrets
-from google.auth.transport import requests
-from google.oauth2 import id_token
+import gzip
+import base64
+import binascii
+import io
+import time
+import random
+import functools
+import inspect
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image as PILImage, ImageOps
+import aiohttp
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import json
 import resend
 import re
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 # Define Stripe checkout models
 class CheckoutSessionRequest(BaseModel):
@@ -122,11 +136,80 @@ class SubscriptionPricing:
             'price_per_box': final_price / months
         }
 
+# Stripe gateway - the stripe SDK is synchronous, so every call runs on a dedicated thread
+# pool instead of blocking the event loop for the HTTPS round trip. Each pool thread keeps
+# its own pooled requests session (keep-alive), calls have a timeout, and transient failures
+# (network errors, rate limits, 5xx) are retried with exponential backoff. Create calls carry
+# an idempotency key so a retried request never creates a second session/customer.
+class StripeGateway:
+    RETRYABLE_ERRORS = (stripe.error.APIConnectionError, stripe.error.RateLimitError)
+
+    def __init__(self, api_key: str, api_base: Optional[str] = None, timeout: float = 10.0,
+                 max_retries: int = 2, backoff_seconds: float = 0.5, workers: int = 8):
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stripe")
+        self.workers = workers
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_ms = 0.0
+
+        stripe.api_key = api_key
+        if api_base:
+            stripe.api_base = api_base
+        requests_client = getattr(stripe, "RequestsClient", None) or stripe.http_client.RequestsClient  # stripe < 8
+        stripe.default_http_client = requests_client(timeout=timeout)
+        stripe.max_network_retries = 0  # Retries are handled here, with backoff
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, self.RETRYABLE_ERRORS):
+            return True
+        if isinstance(error, stripe.error.APIError):
+            return error.http_status is None or error.http_status >= 500
+        return False
+
+    async def call(self, method, *args, **kwargs):
+        """Run a stripe SDK call on the pool, retrying transient failures"""
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+                self.calls += 1
+                self.total_ms += (time.perf_counter() - started) * 1000
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not self.is_retryable(e):
+                    self.failures += 1
+                    raise
+                delay = self.backoff_seconds * (2 ** attempt) * (0.5 + random.random() / 2)
+                attempt += 1
+                self.retries += 1
+                logging.warning(f"Stripe call {getattr(method, '__qualname__', method)} failed ({e}), retry {attempt} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def create(self, method, idempotency_key: Optional[str] = None, **params):
+        """Create call; the same idempotency key is reused by every retry"""
+        return await self.call(method, idempotency_key=idempotency_key or str(uuid.uuid4()), **params)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "avg_call_ms": round(self.total_ms / self.calls, 2) if self.calls else 0.0
+        }
+
 # Stripe subscription implementation - Updated for prepaid subscriptions
 class StripeSubscription:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        stripe.api_key = api_key
+    def __init__(self, gateway: StripeGateway):
+        self.gateway = gateway
 
     async def create_subscription_checkout(self, request: SubscriptionRequest) -> SubscriptionResponse:
         try:
@@ -138,15 +221,17 @@ class StripeSubscription:
             
             # Create or retrieve customer
             if request.customer_id:
-                customer = stripe.Customer.retrieve(request.customer_id)
+                customer = await self.gateway.call(stripe.Customer.retrieve, request.customer_id)
             else:
-                customer = stripe.Customer.create(
+                customer = await self.gateway.create(
+                    stripe.Customer.create,
                     email=request.customer_email,
                     metadata={"source": "mystery_box_prepaid_subscription"}
                 )
 
             # Create one-time payment checkout session (no subscription)
-            session = stripe.checkout.Session.create(
+            session = await self.gateway.create(
+                stripe.checkout.Session.create,
                 customer=customer.id,
                 payment_method_types=["card", "multibanco", "klarna"],
                 line_items=[{
@@ -187,11 +272,11 @@ class StripeSubscription:
 
     async def get_subscription_status(self, session_id: str) -> SubscriptionStatusResponse:
         try:
-            session = stripe.checkout.Session.retrieve(session_id)
+            session = await self.gateway.call(stripe.checkout.Session.retrieve, session_id)
             
             # For one-time payments, we check the payment intent instead of subscription
             if session.payment_intent:
-                payment_intent = stripe.PaymentIntent.retrieve(session.payment_intent)
+                payment_intent = await self.gateway.call(stripe.PaymentIntent.retrieve, session.payment_intent)
                 
                 # Calculate end date based on subscription type from metadata
                 months = int(session.metadata.get('months', 1))
@@ -217,7 +302,8 @@ class StripeSubscription:
 
     async def create_customer_portal(self, request: CustomerPortalRequest) -> CustomerPortalResponse:
         try:
-            portal_session = stripe.billing_portal.Session.create(
+            portal_session = await self.gateway.create(
+                stripe.billing_portal.Session.create,
                 customer=request.customer_id,
                 return_url=request.return_url
             )
@@ -229,10 +315,16 @@ class StripeSubscription:
 
     async def list_customer_subscriptions(self, customer_id: str):
         try:
-            subscriptions = stripe.Subscription.list(
+            subscriptions = await self.gateway.call(
+                stripe.Subscription.list,
                 customer=customer_id,
                 status="all"
             )
+
+            # Resolve every product name once, concurrently
+            product_ids = list({item.price.product for sub in subscriptions.data for item in sub.items.data})
+            products = await asyncio.gather(*(self.gateway.call(stripe.Product.retrieve, pid) for pid in product_ids))
+            product_names = {pid: product.name for pid, product in zip(product_ids, products)}
             
             return {
                 "subscriptions": [
@@ -244,7 +336,7 @@ class StripeSubscription:
                         "items": [
                             {
                                 "price_id": item.price.id,
-                                "product_name": stripe.Product.retrieve(item.price.product).name,
+                                "product_name": product_names[item.price.product],
                                 "quantity": item.quantity
                             } for item in sub.items.data
                         ]
@@ -257,13 +349,14 @@ class StripeSubscription:
 
 # Stripe checkout implementation
 class StripeCheckout:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        stripe.api_key = api_key
+    def __init__(self, gateway: StripeGateway):
+        self.gateway = gateway
 
-    async def create_checkout_session(self, request: CheckoutSessionRequest) -> CheckoutSessionResponse:
+    async def create_checkout_session(self, request: CheckoutSessionRequest, idempotency_key: Optional[str] = None) -> CheckoutSessionResponse:
         try:
-            session = stripe.checkout.Session.create(
+            session = await self.gateway.create(
+                stripe.checkout.Session.create,
+                idempotency_key=idempotency_key,
                 payment_method_types=["card", "klarna", "multibanco", "sofort", "giropay"],
                 line_items=[{
                     "price_data": {
@@ -292,7 +385,7 @@ class StripeCheckout:
 
     async def get_checkout_status(self, session_id: str) -> CheckoutStatusResponse:
         try:
-            session = stripe.checkout.Session.retrieve(session_id)
+            session = await self.gateway.call(stripe.checkout.Session.retrieve, session_id)
             
             return CheckoutStatusResponse(
                 payment_status=session.payment_status,
@@ -315,12 +408,168 @@ db = client[os.environ['DB_NAME']]
 
 # Stripe setup
 stripe_secret = os.environ['STRIPE_SECRET_KEY']
-stripe_checkout = StripeCheckout(api_key=stripe_secret)
-stripe_subscription = StripeSubscription(api_key=stripe_secret)
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE')  # e.g. http://localhost:12111 for fake_stripe_server.py
+STRIPE_TIMEOUT_SECONDS = float(os.environ.get('STRIPE_TIMEOUT_SECONDS', '10'))
+STRIPE_MAX_RETRIES = int(os.environ.get('STRIPE_MAX_RETRIES', '2'))
+STRIPE_WORKERS = int(os.environ.get('STRIPE_WORKERS', '8'))
+stripe_gateway = StripeGateway(
+    api_key=stripe_secret,
+    api_base=STRIPE_API_BASE,
+    timeout=STRIPE_TIMEOUT_SECONDS,
+    max_retries=STRIPE_MAX_RETRIES,
+    workers=STRIPE_WORKERS
+)
+stripe_checkout = StripeCheckout(stripe_gateway)
+stripe_subscription = StripeSubscription(stripe_gateway)
 
 # Google OAuth setup
 GOOGLE_CLIENT_ID = os.environ['GOOGLE_CLIENT_ID']
 
+# Google ID tokens are verified locally against Google's signing keys (JWKS). The key set is
+# cached for its Cache-Control max-age and refreshed in the background before it expires, so
+# a sign-in never waits on an HTTP fetch; a token signed with an unknown key id (rotation)
+# triggers one early refresh. If Google cannot be reached the cached keys keep being served
+# (503 when there are none yet) and fetches back off for GOOGLE_JWKS_MIN_REFRESH_INTERVAL.
+# GOOGLE_JWKS_FILE points the verifier at a local key set.
+GOOGLE_JWKS_URL = os.environ.get('GOOGLE_JWKS_URL', 'https://www.googleapis.com/oauth2/v3/certs')
+GOOGLE_JWKS_FILE = os.environ.get('GOOGLE_JWKS_FILE')
+GOOGLE_ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+GOOGLE_JWKS_DEFAULT_MAX_AGE = 3600
+GOOGLE_JWKS_REFRESH_MARGIN = 300  # Refresh this many seconds before the cached keys expire
+GOOGLE_JWKS_MIN_REFRESH_INTERVAL = 60  # Unknown key ids cannot force refreshes more often than this
+GOOGLE_TOKEN_LEEWAY_SECONDS = 10
+
+def cache_control_max_age(header: Optional[str]) -> Optional[int]:
+    match = re.search(r"max-age=(\d+)", header or "")
+    return int(match.group(1)) if match else None
+
+class GoogleTokenVerifier:
+    def __init__(self, client_id: str, jwks_url: str = GOOGLE_JWKS_URL, jwks: Optional[dict] = None):
+        self.client_id = client_id
+        self.jwks_url = jwks_url
+        self.keys: Dict[str, dict] = {}
+        self.expires_at = 0.0
+        self.fetched_at = 0.0
+        self.failed_at = float("-inf")
+        self.lock = asyncio.Lock()
+        self.refresh_task: Optional[asyncio.Task] = None
+        self.fetches = 0
+        self.fetch_errors = 0
+        self.verified = 0
+        self.rejected = 0
+        if jwks is not None:
+            self.set_keys(jwks, None)  # A fixed key set never expires
+
+    def set_keys(self, jwks: dict, max_age: Optional[int]):
+        self.keys = {key["kid"]: key for key in jwks.get("keys", [])}
+        self.fetched_at = time.monotonic()
+        self.expires_at = self.fetched_at + max_age if max_age is not None else float("inf")
+
+    async def fetch(self) -> tuple:
+        """(jwks, max_age) from Google"""
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+            async with session.get(self.jwks_url) as response:
+                response.raise_for_status()
+                jwks = await response.json(content_type=None)
+                return jwks, cache_control_max_age(response.headers.get("Cache-Control"))
+
+    async def refresh(self, force: bool = False):
+        async with self.lock:
+            # Another coroutine may have refreshed while this one waited for the lock
+            if not force and time.monotonic() < self.expires_at:
+                return
+            if force and time.monotonic() - self.fetched_at < GOOGLE_JWKS_MIN_REFRESH_INTERVAL:
+                return
+            if time.monotonic() - self.failed_at < GOOGLE_JWKS_MIN_REFRESH_INTERVAL:
+                return
+            self.fetches += 1
+            try:
+                jwks, max_age = await self.fetch()
+            except Exception:
+                self.fetch_errors += 1
+                self.failed_at = time.monotonic()
+                raise
+            self.set_keys(jwks, max_age if max_age is not None else GOOGLE_JWKS_DEFAULT_MAX_AGE)
+
+    async def get_key(self, kid: Optional[str]) -> Optional[dict]:
+        try:
+            if not self.keys or time.monotonic() >= self.expires_at:
+                await self.refresh()
+            if kid not in self.keys:
+                await self.refresh(force=True)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Failed to refresh Google signing keys: {e}")
+        if not self.keys:
+            raise HTTPException(status_code=503, detail="Login com Google temporariamente indisponível")
+        return self.keys.get(kid)
+
+    async def verify(self, token: str) -> dict:
+        """Claims of a valid Google ID token for our client id; ValueError otherwise"""
+        try:
+            header = jwt.get_unverified_header(token)
+            key = await self.get_key(header.get("kid"))
+            if key is None:
+                raise ValueError("Unknown Google signing key")
+            claims = jwt.decode(
+                token, key, algorithms=["RS256"], audience=self.client_id,
+                options={"verify_at_hash": False, "leeway": GOOGLE_TOKEN_LEEWAY_SECONDS}
+            )
+            if claims.get("iss") not in GOOGLE_ISSUERS:
+                raise ValueError("Wrong issuer.")
+        except JWTError as e:
+            self.rejected += 1
+            raise ValueError(str(e))
+        except ValueError:
+            self.rejected += 1
+            raise
+        self.verified += 1
+        return claims
+
+    async def _refresh_loop(self):
+        while True:
+            delay = self.expires_at - time.monotonic() - GOOGLE_JWKS_REFRESH_MARGIN
+            if delay == float("inf"):
+                return
+            # A max-age shorter than the margin would otherwise refresh in a tight loop
+            await asyncio.sleep(max(delay, GOOGLE_JWKS_MIN_REFRESH_INTERVAL))
+            try:
+                await self.refresh(force=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Failed to refresh Google signing keys: {e}")
+
+    async def start(self):
+        """Load the keys now and keep them fresh in the background"""
+        try:
+            await self.refresh()
+        except Exception as e:
+            logging.error(f"Failed to load Google signing keys: {e}")
+        self.refresh_task = asyncio.create_task(self._refresh_loop())
+
+    def stop(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+            self.refresh_task = None
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self.keys),
+            "expires_in_s": round(self.expires_at - time.monotonic()) if self.expires_at != float("inf") else None,
+            "fetches": self.fetches,
+            "fetch_errors": self.fetch_errors,
+            "verified": self.verified,
+            "rejected": self.rejected
+        }
+
+def create_google_token_verifier() -> GoogleTokenVerifier:
+    if GOOGLE_JWKS_FILE:
+        with open(GOOGLE_JWKS_FILE) as f:
+            return GoogleTokenVerifier(GOOGLE_CLIENT_ID, jwks=json.load(f))
+    return GoogleTokenVerifier(GOOGLE_CLIENT_ID)
+
+google_token_verifier = create_google_token_verifier()
+
 # Resend setup
 resend.api_key = os.environ['RESEND_API_KEY']
 
@@ -332,36 +581,963 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt takes 100-300 ms per call; it runs on a bounded thread pool (bcrypt releases the GIL)
+# so a burst of logins never blocks the event loop for the other requests on the worker
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '4'))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', '200'))
+
+class PasswordHasher:
+    """passlib hashing offloaded to a thread pool with a concurrency cap and queue-depth metrics"""
+
+    def __init__(self, context: CryptContext, max_workers: int, max_queue: int):
+        self.context = context
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.queued = 0
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.total_run_ms = 0.0
+
+    async def _run(self, func, *args):
+        if self.max_queue and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Servidor ocupado, tente novamente")
+
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        queued_at = time.perf_counter()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        self.in_flight += 1
+        started_at = time.perf_counter()
+        self.total_wait_ms += (started_at - queued_at) * 1000
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.semaphore.release()
+            self.in_flight -= 1
+            self.completed += 1
+            self.total_run_ms += (time.perf_counter() - started_at) * 1000
+
+    async def hash(self, secret: str) -> str:
+        return await self._run(self.context.hash, secret)
+
+    async def verify(self, secret: str, hashed: str) -> bool:
+        return await self._run(self.context.verify, secret, hashed)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "queue_depth": self.queued,
+            "in_flight": self.in_flight,
+            "max_queue_depth": self.max_queue_depth,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait_ms / self.completed, 2) if self.completed else 0.0,
+            "avg_run_ms": round(self.total_run_ms / self.completed, 2) if self.completed else 0.0
+        }
+
+password_hasher = PasswordHasher(pwd_context, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
+
 # Performance optimizations
-# In-memory cache for frequently accessed data
-cache = TTLCache(maxsize=1000, ttl=300)  # 5 minutes TTL
+# Catalog cache - in-process TTLCache per worker, or a shared Redis-compatible store.
+# When REDIS_URL is set, invalidations are also broadcast to every worker over pub/sub.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')  # "memory" or "redis"
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', '300'))  # 5 minutes TTL
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '1000'))
+CACHE_INVALIDATION_CHANNEL = "mysterybox:cache:invalidate"
+REDIS_URL = os.environ.get('REDIS_URL')
+WORKER_ID = uuid.uuid4().hex
+
+class CacheBackend:
+    """Base cache backend with hit/miss counters and invalidation broadcast"""
+    name = "base"
+
+    def __init__(self, redis_client=None):
+        self.redis = redis_client
+        self.worker_id = WORKER_ID
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.invalidations = 0
+        self.remote_invalidations = 0
+        self.listeners = []
+
+    async def get(self, key: str):
+        value = await self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value):
+        self.sets += 1
+        await self._set(key, value)
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """Values of the keys that are cached (one round trip)"""
+        values = await self._get_many(keys) if keys else {}
+        self.hits += len(values)
+        self.misses += len(keys) - len(values)
+        return values
+
+    async def set_many(self, items: Dict[str, Any]):
+        self.sets += len(items)
+        if items:
+            await self._set_many(items)
+
+    async def invalidate(self, pattern: str, exact: bool = False):
+        """Drop matching entries locally and tell every other worker to do the same"""
+        self.invalidations += 1
+        await self._drop(pattern, exact)
+        self._notify_listeners(pattern, exact, remote=False)
+        if self.redis is not None:
+            message = json.dumps({"origin": self.worker_id, "pattern": pattern, "exact": exact})
+            try:
+                await self.redis.publish(CACHE_INVALIDATION_CHANNEL, message)
+            except Exception as e:
+                logging.error(f"Cache invalidation broadcast failed for {pattern}: {e}")
+
+    def add_invalidation_listener(self, callback, remote_only: bool = False):
+        """Register a callback(pattern, exact) fired on invalidations (optionally only other workers')"""
+        self.listeners.append((callback, remote_only))
+
+    def _notify_listeners(self, pattern: str, exact: bool, remote: bool):
+        for callback, remote_only in self.listeners:
+            if remote_only and not remote:
+                continue
+            try:
+                callback(pattern, exact)
+            except Exception as e:
+                logging.error(f"Cache invalidation listener error: {e}")
+
+    async def handle_remote_invalidation(self, pattern: str, exact: bool):
+        self.remote_invalidations += 1
+        await self._drop_remote(pattern, exact)
+        self._notify_listeners(pattern, exact, remote=True)
+
+    async def listen_for_invalidations(self):
+        """Consume invalidations published by other workers (no-op without Redis)"""
+        if self.redis is None:
+            return
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data.get("origin") == self.worker_id:
+                        continue
+                    await self.handle_remote_invalidation(data["pattern"], data.get("exact", False))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Cache invalidation listener disconnected: {e}")
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.aclose() if hasattr(pubsub, "aclose") else await pubsub.close()
+                except Exception:
+                    pass
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.name,
+            "worker_id": self.worker_id,
+            "broadcast": self.redis is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "sets": self.sets,
+            "invalidations": self.invalidations,
+            "remote_invalidations": self.remote_invalidations
+        }
+
+class InProcessCacheBackend(CacheBackend):
+    """Per-worker TTLCache; other workers are cleared through the broadcast"""
+    name = "memory"
+
+    def __init__(self, maxsize: int = 1000, ttl: int = 300, redis_client=None):
+        super().__init__(redis_client)
+        self.store = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def _get(self, key: str):
+        return self.store.get(key)
+
+    async def _set(self, key: str, value):
+        self.store[key] = value
+
+    async def _get_many(self, keys: List[str]) -> Dict[str, Any]:
+        values = {key: self.store.get(key) for key in keys}
+        return {key: value for key, value in values.items() if value is not None}
+
+    async def _set_many(self, items: Dict[str, Any]):
+        self.store.update(items)
+
+    async def _drop(self, pattern: str, exact: bool):
+        if exact:
+            self.store.pop(pattern, None)
+            return
+        for key in [key for key in list(self.store.keys()) if str(key).startswith(pattern)]:
+            self.store.pop(key, None)
+
+    async def _drop_remote(self, pattern: str, exact: bool):
+        await self._drop(pattern, exact)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "entries": len(self.store)}
+
+class RedisCacheBackend(CacheBackend):
+    """Cache shared by all workers in a Redis-compatible store"""
+    name = "redis"
+
+    def __init__(self, redis_client, ttl: int = 300, namespace: str = "mysterybox:cache:"):
+        super().__init__(redis_client)
+        self.ttl = ttl
+        self.namespace = namespace
+
+    async def _get(self, key: str):
+        try:
+            raw = await self.redis.get(self.namespace + key)
+        except Exception as e:
+            logging.error(f"Redis cache get failed for {key}: {e}")
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    async def _set(self, key: str, value):
+        try:
+            await self.redis.set(self.namespace + key, json.dumps(jsonable_encoder(value)), ex=self.ttl)
+        except Exception as e:
+            logging.error(f"Redis cache set failed for {key}: {e}")
+
+    async def _get_many(self, keys: List[str]) -> Dict[str, Any]:
+        try:
+            raws = await self.redis.mget([self.namespace + key for key in keys])
+        except Exception as e:
+            logging.error(f"Redis cache mget failed: {e}")
+            return {}
+        return {key: json.loads(raw) for key, raw in zip(keys, raws) if raw is not None}
+
+    async def _set_many(self, items: Dict[str, Any]):
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key, value in items.items():
+                    pipe.set(self.namespace + key, json.dumps(jsonable_encoder(value)), ex=self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            logging.error(f"Redis cache set_many failed: {e}")
+
+    async def _drop(self, pattern: str, exact: bool):
+        try:
+            if exact:
+                await self.redis.delete(self.namespace + pattern)
+                return
+            keys = [key async for key in self.redis.scan_iter(match=f"{self.namespace}{pattern}*", count=500)]
+            if keys:
+                await self.redis.delete(*keys)
+        except Exception as e:
+            logging.error(f"Redis cache invalidation failed for {pattern}: {e}")
+
+    async def _drop_remote(self, pattern: str, exact: bool):
+        # The shared store was already cleared by the worker that published the message
+        return
+
+def create_cache_backend(backend: str = CACHE_BACKEND, redis_url: Optional[str] = REDIS_URL, redis_client=None) -> CacheBackend:
+    """Build the configured cache backend; redis_client lets tests inject a stand-in"""
+    if redis_client is None and redis_url:
+        import redis.asyncio as aioredis
+        redis_client = aioredis.from_url(redis_url, decode_responses=True)
+
+    if backend == "redis":
+        if redis_client is None:
+            raise RuntimeError("CACHE_BACKEND=redis requires REDIS_URL")
+        return RedisCacheBackend(redis_client, ttl=CACHE_TTL_SECONDS)
+    return InProcessCacheBackend(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, redis_client=redis_client)
+
+cache_backend = create_cache_backend()
+
+# Pre-serialized catalog snapshot - every storefront view is kept as encoded JSON bytes
+# (plus a gzip copy) with a strong ETag, so hits skip jsonable_encoder and GZip entirely
+class SnapshotEntry:
+    __slots__ = ("payload", "body", "gzip_body", "etag", "built_at")
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.body = json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        # Same threshold as GZipMiddleware
+        self.gzip_body = gzip.compress(self.body, compresslevel=6) if len(self.body) >= 1000 else None
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.built_at = datetime.utcnow()
+
+class CatalogSnapshot:
+    """Per-worker snapshot of product list views, single products and categories"""
+
+    def __init__(self, max_age_seconds: int = 300, max_entries: int = 1000):
+        self.max_age = timedelta(seconds=max_age_seconds)
+        # LRU-bounded: views are keyed by the client's category filter, so arbitrary values
+        # must not grow the worker's memory
+        self.views: LRUCache = LRUCache(maxsize=max_entries)
+        self.products: LRUCache = LRUCache(maxsize=max_entries)
+        self.categories: Optional[SnapshotEntry] = None
+        # Bumped on every product change so a request that read the catalog before it does not
+        # store what it read
+        self.generation = 0
+        self.hits = 0
+        self.builds = 0
+        self.not_modified = 0
+
+    def _fresh(self, entry: Optional[SnapshotEntry]) -> Optional[SnapshotEntry]:
+        # Max age guards against writes made outside the API (scripts, migrations)
+        if entry is not None and datetime.utcnow() - entry.built_at < self.max_age:
+            self.hits += 1
+            return entry
+        return None
+
+    def get_view(self, category: Optional[str], featured: Optional[bool]) -> Optional[SnapshotEntry]:
+        return self._fresh(self.views.get((category, featured)))
+
+    def put_view(self, category: Optional[str], featured: Optional[bool], payload: list, generation: Optional[int] = None) -> SnapshotEntry:
+        self.builds += 1
+        entry = SnapshotEntry(jsonable_encoder(payload))
+        if generation is None or generation == self.generation:
+            self.views[(category, featured)] = entry
+        return entry
+
+    def get_product(self, product_id: str) -> Optional[SnapshotEntry]:
+        return self._fresh(self.products.get(product_id))
+
+    def put_product(self, product_id: str, payload: dict, generation: Optional[int] = None) -> SnapshotEntry:
+        self.builds += 1
+        entry = SnapshotEntry(jsonable_encoder(payload))
+        if generation is None or generation == self.generation:
+            self.products[product_id] = entry
+        return entry
+
+    def get_categories(self) -> Optional[SnapshotEntry]:
+        return self._fresh(self.categories)
+
+    def put_categories(self, payload: list) -> SnapshotEntry:
+        self.builds += 1
+        self.categories = SnapshotEntry(jsonable_encoder(payload))
+        return self.categories
+
+    def apply_product(self, product_id: str, product_data: Optional[dict]):
+        """Incrementally rebuild the entries a product write touches, without querying Mongo"""
+        self.generation += 1
+        encoded = jsonable_encoder(product_data) if product_data else None
+        if encoded:
+            self.put_product(product_id, encoded)
+        else:
+            self.products.pop(product_id, None)
+
+        for (category, featured), entry in list(self.views.items()):
+            items = [item for item in entry.payload if item.get("id") != product_id]
+            if encoded and encoded.get("is_active", True) \
+                    and (category is None or encoded.get("category") == category) \
+                    and (featured is None or encoded.get("featured", False) == featured):
+                items.append(encoded)
+                items.sort(key=lambda item: str(item.get("created_at") or ""), reverse=True)
+            elif len(items) == len(entry.payload):
+                continue  # View never contained this product
+            self.put_view(category, featured, items)
+
+    def drop_products(self, product_id: Optional[str] = None):
+        self.generation += 1
+        self.views.clear()
+        if product_id is None:
+            self.products.clear()
+        else:
+            self.products.pop(product_id, None)
+
+    def drop_categories(self):
+        self.categories = None
+
+    def on_remote_invalidation(self, pattern: str, exact: bool):
+        """Another worker changed the catalog - forget what it touched"""
+        if pattern.startswith("products_"):
+            self.generation += 1
+            self.views.clear()
+        elif pattern.startswith("product_"):
+            self.drop_products(pattern[len("product_"):] if exact else None)
+        elif pattern.startswith("categories"):
+            self.drop_categories()
+
+    def stats(self) -> dict:
+        return {
+            "views": len(self.views),
+            "products": len(self.products),
+            "categories": self.categories is not None,
+            "hits": self.hits,
+            "builds": self.builds,
+            "not_modified": self.not_modified
+        }
+
+catalog_snapshot = CatalogSnapshot(max_age_seconds=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES)
+cache_backend.add_invalidation_listener(catalog_snapshot.on_remote_invalidation, remote_only=True)
+
+# Authenticated user cache - get_current_user resolves the token subject (email) to a User
+# without a Mongo round trip. Short TTL, LRU-bounded, dropped explicitly (and on every
+# worker through the cache broadcast) whenever a user's profile or privileges change.
+# Only enabled with the broadcast (REDIS_URL): without it another worker would keep serving
+# a demoted, deleted or re-passworded user until the TTL expires.
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', '60'))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '5000'))
+
+class UserCache:
+    """Resolved users keyed by email"""
+
+    def __init__(self, maxsize: int, ttl: int, enabled: bool = True):
+        self.store = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.enabled = enabled
+        # Bumped on every invalidation so a lookup racing with a change is not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, email: str):
+        user = self.store.get(email) if self.enabled else None
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    def put(self, email: str, user, generation: int):
+        if self.enabled and generation == self.generation:
+            self.store[email] = user
+
+    def drop(self, email: Optional[str] = None):
+        self.generation += 1
+        self.invalidations += 1
+        if email is None:
+            self.store.clear()
+        else:
+            self.store.pop(email, None)
+
+    def on_invalidation(self, pattern: str, exact: bool):
+        if pattern.startswith("user_"):
+            self.drop(pattern[len("user_"):] if exact else None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.store),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+user_cache = UserCache(maxsize=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL_SECONDS, enabled=cache_backend.redis is not None)
+cache_backend.add_invalidation_listener(user_cache.on_invalidation)
+
+# Chat push channel - chat endpoints publish events that are streamed to subscribed
+# clients/agents over Server-Sent Events. The in-process hub delivers to this worker's
+# subscribers; with Redis, events are also published on a shared channel so subscribers
+# connected to any other worker receive them.
+CHAT_PUBSUB_BACKEND = os.environ.get('CHAT_PUBSUB_BACKEND', 'redis' if REDIS_URL else 'memory')  # "memory" or "redis"
+CHAT_PUBSUB_CHANNEL = "mysterybox:chat:events"
+CHAT_EVENTS_HEARTBEAT_SECONDS = 15
+CHAT_SUBSCRIBER_QUEUE_SIZE = 100
+
+class ChatPubSub:
+    """In-process publish/subscribe hub keyed by channel name"""
+    name = "memory"
+
+    def __init__(self):
+        self.worker_id = WORKER_ID
+        self.subscribers: Dict[str, set] = {}
+        self.published = 0
+        self.dropped = 0
+
+    async def publish(self, channel: str, event: str, data: dict):
+        self.published += 1
+        self._deliver(channel, {"event": event, "data": jsonable_encoder(data)})
+
+    def _deliver(self, channel: str, message: dict):
+        for queue in list(self.subscribers.get(channel, ())):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # A stalled client must not hold memory or block publishers
+                self.dropped += 1
+
+    def subscribe(self, channel: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=CHAT_SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.setdefault(channel, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, channel: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(channel)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[channel]
+
+    async def listen(self):
+        """Receive events published by other workers (no-op in-process)"""
+        return
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "channels": len(self.subscribers),
+            "subscribers": sum(len(queues) for queues in self.subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped
+        }
+
+class RedisChatPubSub(ChatPubSub):
+    """Fans events out to every worker through Redis pub/sub"""
+    name = "redis"
+
+    def __init__(self, redis_client):
+        super().__init__()
+        self.redis = redis_client
+
+    async def publish(self, channel: str, event: str, data: dict):
+        await super().publish(channel, event, data)
+        message = json.dumps({"origin": self.worker_id, "channel": channel, "event": event, "data": jsonable_encoder(data)})
+        try:
+            await self.redis.publish(CHAT_PUBSUB_CHANNEL, message)
+        except Exception as e:
+            logging.error(f"Chat event broadcast failed for {channel}: {e}")
+
+    async def listen(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(CHAT_PUBSUB_CHANNEL)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data.get("origin") == self.worker_id:
+                        continue
+                    self._deliver(data["channel"], {"event": data["event"], "data": data["data"]})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Chat event listener disconnected: {e}")
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.aclose() if hasattr(pubsub, "aclose") else await pubsub.close()
+                except Exception:
+                    pass
+
+def create_chat_pubsub(backend: str = CHAT_PUBSUB_BACKEND, redis_client=None) -> ChatPubSub:
+    """Build the configured chat pub/sub; shares the cache backend's Redis connection"""
+    if backend == "redis":
+        if redis_client is None:
+            raise RuntimeError("CHAT_PUBSUB_BACKEND=redis requires REDIS_URL")
+        return RedisChatPubSub(redis_client)
+    return ChatPubSub()
+
+chat_pubsub = create_chat_pubsub(redis_client=cache_backend.redis)
+
+def chat_session_channel(session_id: str) -> str:
+    return f"chat:session:{session_id}"
+
+CHAT_ADMIN_CHANNEL = "chat:admin"
+
+async def publish_chat_event(session: dict, event: str, data: dict):
+    """Notify the session's participants and the admin chat list"""
+    await chat_pubsub.publish(chat_session_channel(session["id"]), event, data)
+    await chat_pubsub.publish(CHAT_ADMIN_CHANNEL, event, {**data, "session_id": session["id"], "user_id": session.get("user_id")})
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag[2:] == etag if tag.startswith("W/") else tag == etag for tag in candidates)
+
+def snapshot_response(request: Request, entry: SnapshotEntry) -> Response:
+    """Serve a snapshot entry as-is: 304 on a matching ETag, pre-compressed bytes when accepted"""
+    headers = {
+        "ETag": entry.etag,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding"
+    }
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        catalog_snapshot.not_modified += 1
+        return Response(status_code=304, headers=headers)
+
+    if entry.gzip_body is not None and "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=entry.gzip_body, media_type="application/json", headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
 
 # Keep-alive system - ping every 2 minutes to keep connection alive
 async def keep_alive_ping():
-    """Ping system to keep connections alive"""
-    import aiohttp
-    while True:
+    """Ping MongoDB to keep this worker's connection alive"""
+    await db.command("ping")
+    print(f"Keep-alive MongoDB ping successful at {datetime.utcnow()}")
+
+# Periodic task scheduler - every worker runs the loop, but leader-only tasks execute on a
+# single worker at a time: before each run the worker must hold (or renew) a lease document
+# in scheduler_locks. If the leader dies its lease expires and another worker takes over.
+class TaskScheduler:
+    def __init__(self, worker_id: str = WORKER_ID):
+        self.worker_id = worker_id
+        self.tasks: Dict[str, dict] = {}
+        self.running: List[asyncio.Task] = []
+
+    def add_task(self, name: str, interval_seconds: float, func, leader_only: bool = True, lease_seconds: Optional[float] = None):
+        self.tasks[name] = {
+            "func": func,
+            "interval": interval_seconds,
+            "leader_only": leader_only,
+            "lease": lease_seconds or max(interval_seconds * 3, 30),
+            "runs": 0,
+            "skipped": 0,
+            "failures": 0,
+            "last_run": None,
+            "last_error": None,
+            "is_leader": False
+        }
+
+    async def acquire_lease(self, name: str, lease_seconds: float, owner: Optional[str] = None) -> bool:
+        """Take the task's lease if it is free, expired or already ours"""
+        owner = owner or self.worker_id
+        now = datetime.utcnow()
+        try:
+            await db.scheduler_locks.find_one_and_update(
+                {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": owner}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=lease_seconds)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False  # Another worker holds a live lease
+
+    async def release_lease(self, name: str, owner: Optional[str] = None):
+        await db.scheduler_locks.delete_one({"_id": name, "owner": owner or self.worker_id})
+
+    async def run_once(self, name: str) -> bool:
+        task = self.tasks[name]
+        if task["leader_only"]:
+            task["is_leader"] = await self.acquire_lease(name, task["lease"])
+            if not task["is_leader"]:
+                task["skipped"] += 1
+                return False
         try:
-            # Ping MongoDB to keep connection alive
-            await db.command("ping")
-            print(f"Keep-alive MongoDB ping successful at {datetime.utcnow()}")
+            await task["func"]()
+            task["runs"] += 1
+            task["last_run"] = datetime.utcnow()
+            return True
         except Exception as e:
-            print(f"Keep-alive MongoDB ping error: {str(e)}")
-        
-        # Wait 2 minutes before next ping
-        await asyncio.sleep(120)  # 2 minutes
+            task["failures"] += 1
+            task["last_error"] = str(e)
+            logging.error(f"Scheduled task {name} failed: {e}")
+            return False
+
+    async def _loop(self, name: str):
+        while True:
+            try:
+                await self.run_once(name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Scheduler error for {name}: {e}")
+            await asyncio.sleep(self.tasks[name]["interval"])
+
+    def start(self):
+        for name in self.tasks:
+            self.running.append(asyncio.create_task(self._loop(name)))
+
+    async def stop(self):
+        """Cancel the loops and hand our leases over right away"""
+        for task in self.running:
+            task.cancel()
+        self.running = []
+        try:
+            await db.scheduler_locks.delete_many({"owner": self.worker_id})
+        except Exception as e:
+            logging.error(f"Failed to release scheduler leases: {e}")
+
+    def stats(self) -> dict:
+        return {
+            name: {key: value for key, value in task.items() if key != "func"}
+            for name, task in self.tasks.items()
+        }
 
-# Start keep-alive task
+scheduler = TaskScheduler()
+scheduler.add_task("keep_alive_ping", 120, keep_alive_ping, leader_only=False)  # Every worker keeps its own connection warm
+
+# Start background tasks
 async def start_background_tasks():
     """Start background tasks"""
-    asyncio.create_task(keep_alive_ping())
+    scheduler.start()
+    email_outbox.start()
+    stripe_event_processor.start()
+    asyncio.create_task(google_token_verifier.start())
+    asyncio.create_task(cache_backend.listen_for_invalidations())
+    asyncio.create_task(chat_pubsub.listen())
+
+# Cache invalidation helpers (broadcast to every worker)
+async def invalidate_cache_pattern(pattern: str):
+    """Invalidate cache entries whose key starts with pattern"""
+    await cache_backend.invalidate(pattern)
+
+async def invalidate_cache_key(key: str):
+    """Invalidate a single cache entry"""
+    await cache_backend.invalidate(key, exact=True)
+
+async def invalidate_user_cache(email: Optional[str] = None):
+    """Forget a resolved user (or all of them) on every worker"""
+    if email is None:
+        await cache_backend.invalidate("user_")
+    else:
+        await cache_backend.invalidate(f"user_{email}", exact=True)
+
+# Content-addressed image store - uploaded images are decoded once, hashed (sha256) and
+# served from /api/images/{hash}; product documents only keep the URLs
+IMAGE_STORE = os.environ.get('IMAGE_STORE', 'gridfs')  # "gridfs" or "disk"
+IMAGE_STORE_DIR = Path(os.environ.get('IMAGE_STORE_DIR', str(ROOT_DIR / 'uploads' / 'images')))
+# Absolute base of the image URLs saved on products (the frontend is hosted on another domain);
+# when unset, the base URL of the upload request is used
+PUBLIC_API_URL = os.environ.get('PUBLIC_API_URL', '').rstrip('/')
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+IMAGE_HASH_PATTERN = re.compile(r'^[a-f0-9]{64}$')
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
 
-# Cache invalidation helper
-def invalidate_cache_pattern(pattern: str):
-    """Invalidate cache entries matching a pattern"""
-    keys_to_remove = [key for key in cache.keys() if pattern in str(key)]
-    for key in keys_to_remove:
-        cache.pop(key, None)
+def sniff_image_type(data: bytes) -> Optional[str]:
+    """Detect the image content type from its magic bytes"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    return None
+
+def is_inline_image(value: Optional[str]) -> bool:
+    return bool(value) and value.startswith("data:")
+
+def decode_image_data(value: str) -> tuple:
+    """Decode a data URI (or bare base64 string) into (bytes, content_type)"""
+    payload = value.split(",", 1)[1] if value.startswith("data:") and "," in value else value
+    try:
+        data = base64.b64decode(payload, validate=False)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Imagem inválida")
+    content_type = sniff_image_type(data)
+    if not content_type:
+        raise HTTPException(status_code=400, detail="Formato de imagem não suportado")
+    return data, content_type
+
+def public_base_url(request: Optional[Request] = None) -> str:
+    """PUBLIC_API_URL, or the public base URL of the request (behind Render's proxy) when unset"""
+    if PUBLIC_API_URL or request is None:
+        return PUBLIC_API_URL
+    scheme = request.headers.get("x-forwarded-proto", request.url.scheme).split(",")[0].strip()
+    host = request.headers.get("x-forwarded-host") or request.headers.get("host") or request.url.netloc
+    return f"{scheme}://{host}"
+
+def image_url_for(image_hash: str, base_url: str = "") -> str:
+    return f"{base_url or PUBLIC_API_URL}/api/images/{image_hash}"
+
+def absolute_image_url(url: str, base_url: str = "") -> str:
+    """Prefix a relative /api/images/ URL (saved while no base URL was known) with the base URL"""
+    base_url = base_url or PUBLIC_API_URL
+    return f"{base_url}{url}" if base_url and url.startswith("/api/images/") else url
+
+class GridFSImageStore:
+    """Image blobs in a GridFS bucket, one file per content hash"""
+
+    def __init__(self, database):
+        self.database = database
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name="images")
+
+    async def exists(self, image_hash: str) -> bool:
+        return await self.database["images.files"].find_one({"filename": image_hash}, {"_id": 1}) is not None
+
+    async def put(self, image_hash: str, data: bytes, content_type: str):
+        await self.bucket.upload_from_stream(image_hash, data, metadata={"content_type": content_type})
+
+    async def get(self, image_hash: str) -> Optional[tuple]:
+        try:
+            stream = await self.bucket.open_download_stream_by_name(image_hash)
+        except NoFile:
+            return None
+        data = await stream.read()
+        return data, (stream.metadata or {}).get("content_type", "application/octet-stream")
+
+class DiskImageStore:
+    """Image blobs on local disk, sharded by the first two hash characters"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    def _path(self, image_hash: str) -> Path:
+        return self.directory / image_hash[:2] / image_hash
+
+    async def exists(self, image_hash: str) -> bool:
+        return self._path(image_hash).exists()
+
+    async def put(self, image_hash: str, data: bytes, content_type: str):
+        def write():
+            path = self._path(image_hash)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.with_suffix(".type").write_text(content_type)
+            # Write then rename so readers never see a partial blob
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+        await asyncio.to_thread(write)
+
+    async def get(self, image_hash: str) -> Optional[tuple]:
+        def read():
+            path = self._path(image_hash)
+            if not path.exists():
+                return None
+            type_path = path.with_suffix(".type")
+            content_type = type_path.read_text() if type_path.exists() else sniff_image_type(path.read_bytes()[:16])
+            return path.read_bytes(), content_type or "application/octet-stream"
+        return await asyncio.to_thread(read)
+
+image_store = DiskImageStore(IMAGE_STORE_DIR) if IMAGE_STORE == "disk" else GridFSImageStore(db)
+
+async def store_image_bytes(data: bytes, content_type: str) -> str:
+    """Store raw image bytes once per content hash and return the hash"""
+    image_hash = hashlib.sha256(data).hexdigest()
+    if not await image_store.exists(image_hash):
+        await image_store.put(image_hash, data, content_type)
+    return image_hash
+
+# Responsive image variants - every uploaded image is resized to fixed widths and encoded
+# as WebP and JPEG in a process pool, so the event loop never runs Pillow
+IMAGE_VARIANT_WIDTHS = {"thumbnail": 300, "card": 600, "detail": 1200}
+AVATAR_VARIANT_WIDTHS = {"avatar": 256}
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+image_process_pool: Optional[ProcessPoolExecutor] = None
+
+def get_image_process_pool() -> ProcessPoolExecutor:
+    global image_process_pool
+    if image_process_pool is None:
+        image_process_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return image_process_pool
+
+def render_image_variants(data: bytes, widths: Dict[str, int]) -> Dict[str, Dict[str, Any]]:
+    """Resize an image to each width (never upscaling) and encode WebP + JPEG; runs in a worker process"""
+    with PILImage.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = PILImage.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        
+        variants = {}
+        for name, width in widths.items():
+            target_width = min(width, image.width)
+            target_height = max(1, round(image.height * target_width / image.width))
+            resized = image if target_width == image.width else image.resize((target_width, target_height), PILImage.LANCZOS)
+            
+            webp_buffer = io.BytesIO()
+            resized.save(webp_buffer, format="WEBP", quality=80, method=4)
+            jpeg_buffer = io.BytesIO()
+            resized.save(jpeg_buffer, format="JPEG", quality=82, optimize=True, progressive=True)
+            
+            variants[name] = {
+                "width": target_width,
+                "height": target_height,
+                "webp": webp_buffer.getvalue(),
+                "jpeg": jpeg_buffer.getvalue()
+            }
+        return variants
+
+def parse_image_hash(url: Optional[str]) -> Optional[str]:
+    """Return the content hash of a blob store URL, or None for external URLs"""
+    match = re.search(r'/api/images/([a-f0-9]{64})$', url or "")
+    return match.group(1) if match else None
+
+async def build_image_variants(image_hash: str, data: Optional[bytes] = None, widths: Dict[str, int] = IMAGE_VARIANT_WIDTHS,
+                               base_url: str = "") -> Dict[str, Dict[str, Any]]:
+    """Variant URLs for a stored image, rendering them once per (hash, widths)"""
+    variants_key = f"{image_hash}:{','.join(f'{name}={width}' for name, width in widths.items())}"
+    existing = await db.image_variants.find_one({"_id": variants_key})
+    if existing:
+        return {
+            name: {**variant, "webp": absolute_image_url(variant["webp"], base_url), "jpeg": absolute_image_url(variant["jpeg"], base_url)}
+            for name, variant in existing["variants"].items()
+        }
+    
+    if data is None:
+        blob = await image_store.get(image_hash)
+        if not blob:
+            return {}
+        data = blob[0]
+    
+    try:
+        loop = asyncio.get_running_loop()
+        rendered = await loop.run_in_executor(get_image_process_pool(), render_image_variants, data, widths)
+    except Exception as e:
+        logging.error(f"Failed to render variants for image {image_hash}: {e}")
+        return {}
+    
+    variants = {}
+    for name, variant in rendered.items():
+        variants[name] = {
+            "width": variant["width"],
+            "height": variant["height"],
+            "webp": image_url_for(await store_image_bytes(variant["webp"], "image/webp"), base_url),
+            "jpeg": image_url_for(await store_image_bytes(variant["jpeg"], "image/jpeg"), base_url)
+        }
+    
+    await db.image_variants.update_one(
+        {"_id": variants_key},
+        {"$set": {"variants": variants, "created_at": datetime.utcnow()}},
+        upsert=True
+    )
+    return variants
+
+async def prepare_product_image(value: Optional[str], base_url: str = "") -> tuple:
+    """Store an uploaded product image and return (url, variants); external URLs get no variants"""
+    if is_inline_image(value):
+        data, content_type = decode_image_data(value)
+        image_hash = await store_image_bytes(data, content_type)
+        return image_url_for(image_hash, base_url), await build_image_variants(image_hash, data, base_url=base_url)
+    
+    image_hash = parse_image_hash(value)
+    if image_hash:
+        return absolute_image_url(value, base_url), await build_image_variants(image_hash, base_url=base_url)
+    return value, {}
+
+async def prepare_avatar_image(value: Optional[str], base_url: str = "") -> Optional[str]:
+    """Resize an uploaded avatar and return the URL of its JPEG rendition"""
+    if not is_inline_image(value):
+        return value
+    data, content_type = decode_image_data(value)
+    image_hash = await store_image_bytes(data, content_type)
+    variants = await build_image_variants(image_hash, data, widths=AVATAR_VARIANT_WIDTHS, base_url=base_url)
+    return variants["avatar"]["jpeg"] if variants else image_url_for(image_hash, base_url)
 
 # Rate limiter
 limiter = Limiter(key_func=get_remote_address)
@@ -369,8 +1545,21 @@ limiter = Limiter(key_func=get_remote_address)
 # Create the main app
 app = FastAPI(title="Mystery Box Store API", version="2.0.0")
 
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZip responses except paths whose bodies are already compressed or streamed as events"""
+
+    def __init__(self, app, exclude_prefixes: tuple = (), **kwargs):
+        super().__init__(app, **kwargs)
+        self.exclude_prefixes = exclude_prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.exclude_prefixes):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
 # Add performance middlewares
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1000, exclude_prefixes=("/api/images/", "/api/events/"))
 app.add_middleware(SlowAPIMiddleware)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -437,6 +1626,8 @@ class Product(BaseModel):
     }
     image_url: str  # Primary image for backwards compatibility
     images: List[str] = []  # Additional images for gallery
+    image_variants: Dict[str, Dict[str, Any]] = {}  # Resized renditions of image_url
+    images_variants: List[Dict[str, Dict[str, Any]]] = []  # Resized renditions of each gallery image
     is_active: bool = True
     stock_quantity: int = 100
     featured: bool = False
@@ -484,6 +1675,7 @@ class CouponCode(BaseModel):
     applicable_categories: List[str] = []  # Empty means all categories
     applicable_products: List[str] = []   # Empty means all products
     is_active: bool = True
+    batch_id: Optional[str] = None  # Set on coupons made by bulk generation
     created_by: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -665,11 +1857,11 @@ class SubscriptionUpdate(BaseModel):
     next_delivery_date: Optional[datetime] = None
 
 # Utility functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    return await password_hasher.hash(password)
 
-def verify_password(password: str, hashed: str) -> bool:
-    return pwd_context.verify(password, hashed)
+async def verify_password(password: str, hashed: str) -> bool:
+    return await password_hasher.verify(password, hashed)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -716,16 +1908,288 @@ def calculate_subscription_prices(base_price: float) -> Dict[str, float]:
         "12_months": round(base_price * 0.8, 2)   # 20% discount
     }
 
-async def send_email(to_email: str, subject: str, html_content: str, text_content: Optional[str] = None):
-    """Send email using Resend"""
+# Email providers - the Resend SDK is synchronous, so sends run in a thread. EMAIL_PROVIDER=fake
+# swaps in an in-memory provider (configurable latency/failure rate) for offline load tests.
+EMAIL_FROM = "Mystery Box Store <noreply@mysteryboxes.pt>"
+EMAIL_PROVIDER = os.environ.get('EMAIL_PROVIDER', 'resend')  # "resend" or "fake"
+EMAIL_BATCH_MAX_SIZE = 100  # Resend batch endpoint limit
+
+class EmailRateLimitError(Exception):
+    """The provider rejected the request for exceeding its rate limit"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ResendEmailProvider:
+    name = "resend"
+
+    def __init__(self):
+        # Older resend releases have no request options (idempotency keys) or batch endpoint
+        self.supports_options = "options" in inspect.signature(resend.Emails.send).parameters
+        self.batch = getattr(resend, "Batch", None)
+        self.rate_limit_error = getattr(getattr(resend, "exceptions", None), "RateLimitError", None)
+
+    def _send(self, params: dict, idempotency_key: Optional[str]):
+        if idempotency_key and self.supports_options:
+            return resend.Emails.send(params, {"idempotency_key": idempotency_key})
+        return resend.Emails.send(params)
+
+    def _send_batch(self, params_list: List[dict], idempotency_key: Optional[str]) -> List[str]:
+        if self.batch is None:
+            return [self._send(params, f"{idempotency_key}_{i}" if idempotency_key else None).get("id")
+                    for i, params in enumerate(params_list)]
+        if idempotency_key and self.supports_options:
+            response = self.batch.send(params_list, {"idempotency_key": idempotency_key})
+        else:
+            response = self.batch.send(params_list)
+        data = response.get("data", []) if isinstance(response, dict) else response
+        return [item.get("id") for item in data]
+
+    async def _call(self, func, *args):
+        try:
+            return await asyncio.to_thread(func, *args)
+        except Exception as e:
+            if self.rate_limit_error and isinstance(e, self.rate_limit_error):
+                retry_after = (getattr(e, "headers", None) or {}).get("retry-after")
+                raise EmailRateLimitError(str(e), float(retry_after) if retry_after else None) from e
+            raise
+
+    async def send(self, params: dict, idempotency_key: Optional[str] = None) -> str:
+        response = await self._call(self._send, params, idempotency_key)
+        return response.get("id")
+
+    async def send_batch(self, params_list: List[dict], idempotency_key: Optional[str] = None) -> List[str]:
+        """Send up to EMAIL_BATCH_MAX_SIZE emails in one API call; returns their message ids"""
+        return await self._call(self._send_batch, params_list, idempotency_key)
+
+class FakeEmailProvider:
+    """Records emails instead of sending them; repeated idempotency keys are not re-sent"""
+    name = "fake"
+
+    def __init__(self, latency_ms: float = 50, failure_rate: float = 0.0, requests_per_second: float = 0):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.requests_per_second = requests_per_second  # 0 = no rate limit
+        self.sent: List[dict] = []
+        self.by_key: Dict[str, Any] = {}
+        self.attempts = 0
+        self.batch_calls = 0
+        self.rate_limited = 0
+        self.recent_requests: List[float] = []
+
+    def check_rate_limit(self):
+        if not self.requests_per_second:
+            return
+        now = time.monotonic()
+        self.recent_requests = [t for t in self.recent_requests if now - t < 1]
+        if len(self.recent_requests) >= self.requests_per_second:
+            self.rate_limited += 1
+            raise EmailRateLimitError("Fake email provider: too many requests", retry_after=1 - (now - self.recent_requests[0]))
+        self.recent_requests.append(now)
+
+    async def send(self, params: dict, idempotency_key: Optional[str] = None) -> str:
+        self.attempts += 1
+        self.check_rate_limit()
+        await asyncio.sleep(self.latency_ms / 1000)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError("Fake email provider: temporary failure")
+        if idempotency_key and idempotency_key in self.by_key:
+            return self.by_key[idempotency_key]
+        message_id = f"fake_{uuid.uuid4().hex}"
+        self.sent.append({**params, "id": message_id})
+        if idempotency_key:
+            self.by_key[idempotency_key] = message_id
+        return message_id
+
+    async def send_batch(self, params_list: List[dict], idempotency_key: Optional[str] = None) -> List[str]:
+        self.batch_calls += 1
+        self.check_rate_limit()
+        await asyncio.sleep(self.latency_ms / 1000)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError("Fake email provider: temporary failure")
+        if idempotency_key and idempotency_key in self.by_key:
+            return self.by_key[idempotency_key]
+        message_ids = []
+        for params in params_list:
+            message_id = f"fake_{uuid.uuid4().hex}"
+            self.sent.append({**params, "id": message_id})
+            message_ids.append(message_id)
+        if idempotency_key:
+            self.by_key[idempotency_key] = message_ids
+        return message_ids
+
+def create_email_provider(provider: str = EMAIL_PROVIDER):
+    if provider == "fake":
+        return FakeEmailProvider(
+            latency_ms=float(os.environ.get('FAKE_EMAIL_LATENCY_MS', '50')),
+            failure_rate=float(os.environ.get('FAKE_EMAIL_FAILURE_RATE', '0')),
+            requests_per_second=float(os.environ.get('FAKE_EMAIL_REQUESTS_PER_SECOND', '0'))
+        )
+    return ResendEmailProvider()
+
+email_provider = create_email_provider()
+
+# Transactional email outbox - request handlers only insert into email_outbox; a pool of
+# background workers on every process claims due messages atomically, sends them, retries
+# failures with exponential backoff and moves messages that keep failing to "dead".
+# An idempotency key (unique index) makes enqueueing the same email twice a no-op.
+# Sent messages lose their body right away; sent and dead rows expire (TTL index on
+# expires_at) after EMAIL_OUTBOX_RETENTION_DAYS.
+EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS', '4'))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '6'))
+EMAIL_RETRY_BASE_SECONDS = float(os.environ.get('EMAIL_RETRY_BASE_SECONDS', '30'))
+EMAIL_RETRY_MAX_SECONDS = 3600
+EMAIL_SEND_LEASE_SECONDS = 120  # A claimed message is retried if its worker dies mid-send
+EMAIL_POLL_SECONDS = 5
+EMAIL_OUTBOX_RETENTION_DAYS = int(os.environ.get('EMAIL_OUTBOX_RETENTION_DAYS', '14'))
+
+class EmailOutbox:
+    def __init__(self, provider, workers: int = EMAIL_WORKERS, max_attempts: int = EMAIL_MAX_ATTEMPTS,
+                 retry_base_seconds: float = EMAIL_RETRY_BASE_SECONDS):
+        self.provider = provider
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.wakeup = asyncio.Event()
+        self.running: List[asyncio.Task] = []
+        self.enqueued = 0
+        self.duplicates = 0
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+
+    async def enqueue(self, to_email: str, subject: str, html_content: str, text_content: Optional[str] = None,
+                      idempotency_key: Optional[str] = None) -> dict:
+        now = datetime.utcnow()
+        message = {
+            "id": str(uuid.uuid4()),
+            "idempotency_key": idempotency_key or str(uuid.uuid4()),
+            "to": to_email,
+            "subject": subject,
+            "html": html_content,
+            "text": text_content,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now
+        }
+        try:
+            await db.email_outbox.insert_one(message)
+        except DuplicateKeyError:
+            self.duplicates += 1
+            existing = await db.email_outbox.find_one({"idempotency_key": message["idempotency_key"]}, {"id": 1, "status": 1})
+            return {"success": True, "queued": False, "duplicate": True, "outbox_id": existing["id"] if existing else None}
+        self.enqueued += 1
+        self.wakeup.set()
+        return {"success": True, "queued": True, "outbox_id": message["id"]}
+
+    async def claim(self) -> Optional[dict]:
+        """Atomically take the next due message (or one whose sender died mid-send)"""
+        now = datetime.utcnow()
+        return await db.email_outbox.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "sending", "locked_until": {"$lt": now}}
+            ]},
+            {"$set": {"status": "sending", "locked_until": now + timedelta(seconds=EMAIL_SEND_LEASE_SECONDS)},
+             "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def retry_delay(self, attempts: int) -> float:
+        return min(self.retry_base_seconds * (2 ** (attempts - 1)), EMAIL_RETRY_MAX_SECONDS)
+
+    async def deliver(self, message: dict):
+        params = {"from": EMAIL_FROM, "to": [message["to"]], "subject": message["subject"], "html": message["html"]}
+        if message.get("text"):
+            params["text"] = message["text"]
+        try:
+            message_id = await self.provider.send(params, idempotency_key=message["idempotency_key"])
+        except Exception as e:
+            if message["attempts"] >= self.max_attempts:
+                self.dead += 1
+                logging.error(f"Email {message['id']} to {message['to']} moved to dead letter after {message['attempts']} attempts: {e}")
+                now = datetime.utcnow()
+                update = {"status": "dead", "last_error": str(e), "failed_at": now,
+                          "expires_at": now + timedelta(days=EMAIL_OUTBOX_RETENTION_DAYS)}
+            else:
+                self.retried += 1
+                delay = self.retry_delay(message["attempts"])
+                logging.warning(f"Email {message['id']} to {message['to']} failed (attempt {message['attempts']}), retry in {delay:.0f}s: {e}")
+                update = {"status": "pending", "last_error": str(e), "next_attempt_at": datetime.utcnow() + timedelta(seconds=delay)}
+            await db.email_outbox.update_one({"id": message["id"]}, {"$set": update, "$unset": {"locked_until": ""}})
+            return
+
+        self.sent += 1
+        logging.info(f"Email {message['id']} sent to {message['to']}. Message ID: {message_id}")
+        now = datetime.utcnow()
+        await db.email_outbox.update_one(
+            {"id": message["id"]},
+            {"$set": {"status": "sent", "message_id": message_id, "sent_at": now,
+                      "expires_at": now + timedelta(days=EMAIL_OUTBOX_RETENTION_DAYS)},
+             "$unset": {"locked_until": "", "html": "", "text": ""}}
+        )
+
+    async def drain(self) -> int:
+        """Send every message that is due now; returns how many were attempted"""
+        attempted = 0
+        while True:
+            message = await self.claim()
+            if message is None:
+                return attempted
+            await self.deliver(message)
+            attempted += 1
+
+    async def _worker(self):
+        while True:
+            try:
+                await self.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Email outbox worker error: {e}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=EMAIL_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self.running = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.running:
+            task.cancel()
+        self.running = []
+
+    def stats(self) -> dict:
+        return {
+            "provider": self.provider.name,
+            "workers": self.workers,
+            "enqueued": self.enqueued,
+            "duplicates": self.duplicates,
+            "sent": self.sent,
+            "retried": self.retried,
+            "dead": self.dead
+        }
+
+email_outbox = EmailOutbox(email_provider)
+
+async def send_email(to_email: str, subject: str, html_content: str, text_content: Optional[str] = None,
+                     queue: bool = False, idempotency_key: Optional[str] = None):
+    """Send email through the configured provider, or hand it to the outbox with queue=True"""
+    if queue:
+        return await email_outbox.enqueue(to_email, subject, html_content, text_content, idempotency_key)
+
     try:
         # Log the email sending attempt with timestamp
-        from datetime import datetime
         timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
         logging.info(f"[{timestamp}] Attempting to send email to {to_email} with subject: {subject}")
         
         params = {
-            "from": "Mystery Box Store <noreply@mysteryboxes.pt>",
+            "from": EMAIL_FROM,
             "to": [to_email],
             "subject": subject,
             "html": html_content
@@ -734,398 +2198,626 @@ async def send_email(to_email: str, subject: str, html_content: str, text_conten
         if text_content:
             params["text"] = text_content
         
-        response = resend.Emails.send(params)
+        message_id = await email_provider.send(params, idempotency_key=idempotency_key)
         success_timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-        logging.info(f"[{success_timestamp}] Email sent successfully to {to_email}. Message ID: {response.get('id')}")
+        logging.info(f"[{success_timestamp}] Email sent successfully to {to_email}. Message ID: {message_id}")
         
-        return {"success": True, "message_id": response.get("id"), "timestamp": success_timestamp}
+        return {"success": True, "message_id": message_id, "timestamp": success_timestamp}
     except Exception as e:
         error_timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
         logging.error(f"[{error_timestamp}] Error sending email to {to_email}: {e}")
         return {"success": False, "error": str(e), "timestamp": error_timestamp}
 
-async def send_welcome_email(user_email: str, user_name: str):
+# Email templates - the HTML and plain-text bodies live in email_templates/ and are compiled
+# once at startup into a shared Jinja2 environment. HTML templates are autoescaped, so names
+# and addresses typed by users cannot inject markup; every send reuses the compiled templates.
+EMAIL_TEMPLATES_DIR = ROOT_DIR / "email_templates"
+
+CATEGORY_EMOJIS = {
+    "mistery_box": "🎁",
+    "geek": "🎮",
+    "terror": "👻",
+    "pets": "🐕",
+    "lifestyle": "✨",
+    "tech": "📱",
+    "fashion": "👕",
+    "home": "🏠"
+}
+
+class EmailTemplates:
+    def __init__(self, directory: Path = EMAIL_TEMPLATES_DIR):
+        self.environment = Environment(
+            loader=FileSystemLoader(str(directory)),
+            autoescape=select_autoescape(["html"]),
+            auto_reload=False
+        )
+        self.templates = {
+            name: self.environment.get_template(name)
+            for name in self.environment.list_templates(extensions=["html", "txt"])
+        }
+
+    def render(self, name: str, **context) -> tuple:
+        """(html, text) bodies of an email; text is None when there is no .txt alternative"""
+        html = self.templates[f"{name}.html"].render(context)
+        text_template = self.templates.get(f"{name}.txt")
+        return html, text_template.render(context) if text_template else None
+
+email_templates = EmailTemplates()
+
+async def send_welcome_email(user_email: str, user_name: str, queue: bool = False, idempotency_key: Optional[str] = None):
     """Send welcome email to new users"""
-    html_template = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Bem-vindo à Mystery Box Store!</title>
-        <style>
-            body { font-family: 'Arial', sans-serif; margin: 0; padding: 0; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); }
-            .container { max-width: 600px; margin: 0 auto; background: white; border-radius: 20px; overflow: hidden; box-shadow: 0 20px 40px rgba(0,0,0,0.1); }
-            .header { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; text-align: center; padding: 40px 20px; }
-            .header h1 { margin: 0; font-size: 28px; font-weight: bold; }
-            .mystery-box { font-size: 60px; margin: 20px 0; animation: bounce 2s infinite; }
-            @keyframes bounce { 0%, 100% { transform: translateY(0px); } 50% { transform: translateY(-10px); } }
-            .content { padding: 40px 20px; text-align: center; }
-            .welcome-text { font-size: 18px; color: #333; margin-bottom: 30px; line-height: 1.6; }
-            .features { display: flex; justify-content: space-around; margin: 30px 0; flex-wrap: wrap; }
-            .feature { flex: 1; min-width: 150px; margin: 10px; text-align: center; }
-            .feature-icon { font-size: 40px; margin-bottom: 10px; }
-            .feature-text { font-size: 14px; color: #666; }
-            .cta-button { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 15px 30px; text-decoration: none; border-radius: 50px; font-weight: bold; font-size: 16px; display: inline-block; margin: 20px 0; transition: transform 0.3s ease; }
-            .cta-button:hover { transform: translateY(-2px); }
-            .footer { background: #f8f9fa; padding: 20px; text-align: center; color: #666; font-size: 12px; }
-            .stars { color: #FFD700; font-size: 20px; margin: 10px 0; }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <div class="mystery-box">🎁</div>
-                <h1>Bem-vindo à Mystery Box Store!</h1>
-                <p style="margin: 10px 0 0 0; font-size: 16px; opacity: 0.9;">Sua aventura misteriosa começa aqui</p>
-            </div>
-            
-            <div class="content">
-                <p class="welcome-text">
-                    Olá <strong>{{ user_name }}</strong>! 👋<br>
-                    Seja bem-vindo à nossa loja de mistérios e surpresas!
-                </p>
-                
-                <div class="stars">⭐ ⭐ ⭐ ⭐ ⭐</div>
-                
-                <div class="features">
-                    <div class="feature">
-                        <div class="feature-icon">🎯</div>
-                        <div class="feature-text">Produtos Exclusivos</div>
-                    </div>
-                    <div class="feature">
-                        <div class="feature-icon">🚀</div>
-                        <div class="feature-text">Entregas Rápidas</div>
-                    </div>
-                    <div class="feature">
-                        <div class="feature-icon">💎</div>
-                        <div class="feature-text">Qualidade Premium</div>
-                    </div>
-                </div>
-                
-                <p style="color: #666; margin: 20px 0;">
-                    Descubra produtos incríveis com descontos especiais e ofertas exclusivas para membros!
-                </p>
-                
-                <a href="https://mystery-box-loja.vercel.app" class="cta-button">
-                    🛍️ Explorar Produtos
-                </a>
-                
-                <p style="color: #888; font-size: 14px; margin-top: 30px;">
-                    Use o código <strong style="color: #667eea;">WELCOME10</strong> e ganhe 10% de desconto na sua primeira compra!
-                </p>
-            </div>
-            
-            <div class="footer">
-                <p>Mystery Box Store - Sua loja de mistérios e surpresas</p>
-                <p>© 2024 Mystery Box Store. Todos os direitos reservados.</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    
-    html_content = html_template.replace("{{ user_name }}", user_name)
+    html_content, text_content = email_templates.render("welcome", user_name=user_name)
     
     return await send_email(
         to_email=user_email,
         subject="🎁 Bem-vindo à Mystery Box Store!",
-        html_content=html_content
+        html_content=html_content,
+        text_content=text_content,
+        queue=queue,
+        idempotency_key=idempotency_key
     )
 
-async def send_order_confirmation_email(user_email: str, order: Order, products: List[dict]):
-    """Send order confirmation email"""
-    html_template = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Confirmação do Seu Pedido</title>
-        <style>
-            body { font-family: 'Arial', sans-serif; margin: 0; padding: 0; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); }
-            .container { max-width: 600px; margin: 0 auto; background: white; border-radius: 20px; overflow: hidden; box-shadow: 0 20px 40px rgba(0,0,0,0.1); }
-            .header { background: linear-gradient(135deg, #28a745 0%, #20c997 100%); color: white; text-align: center; padding: 40px 20px; }
-            .header h1 { margin: 0; font-size: 28px; font-weight: bold; }
-            .check-icon { font-size: 60px; margin: 20px 0; animation: pulse 2s infinite; }
-            @keyframes pulse { 0%, 100% { transform: scale(1); } 50% { transform: scale(1.1); } }
-            .content { padding: 40px 20px; }
-            .order-info { background: #f8f9fa; padding: 20px; border-radius: 15px; margin: 20px 0; }
-            .order-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 15px; }
-            .order-number { font-size: 18px; font-weight: bold; color: #333; }
-            .order-status { background: #28a745; color: white; padding: 5px 15px; border-radius: 20px; font-size: 12px; }
-            .product-item { display: flex; align-items: center; padding: 15px 0; border-bottom: 1px solid #eee; }
-            .product-item:last-child { border-bottom: none; }
-            .product-info { flex: 1; margin-left: 15px; }
-            .product-name { font-weight: bold; color: #333; }
-            .product-price { color: #28a745; font-weight: bold; }
-            .product-emoji { font-size: 40px; }
-            .total-section { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 20px; border-radius: 15px; margin: 20px 0; text-align: center; }
-            .total-amount { font-size: 24px; font-weight: bold; }
-            .shipping-info { background: #e3f2fd; padding: 20px; border-radius: 15px; margin: 20px 0; }
-            .cta-button { background: linear-gradient(135deg, #28a745 0%, #20c997 100%); color: white; padding: 15px 30px; text-decoration: none; border-radius: 50px; font-weight: bold; font-size: 16px; display: inline-block; margin: 20px auto; transition: transform 0.3s ease; text-align: center; }
-            .cta-button:hover { transform: translateY(-2px); }
-            .footer { background: #f8f9fa; padding: 20px; text-align: center; color: #666; font-size: 12px; }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <div class="check-icon">✅</div>
-                <h1>Pedido Confirmado!</h1>
-                <p style="margin: 10px 0 0 0; font-size: 16px; opacity: 0.9;">Obrigado pela sua compra</p>
-            </div>
-            
-            <div class="content">
-                <div class="order-info">
-                    <div class="order-header">
-                        <span class="order-number">Pedido #{{ order_id }}</span>
-                        <span class="order-status">{{ order_status }}</span>
-                    </div>
-                    <p style="color: #666; margin: 0;">
-                        📅 Realizado em: {{ order_date }}<br>
-                        💳 Método de pagamento: {{ payment_method }}<br>
-                        🚚 Método de entrega: {{ shipping_method }}
-                    </p>
-                </div>
-                
-                <h3 style="color: #333; margin: 30px 0 15px 0;">📦 Produtos Comprados:</h3>
-                
-                {{ products_list }}
-                
-                <div class="total-section">
-                    <p style="margin: 0 0 10px 0; font-size: 16px;">Total do Pedido</p>
-                    <div class="total-amount">€{{ total_amount }}</div>
-                </div>
-                
-                <div class="shipping-info">
-                    <h4 style="color: #1976d2; margin: 0 0 10px 0;">🚚 Informações de Entrega</h4>
-                    <p style="color: #666; margin: 0;">
-                        <strong>{{ customer_name }}</strong><br>
-                        {{ customer_address }}<br>
-                        {{ customer_postal_code }} {{ customer_city }}
-                    </p>
-                </div>
-                
-                <div style="text-align: center;">
-                    <a href="https://mystery-box-loja.vercel.app/profile" class="cta-button">
-                        📋 Acompanhar Pedido
-                    </a>
-                </div>
-                
-                <p style="color: #888; font-size: 14px; text-align: center; margin-top: 30px;">
-                    Receberá um email com o código de rastreamento assim que o pedido for enviado.
-                </p>
-            </div>
-            
-            <div class="footer">
-                <p>Mystery Box Store - Sua loja de mistérios e surpresas</p>
-                <p>© 2024 Mystery Box Store. Todos os direitos reservados.</p>
-                <p>Precisa de ajuda? Contacte-nos através do chat no website.</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    
-    # Build products list HTML
-    products_html = ""
+def order_email_items(order: Order, products: List[dict]) -> List[dict]:
+    """Product rows of the order confirmation email"""
+    products_by_id = {product["id"]: product for product in products}
+    items = []
     for item in order.items:
-        # Find product in the products list
-        product = next((p for p in products if p["id"] == item.product_id), None)
+        product = products_by_id.get(item.product_id)
         if product:
             price = item.subscription_type and product.get("subscription_prices", {}).get(item.subscription_type) or product.get("price", 0)
-            total_price = price * item.quantity
-            
-            # Map categories to emojis
-            category_emojis = {
-                "mistery_box": "🎁",
-                "geek": "🎮",
-                "terror": "👻",
-                "pets": "🐕",
-                "lifestyle": "✨",
-                "tech": "📱",
-                "fashion": "👕",
-                "home": "🏠"
-            }
-            emoji = category_emojis.get(product.get("category", ""), "📦")
-            
-            products_html += f"""
-            <div class="product-item">
-                <div class="product-emoji">{emoji}</div>
-                <div class="product-info">
-                    <div class="product-name">{product.get("name", "Produto")}</div>
-                    <div style="color: #666; font-size: 14px;">{product.get("description", "")}</div>
-                    <div style="margin-top: 5px;">
-                        <span style="color: #666;">Quantidade: {item.quantity}</span>
-                        <span class="product-price" style="float: right;">€{total_price:.2f}</span>
-                    </div>
-                </div>
-            </div>
-            """
-    
-    # Replace placeholders
-    html_content = html_template.replace("{{ order_id }}", order.id[:8])
-    html_content = html_content.replace("{{ order_status }}", order.order_status.title())
-    html_content = html_content.replace("{{ order_date }}", order.created_at.strftime("%d/%m/%Y às %H:%M"))
-    html_content = html_content.replace("{{ payment_method }}", order.payment_method.title())
-    html_content = html_content.replace("{{ shipping_method }}", order.shipping_method.title())
-    html_content = html_content.replace("{{ products_list }}", products_html)
-    html_content = html_content.replace("{{ total_amount }}", f"{order.total_amount:.2f}")
-    html_content = html_content.replace("{{ customer_name }}", order.customer_name)
-    html_content = html_content.replace("{{ customer_address }}", order.customer_address)
-    html_content = html_content.replace("{{ customer_postal_code }}", order.customer_postal_code)
-    html_content = html_content.replace("{{ customer_city }}", order.customer_city)
+            items.append({
+                "name": product.get("name", "Produto"),
+                "description": product.get("description", ""),
+                "emoji": CATEGORY_EMOJIS.get(product.get("category", ""), "📦"),
+                "quantity": item.quantity,
+                "total_price": price * item.quantity
+            })
+    return items
+
+async def send_order_confirmation_email(user_email: str, order: Order, products: List[dict], customer_name: Optional[str] = None,
+                                        queue: bool = False, idempotency_key: Optional[str] = None):
+    """Send order confirmation email"""
+    html_content, text_content = email_templates.render(
+        "order_confirmation",
+        order_id=order.id[:8],
+        order_status=order.order_status.title(),
+        order_date=order.created_at.strftime("%d/%m/%Y às %H:%M"),
+        payment_method=order.payment_method.title(),
+        shipping_method=order.shipping_method.title(),
+        items=order_email_items(order, products),
+        total_amount=order.total_amount,
+        customer_name=customer_name,
+        shipping_address=order.shipping_address,
+        phone=order.phone
+    )
     
     return await send_email(
         to_email=user_email,
         subject=f"✅ Confirmação de Pedido #{order.id[:8]}",
-        html_content=html_content
+        html_content=html_content,
+        text_content=text_content,
+        queue=queue,
+        idempotency_key=idempotency_key
     )
 
-async def send_discount_email(user_email: str, user_name: str, coupon_code: str, discount_value: float, discount_type: str, expiry_date: str):
-    """Send discount notification email"""
-    html_template = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <title>Desconto Especial!</title>
-        <style>
-            body { font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; background-color: #0f0f10; color: white; }
-            .container { background: linear-gradient(135deg, #f59e0b, #d97706); padding: 40px; border-radius: 20px; }
-            .header { text-align: center; margin-bottom: 30px; }
-            .content { background: rgba(0,0,0,0.3); padding: 30px; border-radius: 15px; }
-            .coupon { background: linear-gradient(45deg, #fbbf24, #f59e0b); color: black; padding: 20px; border-radius: 15px; text-align: center; margin: 20px 0; border: 3px dashed #92400e; }
-            .button { display: inline-block; background: linear-gradient(45deg, #8b5cf6, #6366f1); color: white; padding: 15px 30px; text-decoration: none; border-radius: 10px; font-weight: bold; margin: 20px 0; }
-            .footer { text-align: center; margin-top: 30px; font-size: 14px; color: #ccc; }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>🎉 Desconto Especial Para Si!</h1>
-                <div style="font-size: 48px;">💰 🎁</div>
-            </div>
-            <div class="content">
-                <h2>Olá {{ user_name }}! 🌟</h2>
-                <p>Temos uma surpresa especial para si! Aproveite este desconto exclusivo nas nossas mystery boxes.</p>
-                
-                <div class="coupon">
-                    <h2 style="margin: 0; color: black;">{{ discount_text }}</h2>
-                    <div style="font-size: 28px; font-weight: bold; margin: 15px 0; color: #92400e;">{{ coupon_code }}</div>
-                    <p style="margin: 0; color: black;">Código promocional</p>
-                </div>
-                
-                <div style="text-align: center;">
-                    <a href="https://mysteryboxes.pt/produtos" class="button">🛒 Usar Desconto</a>
-                </div>
-                
-                <p><strong>Válido até:</strong> {{ expiry_date }}</p>
-                <p>Não perca esta oportunidade de descobrir mistérios incríveis com desconto!</p>
-            </div>
-            <div class="footer">
-                <p>Mystery Box Store - Descontos misteriosos! 🔮</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    
+def discount_email_content(user_name: str, coupon_code: str, discount_value: float, discount_type: str, expiry_date: str) -> tuple:
+    """(subject, html, text) of the discount email"""
     discount_text = f"{discount_value}% OFF" if discount_type == "percentage" else f"€{discount_value} OFF"
-    
-    template = Template(html_template)
-    html_content = template.render(
+    html_content, text_content = email_templates.render(
+        "discount",
         user_name=user_name,
         discount_text=discount_text,
         coupon_code=coupon_code,
         expiry_date=expiry_date
     )
+    return f"🎉 {discount_text} - Desconto Especial!", html_content, text_content
+
+def birthday_email_content(user_name: str, coupon_code: str, discount_value: float) -> tuple:
+    """(subject, html, text) of the birthday email"""
+    html_content, text_content = email_templates.render(
+        "birthday",
+        user_name=user_name,
+        discount_value=discount_value,
+        coupon_code=coupon_code
+    )
+    return f"🎂 Feliz Aniversário {user_name}! Desconto especial para si!", html_content, text_content
+
+async def send_discount_email(user_email: str, user_name: str, coupon_code: str, discount_value: float, discount_type: str, expiry_date: str, queue: bool = False, idempotency_key: Optional[str] = None):
+    """Send discount notification email"""
+    subject, html_content, text_content = discount_email_content(user_name, coupon_code, discount_value, discount_type, expiry_date)
     
     return await send_email(
         to_email=user_email,
-        subject=f"🎉 {discount_text} - Desconto Especial!",
-        html_content=html_content
+        subject=subject,
+        html_content=html_content,
+        text_content=text_content,
+        queue=queue,
+        idempotency_key=idempotency_key
     )
 
-async def send_birthday_email(user_email: str, user_name: str, coupon_code: str, discount_value: float):
+async def send_birthday_email(user_email: str, user_name: str, coupon_code: str, discount_value: float, queue: bool = False, idempotency_key: Optional[str] = None):
     """Send birthday discount email"""
-    html_template = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <title>Feliz Aniversário!</title>
-        <style>
-            body { font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; background-color: #0f0f10; color: white; }
-            .container { background: linear-gradient(135deg, #ec4899, #be185d); padding: 40px; border-radius: 20px; }
-            .header { text-align: center; margin-bottom: 30px; }
-            .content { background: rgba(0,0,0,0.3); padding: 30px; border-radius: 15px; }
-            .coupon { background: linear-gradient(45deg, #fbbf24, #f59e0b); color: black; padding: 20px; border-radius: 15px; text-align: center; margin: 20px 0; border: 3px dashed #92400e; }
-            .button { display: inline-block; background: linear-gradient(45deg, #8b5cf6, #6366f1); color: white; padding: 15px 30px; text-decoration: none; border-radius: 10px; font-weight: bold; margin: 20px 0; }
-            .footer { text-align: center; margin-top: 30px; font-size: 14px; color: #ccc; }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>🎂 Feliz Aniversário!</h1>
-                <div style="font-size: 48px;">🎉 🎁 🎈</div>
-            </div>
-            <div class="content">
-                <h2>Parabéns {{ user_name }}! 🥳</h2>
-                <p>É o seu dia especial e nós temos um presente especial para si! Celebre com desconto nas nossas mystery boxes.</p>
-                
-                <div class="coupon">
-                    <h2 style="margin: 0; color: black;">🎂 {{ discount_value }}% OFF 🎂</h2>
-                    <div style="font-size: 28px; font-weight: bold; margin: 15px 0; color: #92400e;">{{ coupon_code }}</div>
-                    <p style="margin: 0; color: black;">Desconto de Aniversário</p>
-                </div>
-                
-                <div style="text-align: center;">
-                    <a href="https://mysteryboxes.pt/produtos" class="button">🎁 Celebrar com Compras</a>
-                </div>
-                
-                <p>Este desconto especial é válido por 7 dias. Aproveite o seu aniversário para descobrir mistérios incríveis!</p>
-                
-                <p style="text-align: center; font-size: 18px;">🎊 Que tenha um aniversário cheio de surpresas! 🎊</p>
-            </div>
-            <div class="footer">
-                <p>Mystery Box Store - Celebrando os seus momentos especiais! 💜</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    
-    template = Template(html_template)
-    html_content = template.render(
-        user_name=user_name,
-        discount_value=discount_value,
-        coupon_code=coupon_code
-    )
+    subject, html_content, text_content = birthday_email_content(user_name, coupon_code, discount_value)
     
     return await send_email(
         to_email=user_email,
-        subject=f"🎂 Feliz Aniversário {user_name}! Desconto especial para si!",
-        html_content=html_content
+        subject=subject,
+        html_content=html_content,
+        text_content=text_content,
+        queue=queue,
+        idempotency_key=idempotency_key
     )
 
+# Birthday rewards - a scheduled job gives every user whose birthday is today a single-use
+# coupon and queues the birthday email. Users are matched on birth_month_day ("MM-DD", kept in
+# sync with birth_date and indexed) instead of scanning every birth date. A birthday_rewards
+# row with a unique (user_id, year) key is claimed before anything is created, so re-runs and
+# concurrent workers never reward a user twice in the same year; a claimed row is only marked
+# queued once its coupon and email exist, so an interrupted run is finished by the next one.
+BIRTHDAY_DISCOUNT_PERCENT = float(os.environ.get('BIRTHDAY_DISCOUNT_PERCENT', '15'))
+BIRTHDAY_COUPON_VALID_DAYS = 7
+
+def birth_month_day(birth_date: Optional[datetime]) -> Optional[str]:
+    return birth_date.strftime("%m-%d") if birth_date else None
+
+def birthday_keys(day: datetime) -> List[str]:
+    """birth_month_day values celebrated on a day (29 February is celebrated on the 28th in common years)"""
+    keys = [day.strftime("%m-%d")]
+    if keys[0] == "02-28" and not calendar.isleap(day.year):
+        keys.append("02-29")
+    return keys
+
+async def backfill_birth_month_day() -> int:
+    """Set birth_month_day on users saved before the field existed"""
+    result = await db.users.update_many(
+        {"birth_date": {"$type": "date"}, "birth_month_day": {"$exists": False}},
+        [{"$set": {"birth_month_day": {"$dateToString": {"format": "%m-%d", "date": "$birth_date"}}}}]
+    )
+    return result.modified_count
+
+async def insert_many_ignoring_duplicates(collection, documents: List[dict]) -> List[dict]:
+    """Unordered insert_many; returns the documents that were inserted (duplicates are skipped)"""
+    if not documents:
+        return []
+    try:
+        await collection.insert_many(documents, ordered=False)
+        return documents
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+        return [doc for i, doc in enumerate(documents) if i not in duplicates]
+
+async def run_birthday_rewards(today: Optional[datetime] = None) -> dict:
+    """Claim, create coupons for and queue the birthday emails of today's birthdays"""
+    today = today or datetime.utcnow()
+    year = today.year
+    users = await db.users.find(
+        {"birth_month_day": {"$in": birthday_keys(today)}, "email": {"$nin": [None, ""]}},
+        {"_id": 0, "id": 1, "email": 1, "name": 1}
+    ).to_list(None)
+
+    rewarded = set(await db.birthday_rewards.distinct("user_id", {"year": year, "user_id": {"$in": [user["id"] for user in users]}}))
+    claims = [{
+        "id": str(uuid.uuid4()),
+        "user_id": user["id"],
+        "year": year,
+        "email": user["email"],
+        "name": user.get("name") or "Cliente",
+        "coupon_code": "ANIV" + secrets.token_hex(4).upper(),
+        "status": "claimed",
+        "created_at": datetime.utcnow()
+    } for user in users if user["id"] not in rewarded]
+    claimed = await insert_many_ignoring_duplicates(db.birthday_rewards, claims)
+
+    # Claimed rows, including ones left behind by an interrupted run
+    pending = await db.birthday_rewards.find({"year": year, "status": "claimed"}, {"_id": 0}).to_list(None)
+    if not pending:
+        return {"matched": len(users), "claimed": len(claimed), "queued": 0}
+
+    valid_from = datetime.utcnow()
+    coupons = [{
+        **CouponCode(
+            code=reward["coupon_code"],
+            description=f"Aniversário {year} - {reward['name']}",
+            discount_type="percentage",
+            discount_value=BIRTHDAY_DISCOUNT_PERCENT,
+            max_uses=1,
+            valid_from=valid_from,
+            valid_until=valid_from + timedelta(days=BIRTHDAY_COUPON_VALID_DAYS),
+            created_by="birthday_job"
+        ).dict(),
+        "assigned_user_id": reward["user_id"]
+    } for reward in pending]
+    await insert_many_ignoring_duplicates(db.coupons, coupons)
+
+    for reward in pending:
+        await send_birthday_email(
+            reward["email"], reward["name"], reward["coupon_code"], BIRTHDAY_DISCOUNT_PERCENT,
+            queue=True, idempotency_key=f"birthday_{reward['user_id']}_{year}"
+        )
+    await db.birthday_rewards.update_many(
+        {"id": {"$in": [reward["id"] for reward in pending]}},
+        {"$set": {"status": "queued", "queued_at": datetime.utcnow()}}
+    )
+    logging.info(f"Birthday rewards {today.strftime('%Y-%m-%d')}: {len(users)} birthdays, {len(claimed)} new, {len(pending)} queued")
+    return {"matched": len(users), "claimed": len(claimed), "queued": len(pending)}
+
+# Bulk coupon generation - a batch turns one coupon template into N unique codes (prefix plus
+# random characters without look-alikes such as 0/O and 1/I). Codes are drawn collision-free in
+# memory and written with unordered insert_many chunks; a code that already exists in the
+# collection is skipped by the unique index and drawn again. The batch document tracks
+# progress, and the codes are exported as a streamed CSV.
+COUPON_CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+COUPON_BATCH_MAX_QUANTITY = 100000
+COUPON_BATCH_INSERT_SIZE = 1000
+COUPON_BATCH_CSV_FIELDS = ["code", "discount_type", "discount_value", "min_order_value", "max_uses", "current_uses", "valid_from", "valid_until", "is_active"]
+
+class CouponBatchCreate(BaseModel):
+    quantity: int
+    prefix: str = ""
+    code_length: int = 8  # Random characters after the prefix
+    description: str
+    discount_type: str
+    discount_value: float
+    min_order_value: Optional[float] = None
+    max_uses: Optional[int] = 1  # Single-use by default
+    valid_from: datetime
+    valid_until: datetime
+    applicable_categories: List[str] = []
+    applicable_products: List[str] = []
+
+def generate_coupon_codes(prefix: str, length: int, count: int, seen: set) -> List[str]:
+    """count new random codes, none of them in seen (which they are added to)"""
+    rng = random.SystemRandom()
+    codes = []
+    while len(codes) < count:
+        code = prefix + "".join(rng.choices(COUPON_CODE_ALPHABET, k=length))
+        if code not in seen:
+            seen.add(code)
+            codes.append(code)
+    return codes
+
+async def create_coupon_batch(batch_data: CouponBatchCreate, created_by: str) -> dict:
+    batch = {
+        "id": str(uuid.uuid4()),
+        **batch_data.dict(),
+        "prefix": batch_data.prefix.upper(),
+        "created": 0,
+        "status": "running",
+        "error": None,
+        "created_by": created_by,
+        "created_at": datetime.utcnow(),
+        "completed_at": None
+    }
+    await db.coupon_batches.insert_one(batch)
+    batch.pop("_id", None)
+    return batch
+
+async def run_coupon_batch(batch: dict, progress=None) -> dict:
+    """Insert the batch's coupons chunk by chunk, recording progress on the batch document"""
+    template = CouponCode(
+        code=batch["prefix"],
+        batch_id=batch["id"],
+        created_by=batch["created_by"],
+        **{field: batch[field] for field in CouponCreate.__fields__ if field != "code"}
+    ).dict()
+    seen = set()
+    created = 0
+    empty_rounds = 0
+    try:
+        while created < batch["quantity"]:
+            codes = generate_coupon_codes(batch["prefix"], batch["code_length"], min(COUPON_BATCH_INSERT_SIZE, batch["quantity"] - created), seen)
+            documents = [{**template, "id": str(uuid.uuid4()), "code": code} for code in codes]
+            inserted = await insert_many_ignoring_duplicates(db.coupons, documents)
+            created += len(inserted)
+            empty_rounds = 0 if inserted else empty_rounds + 1
+            if empty_rounds >= 5:
+                raise RuntimeError("Códigos esgotados para este prefixo e comprimento")
+            await db.coupon_batches.update_one({"id": batch["id"]}, {"$set": {"created": created}})
+            if progress:
+                progress(created, batch["quantity"])
+        update = {"status": "completed", "created": created, "completed_at": datetime.utcnow()}
+    except Exception as e:
+        logging.error(f"Coupon batch {batch['id']} failed after {created} coupons: {e}")
+        update = {"status": "failed", "created": created, "error": str(e), "completed_at": datetime.utcnow()}
+    await db.coupon_batches.update_one({"id": batch["id"]}, {"$set": update})
+    return {**batch, **update}
+
+async def coupon_batch_csv(batch_id: str):
+    """CSV rows of a batch's coupons, yielded in chunks straight from the cursor"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COUPON_BATCH_CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    projection = {"_id": 0, **{field: 1 for field in COUPON_BATCH_CSV_FIELDS}}
+    async for coupon in db.coupons.find({"batch_id": batch_id}, projection).sort("code", 1).batch_size(COUPON_BATCH_INSERT_SIZE):
+        writer.writerow(coupon)
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def validate_coupon_batch(batch_data: CouponBatchCreate):
+    if not 1 <= batch_data.quantity <= COUPON_BATCH_MAX_QUANTITY:
+        raise HTTPException(status_code=400, detail=f"Quantidade deve estar entre 1 e {COUPON_BATCH_MAX_QUANTITY}")
+    if not re.fullmatch(r"[A-Za-z0-9-]{0,20}", batch_data.prefix):
+        raise HTTPException(status_code=400, detail="Prefixo inválido (apenas letras, números e hífen)")
+    if batch_data.discount_type not in ("percentage", "fixed"):
+        raise HTTPException(status_code=400, detail="Tipo de desconto inválido")
+    if not 4 <= batch_data.code_length <= 16:
+        raise HTTPException(status_code=400, detail="Comprimento do código deve estar entre 4 e 16")
+    # Keep random draws far from the keyspace limit so collisions stay rare
+    if len(COUPON_CODE_ALPHABET) ** batch_data.code_length < batch_data.quantity * 1000:
+        raise HTTPException(status_code=400, detail="Comprimento do código demasiado curto para esta quantidade")
+    if batch_data.valid_until <= batch_data.valid_from:
+        raise HTTPException(status_code=400, detail="Data de fim deve ser posterior à data de início")
+
+# Email campaigns - a campaign resolves a user segment into email_campaign_recipients (one
+# pending row per user, which is the send queue and the per-recipient status), then a single
+# sender (leader-elected scheduler task, plus a lease on the campaign document) renders each
+# recipient's email and sends them in batches through the provider's batch endpoint, throttled
+# to EMAIL_CAMPAIGN_REQUESTS_PER_SECOND and pausing whenever the provider reports a rate limit.
+CAMPAIGN_TEMPLATES = ["discount", "birthday"]
+CAMPAIGN_SEGMENTS = ["all", "birthday_today", "no_orders", "customers"]
+EMAIL_CAMPAIGN_BATCH_SIZE = min(int(os.environ.get('EMAIL_CAMPAIGN_BATCH_SIZE', '100')), EMAIL_BATCH_MAX_SIZE)
+EMAIL_CAMPAIGN_REQUESTS_PER_SECOND = float(os.environ.get('EMAIL_CAMPAIGN_REQUESTS_PER_SECOND', '2'))  # Resend default limit
+EMAIL_CAMPAIGN_MAX_ATTEMPTS = 3
+EMAIL_CAMPAIGN_RETRY_SECONDS = 5
+EMAIL_CAMPAIGN_LEASE_SECONDS = 120
+EMAIL_CAMPAIGN_MAX_PAUSE_SECONDS = 60
+
+class EmailCampaignCreate(BaseModel):
+    template: str  # "discount" or "birthday"
+    segment: str = "all"
+    coupon_code: str
+    discount_value: float
+    discount_type: str = "percentage"
+    expiry_date: Optional[str] = None
+
+def campaign_segment_users(segment: str):
+    """Cursor over the id, email and name of every user of a campaign segment"""
+    query = {"email": {"$nin": [None, ""]}}
+    projection = {"_id": 0, "id": 1, "email": 1, "name": 1}
+    if segment == "birthday_today":
+        query["birth_month_day"] = {"$in": birthday_keys(datetime.utcnow())}
+    elif segment in ("no_orders", "customers"):
+        # Each user is checked against the orders.user_id index as the cursor streams,
+        # instead of building an $in/$nin list of every customer id
+        return db.users.aggregate([
+            {"$match": query},
+            {"$lookup": {
+                "from": "orders",
+                "let": {"user_id": "$id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
+                    {"$limit": 1},
+                    {"$project": {"_id": 1}}
+                ],
+                "as": "orders"
+            }},
+            {"$match": {"orders": {"$ne": []} if segment == "customers" else []}},
+            {"$project": projection}
+        ])
+    return db.users.find(query, projection)
+
+def campaign_email_content(campaign: dict, recipient: dict) -> tuple:
+    """(subject, html, text) of a campaign email for one recipient"""
+    name = recipient.get("name") or "Cliente"
+    if campaign["template"] == "birthday":
+        return birthday_email_content(name, campaign["coupon_code"], campaign["discount_value"])
+    return discount_email_content(name, campaign["coupon_code"], campaign["discount_value"],
+                                  campaign["discount_type"], campaign.get("expiry_date") or "")
+
+class RequestThrottle:
+    """Spaces out provider calls to at most rate_per_second, shared by every campaign send"""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1 / rate_per_second if rate_per_second > 0 else 0
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            delay = self.next_slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_slot = max(self.next_slot, time.monotonic()) + self.interval
+
+    def pause(self, seconds: float):
+        """Push the next slot back after the provider reported a rate limit"""
+        self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+class CampaignSender:
+    def __init__(self, provider, batch_size: int = EMAIL_CAMPAIGN_BATCH_SIZE,
+                 requests_per_second: float = EMAIL_CAMPAIGN_REQUESTS_PER_SECOND, worker_id: str = WORKER_ID):
+        self.provider = provider
+        self.batch_size = batch_size
+        self.throttle = RequestThrottle(requests_per_second)
+        self.retry_seconds = EMAIL_CAMPAIGN_RETRY_SECONDS
+        self.worker_id = worker_id
+        self.batches = 0
+        self.sent = 0
+        self.failed = 0
+        self.unconfirmed = 0
+        self.rate_limited = 0
+
+    async def create_campaign(self, data: EmailCampaignCreate, created_by: Optional[str] = None) -> dict:
+        """Store the campaign and queue one pending recipient row per user of the segment"""
+        now = datetime.utcnow()
+        campaign = {
+            "id": str(uuid.uuid4()),
+            **data.dict(),
+            "status": "draft",
+            "total": 0,
+            "sent": 0,
+            "failed": 0,
+            "unconfirmed": 0,
+            "created_by": created_by,
+            "created_at": now,
+            "updated_at": now
+        }
+        await db.email_campaigns.insert_one(campaign)
+
+        total = 0
+        chunk = []
+        async for user in campaign_segment_users(data.segment):
+            chunk.append({"campaign_id": campaign["id"], "user_id": user["id"], "email": user["email"],
+                          "name": user.get("name"), "status": "pending", "attempts": 0})
+            if len(chunk) >= 1000:
+                await db.email_campaign_recipients.insert_many(chunk, ordered=False)
+                total += len(chunk)
+                chunk = []
+        if chunk:
+            await db.email_campaign_recipients.insert_many(chunk, ordered=False)
+            total += len(chunk)
+
+        campaign.update({"status": "queued" if total else "completed", "total": total})
+        await db.email_campaigns.update_one({"id": campaign["id"]}, {"$set": {"status": campaign["status"], "total": total}})
+        campaign.pop("_id", None)
+        return campaign
+
+    async def claim(self, campaign_id: Optional[str] = None) -> Optional[dict]:
+        """Take (or renew) the sending lease of a queued/running campaign"""
+        now = datetime.utcnow()
+        query = {"status": {"$in": ["queued", "running"]},
+                 "$or": [{"locked_until": {"$exists": False}}, {"locked_until": {"$lt": now}}, {"locked_by": self.worker_id}]}
+        if campaign_id:
+            query["id"] = campaign_id
+        return await db.email_campaigns.find_one_and_update(
+            query,
+            {"$set": {"status": "running", "locked_by": self.worker_id,
+                      "locked_until": now + timedelta(seconds=EMAIL_CAMPAIGN_LEASE_SECONDS), "updated_at": now},
+             "$min": {"started_at": now}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def send_batch(self, campaign: dict, recipients: List[dict]):
+        params_list = []
+        for recipient in recipients:
+            subject, html_content, text_content = campaign_email_content(campaign, recipient)
+            params_list.append({"from": EMAIL_FROM, "to": [recipient["email"]], "subject": subject,
+                                "html": html_content, "text": text_content})
+        # Same recipients -> same key, so a batch retried after a timeout is not delivered twice
+        batch_key = hashlib.sha256("|".join(r["user_id"] for r in recipients).encode()).hexdigest()[:32]
+        ids = [recipient["_id"] for recipient in recipients]
+
+        await self.throttle.wait()
+        try:
+            message_ids = await self.provider.send_batch(params_list, idempotency_key=f"campaign_{campaign['id']}_{batch_key}")
+        except EmailRateLimitError as e:
+            self.rate_limited += 1
+            pause = min(e.retry_after or 1.0, EMAIL_CAMPAIGN_MAX_PAUSE_SECONDS)
+            logging.warning(f"Campaign {campaign['id']} rate limited by the email provider, pausing {pause:.1f}s")
+            self.throttle.pause(pause)
+            return
+        except Exception as e:
+            logging.error(f"Campaign {campaign['id']} batch of {len(recipients)} failed: {e}")
+            self.throttle.pause(self.retry_seconds)
+            now = datetime.utcnow()
+            await db.email_campaign_recipients.update_many(
+                {"_id": {"$in": ids}}, {"$inc": {"attempts": 1}, "$set": {"last_error": str(e), "updated_at": now}}
+            )
+            failed = await db.email_campaign_recipients.update_many(
+                {"_id": {"$in": ids}, "attempts": {"$gte": EMAIL_CAMPAIGN_MAX_ATTEMPTS}}, {"$set": {"status": "failed"}}
+            )
+            if failed.modified_count:
+                self.failed += failed.modified_count
+                await db.email_campaigns.update_one({"id": campaign["id"]}, {"$inc": {"failed": failed.modified_count}})
+            return
+
+        now = datetime.utcnow()
+        self.batches += 1
+        delivered = list(zip(recipients, message_ids))
+        updates = [
+            UpdateOne({"_id": recipient["_id"]},
+                      {"$set": {"status": "sent", "message_id": message_id, "sent_at": now, "updated_at": now},
+                       "$inc": {"attempts": 1}})
+            for recipient, message_id in delivered
+        ]
+        # Recipients the provider returned no message id for may or may not have been sent;
+        # they are marked instead of left pending, so they are not emailed again
+        unconfirmed = [recipient["_id"] for recipient in recipients[len(delivered):]]
+        if unconfirmed:
+            logging.warning(f"Campaign {campaign['id']} batch returned {len(message_ids)} message ids for {len(recipients)} recipients")
+            updates.append(UpdateMany(
+                {"_id": {"$in": unconfirmed}},
+                {"$set": {"status": "unconfirmed", "last_error": "Sem id de mensagem do fornecedor", "updated_at": now},
+                 "$inc": {"attempts": 1}}
+            ))
+        self.sent += len(delivered)
+        self.unconfirmed += len(unconfirmed)
+        await db.email_campaign_recipients.bulk_write(updates, ordered=False)
+        await db.email_campaigns.update_one({"id": campaign["id"]}, {"$inc": {"sent": len(delivered), "unconfirmed": len(unconfirmed)}})
+
+    async def run_campaign(self, campaign: dict):
+        """Send every pending recipient of a claimed campaign, renewing the lease per batch"""
+        logging.info(f"Sending campaign {campaign['id']} ({campaign['template']}, segment {campaign['segment']}) to {campaign['total']} users")
+        while True:
+            recipients = await db.email_campaign_recipients.find(
+                {"campaign_id": campaign["id"], "status": "pending"}
+            ).limit(self.batch_size).to_list(self.batch_size)
+            if not recipients:
+                break
+            await self.send_batch(campaign, recipients)
+            campaign = await self.claim(campaign["id"])
+            if campaign is None:
+                logging.info("Campaign stopped (cancelled or taken over by another worker)")
+                return
+
+        await db.email_campaigns.update_one(
+            {"id": campaign["id"], "status": "running"},
+            {"$set": {"status": "completed", "completed_at": datetime.utcnow()}, "$unset": {"locked_by": "", "locked_until": ""}}
+        )
+        logging.info(f"Campaign {campaign['id']} completed")
+
+    async def run_pending(self):
+        """Scheduled task: work through queued campaigns (and resume ones whose sender died)"""
+        while True:
+            campaign = await self.claim()
+            if campaign is None:
+                return
+            await self.run_campaign(campaign)
+
+    def stats(self) -> dict:
+        return {
+            "batch_size": self.batch_size,
+            "batches": self.batches,
+            "sent": self.sent,
+            "failed": self.failed,
+            "unconfirmed": self.unconfirmed,
+            "rate_limited": self.rate_limited
+        }
+
+campaign_sender = CampaignSender(email_provider)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     if not credentials:
         return None
+    return await resolve_user_from_token(credentials.credentials)
 
+async def resolve_user_from_token(token: str) -> Optional[User]:
+    """User for a JWT access token (also used by EventSource streams, which cannot send headers)"""
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
             return None
     except JWTError:
         return None
 
+    cached = user_cache.get(email)
+    if cached is not None:
+        return cached.model_copy()
+
+    generation = user_cache.generation
     user = await db.users.find_one({"email": email})
     if user:
-        return User(**user)
+        resolved = User(**user)
+        user_cache.put(email, resolved, generation)
+        return resolved.model_copy()
     return None
 
 async def get_admin_user(current_user: User = Depends(get_current_user)):
@@ -1133,6 +2825,411 @@ async def get_admin_user(current_user: User = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
+# Request-scoped product loader - endpoints that render carts/orders collect every product id
+# first and resolve them with a single $in query instead of one find_one per item (N+1).
+class ProductLoader:
+    def __init__(self, collection=None, cache: Optional[CacheBackend] = None):
+        self.collection = collection if collection is not None else db.products
+        self.cache = cache
+        self.products: Dict[str, Optional[dict]] = {}
+        self.queries = 0
+
+    async def load_many(self, product_ids) -> Dict[str, dict]:
+        """Products by id (missing ids are left out); ids already seen are not queried again.
+        With a cache, products come from the catalog cache (public product payloads) first."""
+        product_ids = list(dict.fromkeys(product_ids))
+        missing = [pid for pid in product_ids if pid not in self.products]
+        if missing and self.cache is not None:
+            cached = await self.cache.get_many([f"product_{pid}" for pid in missing])
+            for pid in missing:
+                if f"product_{pid}" in cached:
+                    self.products[pid] = cached[f"product_{pid}"]
+            missing = [pid for pid in missing if pid not in self.products]
+        if missing:
+            self.queries += 1
+            found = await self.collection.find({"id": {"$in": missing}}).to_list(None)
+            if self.cache is not None:
+                found = [map_product_document(product) for product in found]
+                await self.cache.set_many({f"product_{product['id']}": product for product in found})
+            for product in found:
+                self.products[product["id"]] = product
+            for pid in missing:
+                self.products.setdefault(pid, None)
+        return {pid: self.products[pid] for pid in product_ids if self.products[pid] is not None}
+
+    async def load(self, product_id: str) -> Optional[dict]:
+        return (await self.load_many([product_id])).get(product_id)
+
+def get_product_loader() -> ProductLoader:
+    """One loader per request (FastAPI caches dependencies within a request)"""
+    return ProductLoader()
+
+def get_catalog_product_loader() -> ProductLoader:
+    """Request loader backed by the catalog cache, for read-only views such as the cart"""
+    return ProductLoader(cache=cache_backend)
+
+# Cart pricing - line prices, active promotions, coupon discount, VAT and shipping are
+# computed here and nowhere else: checkout charges exactly what GET /cart shows. Products
+# are batch-loaded (from the catalog cache for cart views), so pricing a cart of any size
+# costs at most one products query plus the coupon lookup.
+VAT_RATE = 0.23
+
+def product_unit_price(product: dict, subscription_type: Optional[str]) -> float:
+    """Base or subscription price of a product (subscription prices left at 0 fall back to the base price)"""
+    price = product.get("price", 0.0)
+    if subscription_type:
+        price = (product.get("subscription_prices") or {}).get(subscription_type) or price
+    return price
+
+def discount_applies_to(rule, product: dict) -> bool:
+    """Coupon/promotion product and category restrictions (none means everything)"""
+    if not rule.applicable_categories and not rule.applicable_products:
+        return True
+    return product.get("category") in rule.applicable_categories or product.get("id") in rule.applicable_products
+
+def promoted_price(price: float, promotions: List[Promotion], product: dict) -> tuple:
+    """(lowest price, promotion giving it) among the promotions that apply to the product"""
+    best_price, best_promotion = price, None
+    for promotion in promotions:
+        if not discount_applies_to(promotion, product):
+            continue
+        if promotion.discount_type == "percentage":
+            candidate = price * (1 - promotion.discount_value / 100)
+        else:
+            candidate = price - promotion.discount_value
+        candidate = max(candidate, 0.0)
+        if candidate < best_price:
+            best_price, best_promotion = candidate, promotion
+    return best_price, best_promotion
+
+# Promotion index - every worker keeps the active promotions in memory, bucketed by product
+# id and category (plus the unrestricted ones), so a product's sale price is a couple of dict
+# lookups. The index is rebuilt without a query when the next valid_from/valid_until boundary
+# passes, and reloaded after admin writes (broadcast to the other workers as the "promotions"
+# cache invalidation) or once it is older than the cache TTL.
+class PromotionIndex:
+    """Per-worker index of active promotions by product id and category"""
+
+    def __init__(self, max_age_seconds: int = 300):
+        self.max_age = timedelta(seconds=max_age_seconds)
+        self.promotions: List[Promotion] = []  # Active and not yet ended, scheduled ones included
+        self.by_product: Dict[str, List[Promotion]] = {}
+        self.by_category: Dict[str, List[Promotion]] = {}
+        self.unrestricted: List[Promotion] = []
+        self.next_boundary: Optional[datetime] = None
+        self.loaded_at: Optional[datetime] = None
+        self.stale = True
+        self.lock = asyncio.Lock()
+        self.loads = 0
+        self.rebuilds = 0
+
+    async def load(self):
+        now = datetime.utcnow()
+        documents = await db.promotions.find({"is_active": True, "valid_until": {"$gt": now}}, {"_id": 0}).to_list(None)
+        self.promotions = [Promotion(**document) for document in documents]
+        self.loaded_at = now
+        self.stale = False
+        self.loads += 1
+        self.build(now)
+
+    def build(self, now: Optional[datetime] = None):
+        """Bucket the promotions running at now ([valid_from, valid_until)) and find the next boundary"""
+        now = now or datetime.utcnow()
+        by_product: Dict[str, List[Promotion]] = {}
+        by_category: Dict[str, List[Promotion]] = {}
+        unrestricted = []
+        boundaries = []
+        for promotion in self.promotions:
+            boundaries += [moment for moment in (promotion.valid_from, promotion.valid_until) if moment > now]
+            if not promotion.valid_from <= now < promotion.valid_until:
+                continue
+            if not promotion.applicable_products and not promotion.applicable_categories:
+                unrestricted.append(promotion)
+            for product_id in promotion.applicable_products:
+                by_product.setdefault(product_id, []).append(promotion)
+            for category in promotion.applicable_categories:
+                by_category.setdefault(category, []).append(promotion)
+        self.by_product, self.by_category, self.unrestricted = by_product, by_category, unrestricted
+        self.next_boundary = min(boundaries) if boundaries else None
+        self.rebuilds += 1
+
+    async def refresh(self) -> bool:
+        """Reload or rebuild when needed; True when sale prices may have changed"""
+        now = datetime.utcnow()
+        if self.stale or now - self.loaded_at >= self.max_age:
+            async with self.lock:
+                if self.stale or now - self.loaded_at >= self.max_age:
+                    await self.load()
+                    return True
+            return False
+        if self.next_boundary is not None and now >= self.next_boundary:
+            self.build(now)
+            return True
+        return False
+
+    def invalidate(self):
+        self.stale = True
+
+    def on_remote_invalidation(self, pattern: str, exact: bool):
+        """Another worker changed the promotions - reload on the next lookup"""
+        if pattern == "promotions":
+            self.invalidate()
+
+    def best_price(self, price: float, product: dict) -> tuple:
+        """(sale price, promotion giving it) for a product at the given list price"""
+        candidates = self.by_product.get(product.get("id"), []) + self.by_category.get(product.get("category"), []) + self.unrestricted
+        if not candidates:
+            return price, None
+        return promoted_price(price, candidates, product)
+
+    def apply(self, product_data: dict) -> dict:
+        """Public product payload with its effective sale price"""
+        sale_price, promotion = self.best_price(product_data.get("price", 0.0), product_data)
+        return {
+            **product_data,
+            "sale_price": round(sale_price, 2),
+            "promotion": {
+                "id": promotion.id,
+                "name": promotion.name,
+                "discount_type": promotion.discount_type,
+                "discount_value": promotion.discount_value,
+                "valid_until": promotion.valid_until
+            } if promotion else None
+        }
+
+    def stats(self) -> dict:
+        return {
+            "promotions": len(self.promotions),
+            "running": len({p.id for bucket in (*self.by_product.values(), *self.by_category.values(), self.unrestricted) for p in bucket}),
+            "next_boundary": self.next_boundary,
+            "loaded_at": self.loaded_at,
+            "loads": self.loads,
+            "rebuilds": self.rebuilds
+        }
+
+promotion_index = PromotionIndex(max_age_seconds=CACHE_TTL_SECONDS)
+cache_backend.add_invalidation_listener(promotion_index.on_remote_invalidation, remote_only=True)
+
+async def refresh_promotions():
+    """Bring the promotion index up to date, dropping snapshot views built with old sale prices"""
+    if await promotion_index.refresh():
+        catalog_snapshot.drop_products()
+
+async def price_cart(items: List[CartItem], coupon_code: Optional[str], shipping_method_id: Optional[str],
+                     product_loader: ProductLoader) -> dict:
+    """Line totals and order totals for cart items"""
+    await refresh_promotions()
+    products = await product_loader.load_many(item.product_id for item in items)
+
+    lines = []
+    subtotal = 0.0
+    for item in items:
+        product = products.get(item.product_id)
+        if not product:
+            lines.append({"product_id": item.product_id, "subscription_type": item.subscription_type,
+                          "quantity": item.quantity, "available": False})
+            continue
+        list_price = product_unit_price(product, item.subscription_type)
+        unit_price, promotion = promotion_index.best_price(list_price, product)
+        line_total = unit_price * item.quantity
+        subtotal += line_total
+        lines.append({
+            "product_id": item.product_id,
+            "subscription_type": item.subscription_type,
+            "quantity": item.quantity,
+            "available": True,
+            "name": product.get("name"),
+            "category": product.get("category"),
+            "image_url": product.get("image_url", ""),
+            "list_price": round(list_price, 2),
+            "unit_price": round(unit_price, 2),
+            "promotion_id": promotion.id if promotion else None,
+            "line_total": round(line_total, 2)
+        })
+
+    # Coupon discount (an invalid or expired coupon is reported, not applied)
+    discount_amount = 0.0
+    coupon_error = None
+    if coupon_code:
+        try:
+            coupon = await validate_coupon(coupon_code)
+            applies = any(discount_applies_to(coupon, product) for product in products.values())
+            if not applies:
+                coupon_error = "Cupão não aplicável aos produtos do carrinho"
+            elif coupon.min_order_value and subtotal < coupon.min_order_value:
+                coupon_error = f"Valor mínimo de encomenda: €{coupon.min_order_value:.2f}"
+            elif coupon.discount_type == "percentage":
+                discount_amount = subtotal * (coupon.discount_value / 100)
+            else:
+                discount_amount = min(coupon.discount_value, subtotal)
+        except HTTPException as e:
+            coupon_error = e.detail
+
+    # Shipping (free above the method's minimum order)
+    shipping_methods = await get_shipping_methods()
+    shipping_method = next((sm for sm in shipping_methods if sm["id"] == shipping_method_id), shipping_methods[0])
+    shipping_cost = shipping_method["price"]
+    if shipping_method.get("min_order") and (subtotal - discount_amount) >= shipping_method["min_order"]:
+        shipping_cost = 0.0
+
+    vat_amount = (subtotal - discount_amount) * VAT_RATE
+    total_amount = subtotal - discount_amount + vat_amount + shipping_cost
+    return {
+        "lines": lines,
+        "item_count": sum(line["quantity"] for line in lines if line["available"]),
+        "subtotal": round(subtotal, 2),
+        "coupon_code": coupon_code,
+        "coupon_error": coupon_error,
+        "discount_amount": round(discount_amount, 2),
+        "shipping_method": shipping_method["id"],
+        "shipping_cost": round(shipping_cost, 2),
+        "vat_amount": round(vat_amount, 2),
+        "total_amount": round(total_amount, 2)
+    }
+
+# Dashboard statistics - order counts and revenue live in a materialized "stats" document
+# (plus revenue_daily / revenue_monthly rows keyed by date) that checkout, payment
+# confirmation and order status changes keep up to date with $inc. The full figures are
+# rebuilt with one aggregation at startup (when missing) or on demand, by one worker at a
+# time under a scheduler lease. Orders carry the time of every counted event (created_at,
+# paid_at, status_changed_at with previous_order_status), so a rebuild can count each order
+# as it stood at a cutoff and leave later events to the writers' own $inc.
+DASHBOARD_STATS_ID = "dashboard"
+DASHBOARD_REBUILD_LEASE = "dashboard_stats_rebuild"
+DASHBOARD_REBUILD_LEASE_SECONDS = 300
+
+def revenue_periods(when: datetime) -> tuple:
+    return when.strftime("%Y-%m-%d"), when.strftime("%Y-%m")
+
+def counter_deltas(target: dict, current: dict, fields: List[str]) -> dict:
+    return {field: target.get(field, 0) - current.get(field, 0) for field in fields}
+
+async def rebuild_dashboard_stats() -> Optional[dict]:
+    """Recompute order counters and revenue breakdowns from the orders collection
+
+    Returns None when another rebuild is already running.
+    """
+    owner = str(uuid.uuid4())
+    if not await scheduler.acquire_lease(DASHBOARD_REBUILD_LEASE, DASHBOARD_REBUILD_LEASE_SECONDS, owner=owner):
+        return None
+    try:
+        return await _rebuild_dashboard_stats()
+    finally:
+        await scheduler.release_lease(DASHBOARD_REBUILD_LEASE, owner=owner)
+
+def dashboard_stats_pipeline(cutoff: datetime) -> list:
+    """Order counts and daily revenue as they stood at the cutoff"""
+    revenue_date = {"$ifNull": ["$paid_at", "$created_at"]}
+    return [
+        {"$match": {"created_at": {"$lte": cutoff}}},
+        {"$project": {
+            "total_amount": 1,
+            "revenue_date": revenue_date,
+            # A status changed after the cutoff is counted as it was before the change
+            "order_status": {"$cond": [{"$gt": ["$status_changed_at", cutoff]}, "$previous_order_status", "$order_status"]},
+            "paid": {"$and": [{"$eq": ["$payment_status", "paid"]}, {"$lte": [revenue_date, cutoff]}]}
+        }},
+        {"$facet": {
+            "by_status": [{"$group": {"_id": "$order_status", "count": {"$sum": 1}}}],
+            "daily": [
+                {"$match": {"paid": True}},
+                {"$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$revenue_date"}},
+                    "revenue": {"$sum": "$total_amount"},
+                    "orders": {"$sum": 1}
+                }}
+            ]
+        }}
+    ]
+
+async def _rebuild_dashboard_stats() -> dict:
+    # Counters as they stand now, then the cutoff: the aggregation only counts events up to
+    # the cutoff and the difference is applied as $inc, so an order created, paid or moved
+    # after it is counted by its writer's own $inc alone
+    current = await db.stats.find_one({"_id": DASHBOARD_STATS_ID}) or {}
+    current_daily = {row["_id"]: row for row in await db.revenue_daily.find().to_list(None)}
+    current_monthly = {row["_id"]: row for row in await db.revenue_monthly.find().to_list(None)}
+    cutoff = datetime.utcnow()
+
+    result = (await db.orders.aggregate(dashboard_stats_pipeline(cutoff)).to_list(1))[0]
+
+    orders_by_status = {}
+    for row in result["by_status"]:
+        status = row["_id"] or "pending"
+        orders_by_status[status] = orders_by_status.get(status, 0) + row["count"]
+
+    daily = {row["_id"]: {"revenue": row["revenue"], "orders": row["orders"]} for row in result["daily"]}
+    monthly = {}
+    for day, row in daily.items():
+        month = monthly.setdefault(day[:7], {"revenue": 0.0, "orders": 0})
+        month["revenue"] += row["revenue"]
+        month["orders"] += row["orders"]
+
+    rebuilt = {
+        "total_orders": sum(orders_by_status.values()),
+        "paid_orders": sum(row["orders"] for row in daily.values()),
+        "total_revenue": sum(row["revenue"] for row in daily.values())
+    }
+    inc = counter_deltas(rebuilt, current, list(rebuilt))
+    current_by_status = current.get("orders_by_status", {})
+    for status, delta in counter_deltas(orders_by_status, current_by_status, list({*orders_by_status, *current_by_status})).items():
+        inc[f"orders_by_status.{status}"] = delta
+    now = datetime.utcnow()
+    stats = await db.stats.find_one_and_update(
+        {"_id": DASHBOARD_STATS_ID},
+        {"$inc": inc, "$set": {"built_at": now, "updated_at": now}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+    for collection, target, existing in ((db.revenue_daily, daily, current_daily), (db.revenue_monthly, monthly, current_monthly)):
+        updates = [
+            UpdateOne({"_id": period}, {"$inc": counter_deltas(target.get(period, {}), existing.get(period, {}), ["revenue", "orders"])}, upsert=True)
+            for period in {*target, *existing}
+        ]
+        if updates:
+            await collection.bulk_write(updates, ordered=False)
+        await collection.delete_many({"orders": {"$lte": 0}})
+    return stats
+
+async def get_dashboard_stats() -> dict:
+    stats = await db.stats.find_one({"_id": DASHBOARD_STATS_ID})
+    if not stats or not stats.get("built_at"):
+        # Another worker may be building it already; show what is there until it is done
+        stats = await rebuild_dashboard_stats() or stats or {}
+    return stats
+
+async def record_order_created(order: dict):
+    """Count a new order (and its revenue if it is created already paid)"""
+    status = order.get("order_status") or "pending"
+    await db.stats.update_one(
+        {"_id": DASHBOARD_STATS_ID},
+        {"$inc": {"total_orders": 1, f"orders_by_status.{status}": 1}, "$set": {"updated_at": datetime.utcnow()}}
+    )
+    if order.get("payment_status") == "paid":
+        await record_order_paid(order.get("total_amount", 0), order.get("paid_at") or order.get("created_at") or datetime.utcnow())
+
+async def record_order_paid(amount: float, paid_at: datetime, previous_status: Optional[str] = None, new_status: Optional[str] = None):
+    """Add a confirmed payment to the revenue counters - call once per order"""
+    inc = {"paid_orders": 1, "total_revenue": amount}
+    if previous_status and new_status and previous_status != new_status:
+        inc[f"orders_by_status.{previous_status}"] = -1
+        inc[f"orders_by_status.{new_status}"] = 1
+    await db.stats.update_one({"_id": DASHBOARD_STATS_ID}, {"$inc": inc, "$set": {"updated_at": datetime.utcnow()}})
+
+    day, month = revenue_periods(paid_at)
+    await db.revenue_daily.update_one({"_id": day}, {"$inc": {"revenue": amount, "orders": 1}}, upsert=True)
+    await db.revenue_monthly.update_one({"_id": month}, {"$inc": {"revenue": amount, "orders": 1}}, upsert=True)
+
+async def record_order_status_change(previous_status: str, new_status: str):
+    if previous_status == new_status:
+        return
+    await db.stats.update_one(
+        {"_id": DASHBOARD_STATS_ID},
+        {"$inc": {f"orders_by_status.{previous_status}": -1, f"orders_by_status.{new_status}": 1},
+         "$set": {"updated_at": datetime.utcnow()}}
+    )
+
 # Sample data initialization
 SAMPLE_PRODUCTS = [
     {
@@ -1226,7 +3323,10 @@ SAMPLE_CATEGORIES = [
 ]
 
 # Initialize sample data and database indexes
-@api_router.on_event("startup")
+# SEED_SAMPLE_DATA=true creates the default super admin (password admin123) and the sample
+# catalog on startup; leave it off in production
+SEED_SAMPLE_DATA = os.environ.get('SEED_SAMPLE_DATA', 'false').lower() == 'true'
+
 async def fix_cart_indexes():
     """Fix problematic cart indexes by dropping and recreating them"""
     try:
@@ -1288,8 +3388,9 @@ async def cleanup_duplicate_carts():
     except Exception as e:
         print(f"Error cleaning up duplicate carts: {e}")
 
+@api_router.on_event("startup")
 async def startup_event():
-    # Start background tasks (keep-alive)
+    # Start background tasks (keep-alive, cache invalidation listener)
     await start_background_tasks()
     
     # Create database indexes for performance
@@ -1308,6 +3409,7 @@ async def startup_event():
         await db.users.create_index([("email", 1)], unique=True)
         await db.users.create_index([("id", 1)], unique=True)
         await db.users.create_index([("is_admin", 1)])
+        await db.users.create_index([("birth_month_day", 1)], sparse=True)
         
         # Orders indexes
         await db.orders.create_index([("id", 1)], unique=True)
@@ -1316,6 +3418,7 @@ async def startup_event():
         await db.orders.create_index([("created_at", -1)])
         await db.orders.create_index([("order_status", 1)])
         await db.orders.create_index([("payment_status", 1)])
+        await db.orders.create_index([("order_status", 1), ("created_at", -1), ("id", -1)])
         
         # Categories indexes
         await db.categories.create_index([("id", 1)], unique=True)
@@ -1326,6 +3429,13 @@ async def startup_event():
         await db.coupons.create_index([("is_active", 1)])
         await db.coupons.create_index([("valid_from", 1)])
         await db.coupons.create_index([("valid_until", 1)])
+        await db.coupons.create_index([("batch_id", 1), ("code", 1)])
+        await db.coupon_batches.create_index([("id", 1)], unique=True)
+        await db.coupon_batches.create_index([("created_at", -1)])
+        
+        # Promotions indexes
+        await db.promotions.create_index([("id", 1)], unique=True)
+        await db.promotions.create_index([("is_active", 1), ("valid_until", 1)])
         
         # Chat indexes
         await db.chat_sessions.create_index([("id", 1)], unique=True)
@@ -1336,11 +3446,64 @@ async def startup_event():
         await db.chat_messages.create_index([("chat_session_id", 1)])
         await db.chat_messages.create_index([("sender_id", 1)])
         await db.chat_messages.create_index([("timestamp", -1)])
+        await db.chat_messages.create_index([("chat_session_id", 1), ("timestamp", 1), ("id", 1)])
+        await db.chat_sessions.create_index([("updated_at", -1)])
+        await db.chat_sessions.create_index([("status", 1), ("updated_at", 1)])
+
+        # Email outbox indexes
+        await db.email_outbox.create_index([("idempotency_key", 1)], unique=True)
+        await db.email_outbox.create_index([("id", 1)], unique=True)
+        await db.email_outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+        await db.email_outbox.create_index([("expires_at", 1)], expireAfterSeconds=0)
+        await db.email_campaigns.create_index([("id", 1)], unique=True)
+        await db.email_campaigns.create_index([("status", 1), ("created_at", 1)])
+        await db.email_campaign_recipients.create_index([("campaign_id", 1), ("user_id", 1)], unique=True)
+        await db.email_campaign_recipients.create_index([("campaign_id", 1), ("status", 1)])
+        await db.birthday_rewards.create_index([("user_id", 1), ("year", 1)], unique=True)
+        await db.birthday_rewards.create_index([("year", 1), ("status", 1)])
+
+        # Payment transactions updated by the Stripe webhook events
+        await db.payment_transactions.create_index([("session_id", 1)])
         
         print("Database indexes created successfully")
     except Exception as e:
         print(f"Error creating indexes: {e}")
-    
+
+    # Webhook idempotency depends on this index, so it is not part of the block above
+    # (logged as critical, and webhooks are refused, when it cannot be created)
+    await stripe_event_processor.ensure_indexes()
+
+    # Birthday lookups use birth_month_day; fill it in for users saved before it existed
+    try:
+        backfilled = await backfill_birth_month_day()
+        if backfilled:
+            print(f"Set birth_month_day on {backfilled} users")
+    except Exception as e:
+        print(f"Error backfilling birth_month_day: {e}")
+
+    # Outbox rows written before sent bodies were dropped and rows were given an expiry
+    try:
+        expires_at = datetime.utcnow() + timedelta(days=EMAIL_OUTBOX_RETENTION_DAYS)
+        await db.email_outbox.update_many(
+            {"status": "sent", "$or": [{"html": {"$exists": True}}, {"expires_at": {"$exists": False}}]},
+            {"$unset": {"html": "", "text": ""}, "$set": {"expires_at": expires_at}}
+        )
+        await db.email_outbox.update_many({"status": "dead", "expires_at": {"$exists": False}}, {"$set": {"expires_at": expires_at}})
+    except Exception as e:
+        print(f"Error expiring email outbox rows: {e}")
+
+    # Materialize dashboard statistics on first start
+    try:
+        await get_dashboard_stats()
+    except Exception as e:
+        print(f"Error building dashboard stats: {e}")
+
+    # Sample data and the default super admin are only created when explicitly requested
+    if SEED_SAMPLE_DATA:
+        await seed_sample_data()
+
+async def seed_sample_data():
+    """Create the default super admin, sample products and categories when missing"""
     # Check if admin user exists
     admin_user = await db.users.find_one({"email": ADMIN_EMAIL})
     if not admin_user:
@@ -1349,7 +3512,7 @@ async def startup_event():
             name="Admin Principal",
             is_admin=True,
             is_super_admin=True,
-            password_hash=hash_password("admin123")
+            password_hash=await hash_password("admin123")
         )
         await db.users.insert_one(admin.dict())
         print(f"Created super admin: {ADMIN_EMAIL}")
@@ -1384,18 +3547,18 @@ async def register(request: Request, user_data: UserCreate):
     user = User(
         email=user_data.email,
         name=user_data.name,
-        password_hash=hash_password(user_data.password),
+        password_hash=await hash_password(user_data.password),
         is_admin=user_data.email == ADMIN_EMAIL,
         is_super_admin=user_data.email == ADMIN_EMAIL
     )
     await db.users.insert_one(user.dict())
     
-    # Send welcome email
+    # Queue welcome email (sent by the outbox workers, not inside the request)
     try:
-        email_result = await send_welcome_email(user.email, user.name)
-        logging.info(f"Welcome email sent to {user.email}: {email_result}")
+        email_result = await send_welcome_email(user.email, user.name, queue=True, idempotency_key=f"welcome_{user.id}")
+        logging.info(f"Welcome email queued for {user.email}: {email_result}")
     except Exception as e:
-        logging.error(f"Failed to send welcome email to {user.email}: {e}")
+        logging.error(f"Failed to queue welcome email to {user.email}: {e}")
 
     access_token = create_access_token(data={"sub": user.email})
     return Token(
@@ -1408,7 +3571,7 @@ async def register(request: Request, user_data: UserCreate):
 @limiter.limit("15/minute")
 async def login(request: Request, credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user["password_hash"]):
+    if not user or not user.get("password_hash") or not await verify_password(credentials.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Credenciais inválidas")
 
     access_token = create_access_token(data={"sub": user["email"]})
@@ -1421,10 +3584,7 @@ async def login(request: Request, credentials: UserLogin):
 @api_router.post("/auth/google", response_model=Token)
 async def google_auth(auth_request: GoogleAuthRequest):
     try:
-        idinfo = id_token.verify_oauth2_token(auth_request.token, requests.Request(), GOOGLE_CLIENT_ID)
-
-        if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
-            raise ValueError('Wrong issuer.')
+        idinfo = await google_token_verifier.verify(auth_request.token)
 
         email = idinfo['email']
         name = idinfo['name']
@@ -1446,14 +3606,15 @@ async def google_auth(auth_request: GoogleAuthRequest):
             await db.users.insert_one(new_user.dict())
             user = new_user.dict()
             
-            # Send welcome email for new Google users
-            await send_welcome_email(email, name)
+            # Queue welcome email for new Google users
+            await send_welcome_email(email, name, queue=True, idempotency_key=f"welcome_{new_user.id}")
         else:
             # Update existing user with Google info
             await db.users.update_one(
                 {"email": email},
                 {"$set": {"google_id": google_id, "avatar_url": avatar_url}}
             )
+            await invalidate_user_cache(email)
 
         access_token = create_access_token(data={"sub": email})
         return Token(
@@ -1485,7 +3646,7 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
     }
 
 @api_router.put("/auth/profile")
-async def update_user_profile(profile_data: UserProfileUpdate, current_user: User = Depends(get_current_user)):
+async def update_user_profile(request: Request, profile_data: UserProfileUpdate, current_user: User = Depends(get_current_user)):
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
@@ -1506,24 +3667,29 @@ async def update_user_profile(profile_data: UserProfileUpdate, current_user: Use
         update_data["nif"] = profile_data.nif
     if profile_data.birth_date is not None:
         update_data["birth_date"] = profile_data.birth_date
+        update_data["birth_month_day"] = birth_month_day(profile_data.birth_date)
     if profile_data.avatar_base64 is not None:
-        update_data["avatar_url"] = profile_data.avatar_base64
+        update_data["avatar_url"] = await prepare_avatar_image(profile_data.avatar_base64, public_base_url(request))
 
     if update_data:
         await db.users.update_one(
             {"id": current_user.id},
             {"$set": update_data}
         )
+        await invalidate_user_cache(current_user.email)
     
     return {"message": "Perfil atualizado com sucesso"}
 
 @api_router.get("/auth/orders")
-async def get_user_orders(current_user: User = Depends(get_current_user)):
+async def get_user_orders(current_user: User = Depends(get_current_user), product_loader: ProductLoader = Depends(get_product_loader)):
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     # Get orders for the current user
     orders = await db.orders.find({"user_id": current_user.id}).sort("created_at", -1).to_list(1000)
+
+    # Product details for every item of every order in one query
+    products = await product_loader.load_many(item["product_id"] for order in orders for item in order.get("items", []))
     
     # Convert ObjectId to string and prepare order data
     result = []
@@ -1534,7 +3700,7 @@ async def get_user_orders(current_user: User = Depends(get_current_user)):
         # Get product details for each order item
         order_items_with_details = []
         for item in order.get("items", []):
-            product = await db.products.find_one({"id": item["product_id"]})
+            product = products.get(item["product_id"])
             if product:
                 price = item.get("subscription_type") and product["subscription_prices"].get(item["subscription_type"]) or product["price"]
                 order_items_with_details.append({
@@ -1579,72 +3745,9 @@ async def health_check():
     except Exception as e:
         return {"status": "unhealthy", "error": str(e), "timestamp": datetime.utcnow()}
 
-@api_router.get("/products")
-@limiter.limit("120/minute")
-async def get_products(request: Request, category: Optional[str] = None, featured: Optional[bool] = None):
-    # Create cache key
-    cache_key = f"products_{category or 'all'}_{featured or 'all'}"
-    
-    # Try to get from cache first
-    if cache_key in cache:
-        return cache[cache_key]
-    
-    query = {"is_active": True}
-    if category:
-        query["category"] = category
-    if featured is not None:
-        query["featured"] = featured
-
-    products = await db.products.find(query).sort("created_at", -1).to_list(1000)
-    # Convert ObjectId to string and prepare product data
-    result = []
-    for product in products:
-        if "_id" in product:
-            product["_id"] = str(product["_id"])
-        
-        # Map database fields to Product model fields
-        product_data = {
-            "id": product.get("id"),
-            "name": product.get("name"),
-            "description": product.get("description"),
-            "category": product.get("category", ""),
-            "price": product.get("price", 0.0),
-            "subscription_prices": product.get("subscription_prices", {
-                "3_months": 0.0,
-                "6_months": 0.0,
-                "12_months": 0.0
-            }),
-            "image_url": product.get("image_url", ""),
-            "images": product.get("images", []),  # Add gallery images
-            "is_active": product.get("is_active", True),
-            "stock_quantity": product.get("stock_quantity", 100),
-            "featured": product.get("featured", False),
-            "created_at": product.get("created_at", datetime.utcnow())
-        }
-        result.append(product_data)
-    
-    # Cache the result
-    cache[cache_key] = result
-    return result
-
-@api_router.get("/products/{product_id}")
-@limiter.limit("180/minute")
-async def get_product(request: Request, product_id: str):
-    # Try cache first
-    cache_key = f"product_{product_id}"
-    if cache_key in cache:
-        return cache[cache_key]
-    
-    product = await db.products.find_one({"id": product_id})
-    if not product:
-        raise HTTPException(status_code=404, detail="Produto não encontrado")
-    
-    # Convert ObjectId to string
-    if "_id" in product:
-        product["_id"] = str(product["_id"])
-    
-    # Map database fields to Product model fields
-    product_data = {
+def map_product_document(product: dict) -> dict:
+    """Map a products collection document to the public product payload"""
+    return {
         "id": product.get("id"),
         "name": product.get("name"),
         "description": product.get("description"),
@@ -1657,42 +3760,197 @@ async def get_product(request: Request, product_id: str):
         }),
         "image_url": product.get("image_url", ""),
         "images": product.get("images", []),  # Add gallery images
+        "image_variants": product.get("image_variants", {}),
+        "images_variants": product.get("images_variants", []),
         "is_active": product.get("is_active", True),
         "stock_quantity": product.get("stock_quantity", 100),
         "featured": product.get("featured", False),
         "created_at": product.get("created_at", datetime.utcnow())
     }
+
+async def refresh_catalog_product(product_id: str):
+    """Invalidate the shared cache (and the other workers) for a product write, then rebuild this worker's snapshot"""
+    # Shared cache first: a request rebuilding a view in between must not read the old product
+    await invalidate_cache_pattern("products_")
+    await invalidate_cache_key(f"product_{product_id}")  # Invalidate specific product cache
+    
+    product = await db.products.find_one({"id": product_id})
+    await refresh_promotions()
+    catalog_snapshot.apply_product(product_id, promotion_index.apply(map_product_document(product)) if product else None)
+
+@api_router.get("/products")
+@limiter.limit("120/minute")
+async def get_products(request: Request, category: Optional[str] = None, featured: Optional[bool] = None):
+    # Snapshot views carry sale prices, so they are dropped when a promotion starts or ends
+    await refresh_promotions()
+    
+    # Serve the pre-serialized snapshot when this worker already has the view
+    entry = catalog_snapshot.get_view(category, featured)
+    if entry is not None:
+        return snapshot_response(request, entry)
+    
+    # Create cache key
+    cache_key = f"products_{category or 'all'}_{'all' if featured is None else featured}"
+    generation = catalog_snapshot.generation
+    
+    # Try the shared cache before going to the database
+    result = await cache_backend.get(cache_key)
+    if result is None:
+        query = {"is_active": True}
+        if category:
+            query["category"] = category
+        if featured is not None:
+            query["featured"] = featured
+
+        products = await db.products.find(query).sort("created_at", -1).to_list(1000)
+        result = [map_product_document(product) for product in products]
+        
+        # Cache the result
+        await cache_backend.set(cache_key, result)
+    
+    # The shared cache keeps list prices; sale prices are applied per worker
+    entry = catalog_snapshot.put_view(category, featured, [promotion_index.apply(product) for product in result], generation)
+    return snapshot_response(request, entry)
+
+@api_router.get("/products/{product_id}")
+@limiter.limit("180/minute")
+async def get_product(request: Request, product_id: str):
+    await refresh_promotions()
+    
+    # Serve the pre-serialized snapshot when this worker already has the product
+    entry = catalog_snapshot.get_product(product_id)
+    if entry is not None:
+        return snapshot_response(request, entry)
+    
+    # Try the shared cache before going to the database
+    cache_key = f"product_{product_id}"
+    generation = catalog_snapshot.generation
+    product_data = await cache_backend.get(cache_key)
+    if product_data is None:
+        product = await db.products.find_one({"id": product_id})
+        if not product:
+            raise HTTPException(status_code=404, detail="Produto não encontrado")
+        
+        product_data = map_product_document(product)
+        
+        # Cache the result
+        await cache_backend.set(cache_key, product_data)
     
-    # Cache the result
-    cache[cache_key] = product_data
-    return product_data
+    entry = catalog_snapshot.put_product(product_id, promotion_index.apply(product_data), generation)
+    return snapshot_response(request, entry)
 
 @api_router.get("/categories")
 @limiter.limit("120/minute")
 async def get_categories(request: Request):
-    # Try cache first
-    cache_key = "categories_active"
-    if cache_key in cache:
-        return cache[cache_key]
-    
-    categories = await db.categories.find({"is_active": True}).to_list(1000)
-    # Convert ObjectId to string
-    for category in categories:
-        if "_id" in category:
-            category["_id"] = str(category["_id"])
+    # Serve the pre-serialized snapshot when this worker already has it
+    entry = catalog_snapshot.get_categories()
+    if entry is not None:
+        return snapshot_response(request, entry)
     
-    # Cache the result
-    cache[cache_key] = categories
-    return categories
+    # Try the shared cache before going to the database
+    cache_key = "categories_active"
+    categories = await cache_backend.get(cache_key)
+    if categories is None:
+        categories = await db.categories.find({"is_active": True}).to_list(1000)
+        # Convert ObjectId to string
+        for category in categories:
+            if "_id" in category:
+                category["_id"] = str(category["_id"])
+        
+        # Cache the result
+        await cache_backend.set(cache_key, categories)
+    
+    entry = catalog_snapshot.put_categories(categories)
+    return snapshot_response(request, entry)
+
+@api_router.get("/images/{image_hash}")
+async def get_image(request: Request, image_hash: str):
+    """Serve an image blob; content-addressed, so it can be cached forever"""
+    if not IMAGE_HASH_PATTERN.match(image_hash):
+        raise HTTPException(status_code=404, detail="Imagem não encontrada")
+    
+    headers = {"ETag": f'"{image_hash}"', "Cache-Control": IMAGE_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    blob = await image_store.get(image_hash)
+    if not blob:
+        raise HTTPException(status_code=404, detail="Imagem não encontrada")
+    
+    data, content_type = blob
+    return Response(content=data, media_type=content_type, headers=headers)
+
+# Cart updates - every cart mutation is a single atomic find_one_and_update on the cart
+# document (creating it with upsert when needed) that returns the new state, so concurrent
+# requests for the same cart (two tabs, double clicks) can never overwrite each other.
+async def update_cart(session_id: str, update: dict, match: Optional[dict] = None, upsert: bool = True) -> Optional[dict]:
+    """Apply update to the session's cart and return it (None if match fails and upsert is off)"""
+    update.setdefault("$set", {})["updated_at"] = datetime.utcnow()
+    if upsert:
+        # Defaults for a new cart, except fields the update itself writes
+        touched = {field.split(".")[0] for fields in update.values() for field in fields}
+        update["$setOnInsert"] = {
+            key: value for key, value in Cart(session_id=session_id).dict().items()
+            if key not in touched and key != "session_id"
+        }
+    return await db.carts.find_one_and_update(
+        {"session_id": session_id, **(match or {})},
+        update,
+        projection={"_id": 0},
+        upsert=upsert,
+        return_document=ReturnDocument.AFTER
+    )
+
+# Coupons - definitions are read through the catalog cache (dropped on admin coupon writes,
+# on every worker), so validating a coupon on cart views and checkout costs no query. The
+# cached current_uses may lag behind; the authoritative check is redeem_coupon, a single
+# conditional update that only counts a use while current_uses < max_uses.
+async def get_active_coupon(code: str) -> Optional[CouponCode]:
+    cache_key = f"coupon_{code}"
+    coupon = await cache_backend.get(cache_key)
+    if coupon is None:
+        coupon = await db.coupons.find_one({"code": code, "is_active": True}, {"_id": 0})
+        if not coupon:
+            return None
+        await cache_backend.set(cache_key, coupon)
+    return CouponCode(**coupon)
+
+async def redeem_coupon(code: str) -> Optional[dict]:
+    """Count one use of a valid coupon; None when it is inactive, expired or used up"""
+    now = datetime.utcnow()
+    coupon = await db.coupons.find_one_and_update(
+        {
+            "code": code,
+            "is_active": True,
+            "valid_from": {"$lte": now},
+            "valid_until": {"$gte": now},
+            "$or": [
+                {"max_uses": None},
+                {"max_uses": 0},
+                {"$expr": {"$lt": ["$current_uses", "$max_uses"]}}
+            ]
+        },
+        {"$inc": {"current_uses": 1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if coupon and coupon.get("max_uses") and coupon["current_uses"] >= coupon["max_uses"]:
+        # Used up - stop offering it from the cache
+        await invalidate_cache_key(f"coupon_{code}")
+    return coupon
+
+async def release_coupon(code: str):
+    """Give back a use counted for a checkout that did not go through"""
+    await db.coupons.update_one({"code": code, "current_uses": {"$gt": 0}}, {"$inc": {"current_uses": -1}})
+    await invalidate_cache_key(f"coupon_{code}")
 
 # Coupon endpoints
 @api_router.get("/coupons/validate/{code}")
 async def validate_coupon(code: str):
-    coupon = await db.coupons.find_one({"code": code.upper(), "is_active": True})
+    coupon = await get_active_coupon(code.upper())
     if not coupon:
         raise HTTPException(status_code=404, detail="Cupão não encontrado")
     
-    coupon = CouponCode(**coupon)
     now = datetime.utcnow()
     
     if now < coupon.valid_from or now > coupon.valid_until:
@@ -1709,95 +3967,55 @@ async def apply_coupon_to_cart(session_id: str, coupon_code: str):
     coupon = await validate_coupon(coupon_code)
     
     # Update cart with coupon
-    await db.carts.update_one(
-        {"session_id": session_id},
-        {"$set": {"coupon_code": coupon_code.upper(), "updated_at": datetime.utcnow()}}
-    )
-    
-    cart = await db.carts.find_one({"session_id": session_id})
-    if not cart:
-        # Create a new cart if it doesn't exist
-        new_cart = Cart(session_id=session_id, coupon_code=coupon_code.upper())
-        await db.carts.insert_one(new_cart.dict())
-        return new_cart
-    
-    # Convert ObjectId to string
-    if "_id" in cart:
-        cart["_id"] = str(cart["_id"])
-    
+    cart = await update_cart(session_id, {"$set": {"coupon_code": coupon_code.upper()}})
     return Cart(**cart)
 
 @api_router.delete("/cart/{session_id}/remove-coupon")
 async def remove_coupon_from_cart(session_id: str):
-    await db.carts.update_one(
-        {"session_id": session_id},
-        {"$unset": {"coupon_code": ""}, "$set": {"updated_at": datetime.utcnow()}}
-    )
-    
-    cart = await db.carts.find_one({"session_id": session_id})
-    if not cart:
-        # Create a new cart if it doesn't exist
-        new_cart = Cart(session_id=session_id)
-        await db.carts.insert_one(new_cart.dict())
-        return new_cart
-    
-    # Convert ObjectId to string
-    if "_id" in cart:
-        cart["_id"] = str(cart["_id"])
-    
+    cart = await update_cart(session_id, {"$unset": {"coupon_code": ""}})
     return Cart(**cart)
 
 # Cart endpoints
 @api_router.get("/cart/{session_id}")
-async def get_cart(session_id: str):
-    cart = await db.carts.find_one({"session_id": session_id})
-    if not cart:
-        new_cart = Cart(session_id=session_id)
-        await db.carts.insert_one(new_cart.dict())
-        return new_cart
-    # Convert ObjectId to string
-    if "_id" in cart:
-        cart["_id"] = str(cart["_id"])
-    return Cart(**cart)
-
-@api_router.post("/cart/{session_id}/add")
-async def add_to_cart(session_id: str, item: CartItem):
+async def get_cart(session_id: str, shipping_method: str = "standard", product_loader: ProductLoader = Depends(get_catalog_product_loader)):
+    """Cart with its pricing (line totals, discounts, VAT, shipping and total)"""
     cart = await db.carts.find_one({"session_id": session_id})
     if not cart:
         cart = Cart(session_id=session_id)
+        await db.carts.insert_one(cart.dict())
     else:
         cart = Cart(**cart)
+    pricing = await price_cart(cart.items, cart.coupon_code, shipping_method, product_loader)
+    return {**cart.dict(), "pricing": pricing}
 
-    # Check if item already exists
-    existing_item = None
-    for i, cart_item in enumerate(cart.items):
-        if (cart_item.product_id == item.product_id and
-            cart_item.subscription_type == item.subscription_type):
-            existing_item = i
-            break
-
-    if existing_item is not None:
-        cart.items[existing_item].quantity += item.quantity
-    else:
-        cart.items.append(item)
+@api_router.post("/cart/{session_id}/add")
+async def add_to_cart(session_id: str, item: CartItem):
+    line = {"product_id": item.product_id, "subscription_type": item.subscription_type}
+    for _ in range(3):
+        # Already in the cart: bump its quantity in place
+        cart = await update_cart(
+            session_id, {"$inc": {"items.$.quantity": item.quantity}}, {"items": {"$elemMatch": line}}, upsert=False
+        )
+        if cart:
+            return Cart(**cart)
 
-    cart.updated_at = datetime.utcnow()
-    await db.carts.replace_one({"session_id": session_id}, cart.dict(), upsert=True)
-    return cart
+        # Otherwise append it (creating the cart if needed). If another request added the
+        # same line in between, the upsert collides on the unique session_id: go back to $inc
+        try:
+            cart = await update_cart(session_id, {"$push": {"items": item.dict()}}, {"items": {"$not": {"$elemMatch": line}}})
+            return Cart(**cart)
+        except DuplicateKeyError:
+            continue
+    raise HTTPException(status_code=409, detail="O carrinho está a ser atualizado, tente novamente")
 
 @api_router.delete("/cart/{session_id}/remove/{product_id}")
 async def remove_from_cart(session_id: str, product_id: str, subscription_type: Optional[str] = None):
-    cart = await db.carts.find_one({"session_id": session_id})
+    cart = await update_cart(
+        session_id, {"$pull": {"items": {"product_id": product_id, "subscription_type": subscription_type}}}, upsert=False
+    )
     if not cart:
         raise HTTPException(status_code=404, detail="Carrinho não encontrado")
-
-    cart = Cart(**cart)
-    cart.items = [item for item in cart.items
-                 if not (item.product_id == product_id and item.subscription_type == subscription_type)]
-
-    cart.updated_at = datetime.utcnow()
-    await db.carts.replace_one({"session_id": session_id}, cart.dict())
-    return cart
+    return Cart(**cart)
 
 # Shipping methods
 @api_router.get("/shipping-methods")
@@ -1810,7 +4028,7 @@ async def get_shipping_methods():
 
 # Checkout and payment
 @api_router.post("/checkout")
-async def create_checkout(checkout_data: CheckoutRequest, current_user: User = Depends(get_current_user)):
+async def create_checkout(checkout_data: CheckoutRequest, current_user: User = Depends(get_current_user), product_loader: ProductLoader = Depends(get_product_loader)):
     cart = await db.carts.find_one({"session_id": checkout_data.cart_id})
     if not cart or not cart.get("items"):
         raise HTTPException(status_code=400, detail="Carrinho vazio")
@@ -1821,71 +4039,21 @@ async def create_checkout(checkout_data: CheckoutRequest, current_user: User = D
     if checkout_data.nif and not validate_nif(checkout_data.nif):
         raise HTTPException(status_code=400, detail="NIF inválido. Deve ter 9 dígitos válidos, com ou sem prefixo 'PT'.")
 
-    # Calculate subtotal
-    subtotal = 0.0
-    products = []
-    for item in cart.items:
-        product = await db.products.find_one({"id": item.product_id})
-        if not product:
-            continue
-        products.append(product)
-
-        # Handle subscription prices if they exist
-        price = product.get("price", 0.0)
-        if item.subscription_type and "subscription_prices" in product:
-            price = product["subscription_prices"].get(item.subscription_type, price)
-
-        subtotal += price * item.quantity
-
-    # Apply coupon discount
-    discount_amount = 0.0
-    if cart.coupon_code:
-        try:
-            coupon = await validate_coupon(cart.coupon_code)
-            
-            # Check if coupon applies to cart items
-            applies = False
-            if not coupon.applicable_categories and not coupon.applicable_products:
-                applies = True  # Applies to all
-            else:
-                for item in cart.items:
-                    product = next((p for p in products if p["id"] == item.product_id), None)
-                    if product:
-                        if (product["category"] in coupon.applicable_categories or
-                            product["id"] in coupon.applicable_products):
-                            applies = True
-                            break
-            
-            if applies and (not coupon.min_order_value or subtotal >= coupon.min_order_value):
-                if coupon.discount_type == "percentage":
-                    discount_amount = subtotal * (coupon.discount_value / 100)
-                else:
-                    discount_amount = min(coupon.discount_value, subtotal)
-        except:
-            pass  # Invalid coupon, ignore discount
-
-    # Calculate shipping
-    shipping_methods = await get_shipping_methods()
-    shipping_method = next((sm for sm in shipping_methods if sm["id"] == checkout_data.shipping_method), shipping_methods[0])
-    shipping_cost = shipping_method["price"]
-
-    # Apply free shipping if applicable
-    if shipping_method.get("min_order") and (subtotal - discount_amount) >= shipping_method["min_order"]:
-        shipping_cost = 0.0
-
-    # Add VAT (23%)
-    vat_amount = (subtotal - discount_amount) * 0.23
-    total_amount = subtotal - discount_amount + vat_amount + shipping_cost
+    # Same engine as the cart view, but with prices read straight from the products collection
+    pricing = await price_cart(cart.items, cart.coupon_code, checkout_data.shipping_method, product_loader)
+    if pricing["coupon_error"]:
+        raise HTTPException(status_code=400, detail=pricing["coupon_error"])
+    total_amount = pricing["total_amount"]
 
     # Create order
     order = Order(
         user_id=current_user.id,  # Set user_id from authenticated user
         session_id=cart.session_id,
         items=cart.items,
-        subtotal=subtotal,
-        discount_amount=discount_amount,
-        vat_amount=vat_amount,
-        shipping_cost=shipping_cost,
+        subtotal=pricing["subtotal"],
+        discount_amount=pricing["discount_amount"],
+        vat_amount=pricing["vat_amount"],
+        shipping_cost=pricing["shipping_cost"],
         total_amount=total_amount,
         coupon_code=cart.coupon_code,
         shipping_address=checkout_data.shipping_address,
@@ -1899,6 +4067,10 @@ async def create_checkout(checkout_data: CheckoutRequest, current_user: User = D
     if checkout_data.payment_method != "stripe":
         raise HTTPException(status_code=400, detail="Apenas pagamento via Stripe é suportado")
     
+    # Claim a coupon use before charging the discounted total (given back if the checkout fails)
+    if cart.coupon_code and not await redeem_coupon(cart.coupon_code):
+        raise HTTPException(status_code=400, detail="Cupão esgotado")
+    
     # Create Stripe checkout session
     success_url = f"{checkout_data.origin_url}/success?session_id={{CHECKOUT_SESSION_ID}}"
     cancel_url = f"{checkout_data.origin_url}/cart"
@@ -1916,28 +4088,36 @@ async def create_checkout(checkout_data: CheckoutRequest, current_user: User = D
         }
     )
 
-    session = await stripe_checkout.create_checkout_session(checkout_request)
-    order.stripe_session_id = session.session_id
-
-    # Create payment transaction
-    payment_transaction = PaymentTransaction(
-        session_id=session.session_id,
-        payment_id=order.id,
-        amount=total_amount,
-        currency="eur",
-        metadata={"order_id": order.id, "user_id": current_user.id},
-        order_id=order.id
-    )
-    await db.payment_transactions.insert_one(payment_transaction.dict())
-
-    await db.orders.insert_one(order.dict())
-    
-    # Update coupon usage if applicable
-    if cart.coupon_code:
-        await db.coupons.update_one(
-            {"code": cart.coupon_code},
-            {"$inc": {"current_uses": 1}}
+    # Until the order is recorded, a failure gives the coupon use back. Once the order exists
+    # it is closed like an expired checkout, so a later expiry event cannot release it again.
+    order_inserted = False
+    try:
+        session = await stripe_checkout.create_checkout_session(checkout_request, idempotency_key=f"checkout_{order.id}")
+        order.stripe_session_id = session.session_id
+
+        # Create payment transaction
+        payment_transaction = PaymentTransaction(
+            session_id=session.session_id,
+            payment_id=order.id,
+            amount=total_amount,
+            currency="eur",
+            metadata={"order_id": order.id, "user_id": current_user.id},
+            order_id=order.id
         )
+        await db.payment_transactions.insert_one(payment_transaction.dict())
+
+        # Created (and counted) now, not when the order object was built before the Stripe call,
+        # so a dashboard stats rebuild cutoff sees the order and its $inc on the same side
+        order.created_at = datetime.utcnow()
+        await db.orders.insert_one(order.dict())
+        order_inserted = True
+        await record_order_created(order.dict())
+    except Exception:
+        if order_inserted:
+            await close_unpaid_checkout(order.stripe_session_id, order.id, "failed")
+        elif cart.coupon_code:
+            await release_coupon(cart.coupon_code)
+        raise
     
     # Clear the cart after successful order creation
     await db.carts.update_one(
@@ -1947,50 +4127,288 @@ async def create_checkout(checkout_data: CheckoutRequest, current_user: User = D
     
     return {"checkout_url": session.url, "order_id": order.id}
 
-@api_router.get("/payments/checkout/status/{session_id}")
-async def get_payment_status(session_id: str):
-    status = await stripe_checkout.get_checkout_status(session_id)
+# Stripe webhooks - Stripe's events are the source of truth for payments. The webhook
+# endpoint only verifies the signature and stores the event in stripe_events (the event id is
+# a unique key, so Stripe's redeliveries are no-ops) before answering 200. Background workers
+# on every process claim stored events atomically and apply them: mark the order paid, clear
+# the cart and queue the confirmation email, or release the coupon of an expired checkout.
+# Failed events are retried with backoff. The status endpoint polled by the success page then
+# reads the local payment transaction instead of calling Stripe.
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
+STRIPE_WEBHOOK_TOLERANCE_SECONDS = 300
+STRIPE_EVENT_WORKERS = int(os.environ.get('STRIPE_EVENT_WORKERS', '2'))
+STRIPE_EVENT_MAX_ATTEMPTS = 8
+STRIPE_EVENT_RETRY_BASE_SECONDS = 5
+STRIPE_EVENT_RETRY_MAX_SECONDS = 600
+STRIPE_EVENT_LEASE_SECONDS = 60  # A claimed event is retried if its worker dies mid-processing
+STRIPE_EVENT_POLL_SECONDS = 5
+# Pending payments older than this are checked with Stripe by the status endpoint (at most
+# once per interval), in case a webhook is late or not configured
+STRIPE_STATUS_RECONCILE_SECONDS = int(os.environ.get('STRIPE_STATUS_RECONCILE_SECONDS', '60'))
+
+async def confirm_order_payment(session_id: str, order_id: Optional[str]) -> bool:
+    """Record a paid checkout session; only the first confirmation flips the order"""
+    await db.payment_transactions.update_one({"session_id": session_id}, {"$set": {"payment_status": "paid"}})
+    if not order_id:
+        return False
+
+    # Revenue is counted exactly once, by the confirmation that flips the order
+    paid_at = datetime.utcnow()
+    order = await db.orders.find_one_and_update(
+        {"id": order_id, "payment_status": {"$ne": "paid"}},
+        [{"$set": {"payment_status": "paid", "order_status": "confirmed", "previous_order_status": "$order_status",
+                   "paid_at": paid_at, "status_changed_at": paid_at, "updated_at": paid_at}}]
+    )
+    flipped = order is not None
+    if flipped:
+        await record_order_paid(order.get("total_amount", 0), paid_at, order.get("order_status") or "pending", "confirmed")
+        order["payment_status"] = "paid"
+        order["order_status"] = "confirmed"
+    else:
+        # Already paid: a retried confirmation finishes the cart reset and email if they never
+        # completed (both are safe to repeat), and does nothing once they have
+        order = await db.orders.find_one({"id": order_id, "payment_status": "paid", "payment_followup_done": {"$ne": True}})
+        if not order:
+            return False
+    
+    # Clear the cart after successful payment
+    if order.get("session_id"):
+        await db.carts.update_one(
+            {"session_id": order["session_id"]},
+            {"$set": {"items": [], "coupon_code": None, "updated_at": datetime.utcnow()}}
+        )
+    
+    # Queue the order confirmation email
+    user = await db.users.find_one({"id": order.get("user_id")})
+    if user:
+        order_products = await ProductLoader().load_many(item["product_id"] for item in order["items"])
+        email_result = await send_order_confirmation_email(
+            user["email"], Order(**order), list(order_products.values()), customer_name=user.get("name"),
+            queue=True, idempotency_key=f"order_confirmation_{order['id']}"
+        )
+        logging.info(f"Order confirmation email queued for {user['email']}: {email_result}")
+    else:
+        logging.error(f"User not found for order {order.get('id')} with user_id {order.get('user_id')}")
 
-    payment_transaction = await db.payment_transactions.find_one({"session_id": session_id})
-    if payment_transaction:
-        await db.payment_transactions.update_one(
-            {"session_id": session_id},
-            {"$set": {"payment_status": status.payment_status}}
+    await db.orders.update_one({"id": order_id}, {"$set": {"payment_followup_done": True}})
+    return flipped
+
+async def close_unpaid_checkout(session_id: str, order_id: Optional[str], payment_status: str):
+    """Expired or failed checkout: record it and give back the order's coupon use"""
+    await db.payment_transactions.update_one(
+        {"session_id": session_id, "payment_status": {"$ne": "paid"}},
+        {"$set": {"payment_status": payment_status}}
+    )
+    if not order_id:
+        return
+    order = await db.orders.find_one_and_update(
+        {"id": order_id, "payment_status": "pending"},
+        {"$set": {"payment_status": payment_status, "updated_at": datetime.utcnow()}}
+    )
+    if order and order.get("coupon_code"):
+        await release_coupon(order["coupon_code"])
+
+class StripeEventProcessor:
+    def __init__(self, workers: int = STRIPE_EVENT_WORKERS, max_attempts: int = STRIPE_EVENT_MAX_ATTEMPTS,
+                 retry_base_seconds: float = STRIPE_EVENT_RETRY_BASE_SECONDS):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.wakeup = asyncio.Event()
+        self.running: List[asyncio.Task] = []
+        self.received = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.retried = 0
+        self.dead = 0
+        self.indexed = False
+
+    async def ensure_indexes(self) -> bool:
+        """Create the stripe_events indexes; duplicate deliveries are only detected with the unique id index"""
+        try:
+            await db.stripe_events.create_index([("id", 1)], unique=True)
+            await db.stripe_events.create_index([("status", 1), ("next_attempt_at", 1)])
+            self.indexed = True
+        except Exception as e:
+            logging.critical(f"Cannot create the unique stripe_events.id index, Stripe webhooks will be refused: {e}")
+        return self.indexed
+
+    async def ingest(self, event: dict) -> bool:
+        """Store a verified event for the workers; False when it was already stored"""
+        # Without the unique index a redelivered event would be stored and applied twice
+        if not self.indexed and not await self.ensure_indexes():
+            raise HTTPException(status_code=503, detail="Webhook temporariamente indisponível")
+        now = datetime.utcnow()
+        try:
+            await db.stripe_events.insert_one({
+                "id": event["id"],
+                "type": event["type"],
+                "object": event["data"]["object"],
+                "livemode": event.get("livemode", False),
+                "created": datetime.utcfromtimestamp(event.get("created", now.timestamp())),
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "received_at": now
+            })
+        except DuplicateKeyError:
+            self.duplicates += 1
+            return False
+        self.received += 1
+        self.wakeup.set()
+        return True
+
+    async def claim(self) -> Optional[dict]:
+        """Atomically take the next due event (or one whose worker died mid-processing)"""
+        now = datetime.utcnow()
+        return await db.stripe_events.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "processing", "locked_until": {"$lt": now}}
+            ]},
+            {"$set": {"status": "processing", "locked_until": now + timedelta(seconds=STRIPE_EVENT_LEASE_SECONDS)},
+             "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
         )
 
-        if status.payment_status == "paid" and payment_transaction.get("order_id"):
-            order = await db.orders.find_one({"id": payment_transaction["order_id"]})
-            if order:
-                await db.orders.update_one(
-                    {"id": payment_transaction["order_id"]},
-                    {"$set": {"payment_status": "paid", "order_status": "confirmed", "updated_at": datetime.utcnow()}}
+    async def apply(self, event: dict):
+        session = event["object"]
+        metadata = session.get("metadata") or {}
+        if event["type"] in ("checkout.session.completed", "checkout.session.async_payment_succeeded"):
+            if session.get("payment_status") == "paid":
+                await confirm_order_payment(session["id"], metadata.get("order_id"))
+            else:
+                # Delayed methods (Multibanco) complete unpaid and confirm later
+                await db.payment_transactions.update_one(
+                    {"session_id": session["id"], "payment_status": {"$ne": "paid"}},
+                    {"$set": {"payment_status": session.get("payment_status") or "unpaid"}}
                 )
-                
-                # Clear the cart after successful payment
-                if order.get("session_id"):
-                    await db.carts.update_one(
-                        {"session_id": order["session_id"]},
-                        {"$set": {"items": [], "coupon_code": None, "updated_at": datetime.utcnow()}}
-                    )
-                
-                # Send order confirmation email
-                user = await db.users.find_one({"id": order.get("user_id")})
-                if user:
-                    products = []
-                    for item in order["items"]:
-                        product = await db.products.find_one({"id": item["product_id"]})
-                        if product:
-                            products.append(product)
-                    
-                    try:
-                        email_result = await send_order_confirmation_email(user["email"], Order(**order), products)
-                        logging.info(f"Order confirmation email sent to {user['email']}: {email_result}")
-                    except Exception as e:
-                        logging.error(f"Failed to send order confirmation email to {user['email']}: {e}")
-                else:
-                    logging.error(f"User not found for order {order.get('id')} with user_id {order.get('user_id')}")
+        elif event["type"] == "checkout.session.async_payment_failed":
+            await close_unpaid_checkout(session["id"], metadata.get("order_id"), "failed")
+        elif event["type"] == "checkout.session.expired":
+            await close_unpaid_checkout(session["id"], metadata.get("order_id"), "expired")
+        elif event["type"].startswith("customer.subscription.") or event["type"].startswith("invoice.payment_"):
+            logging.info(f"Stripe {event['type']}: {session.get('subscription') or session.get('id')}")
+
+    def retry_delay(self, attempts: int) -> float:
+        return min(self.retry_base_seconds * (2 ** (attempts - 1)), STRIPE_EVENT_RETRY_MAX_SECONDS)
+
+    async def process(self, event: dict):
+        try:
+            await self.apply(event)
+        except Exception as e:
+            if event["attempts"] >= self.max_attempts:
+                self.dead += 1
+                logging.error(f"Stripe event {event['id']} ({event['type']}) moved to dead letter after {event['attempts']} attempts: {e}")
+                update = {"status": "dead", "last_error": str(e), "failed_at": datetime.utcnow()}
+            else:
+                self.retried += 1
+                delay = self.retry_delay(event["attempts"])
+                logging.warning(f"Stripe event {event['id']} ({event['type']}) failed (attempt {event['attempts']}), retry in {delay:.0f}s: {e}")
+                update = {"status": "pending", "last_error": str(e), "next_attempt_at": datetime.utcnow() + timedelta(seconds=delay)}
+            await db.stripe_events.update_one({"id": event["id"]}, {"$set": update, "$unset": {"locked_until": ""}})
+            return
+
+        self.processed += 1
+        await db.stripe_events.update_one(
+            {"id": event["id"]},
+            {"$set": {"status": "processed", "processed_at": datetime.utcnow()}, "$unset": {"locked_until": ""}}
+        )
+
+    async def drain(self) -> int:
+        """Apply every event that is due now; returns how many were attempted"""
+        attempted = 0
+        while True:
+            event = await self.claim()
+            if event is None:
+                return attempted
+            await self.process(event)
+            attempted += 1
+
+    async def _worker(self):
+        while True:
+            try:
+                await self.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Stripe event worker error: {e}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=STRIPE_EVENT_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self.running = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.running:
+            task.cancel()
+        self.running = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "webhook_secret": bool(STRIPE_WEBHOOK_SECRET),
+            "indexed": self.indexed,
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "processed": self.processed,
+            "retried": self.retried,
+            "dead": self.dead
+        }
+
+stripe_event_processor = StripeEventProcessor()
+
+@api_router.post("/payments/webhook")
+@api_router.post("/subscriptions/webhook")
+async def stripe_webhook(request: Request):
+    """Verify and store a Stripe event; it is applied in the background"""
+    if not STRIPE_WEBHOOK_SECRET:
+        logging.error("Stripe webhook received but STRIPE_WEBHOOK_SECRET is not configured")
+        raise HTTPException(status_code=503, detail="Webhook não configurado")
+
+    payload = (await request.body()).decode("utf-8", errors="replace")
+    try:
+        stripe.WebhookSignature.verify_header(payload, request.headers.get("stripe-signature", ""),
+                                              STRIPE_WEBHOOK_SECRET, STRIPE_WEBHOOK_TOLERANCE_SECONDS)
+        event = json.loads(payload)
+    except (stripe.error.SignatureVerificationError, ValueError) as e:
+        logging.warning(f"Rejected Stripe webhook: {e}")
+        raise HTTPException(status_code=400, detail="Assinatura inválida")
+
+    stored = await stripe_event_processor.ingest(event)
+    return {"received": True, "duplicate": not stored}
+
+@api_router.get("/payments/checkout/status/{session_id}")
+async def get_payment_status(session_id: str):
+    """Payment status from the local transaction, kept current by the webhook events"""
+    payment_transaction = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
+    if not payment_transaction:
+        return await stripe_checkout.get_checkout_status(session_id)
 
-    return status
+    # Late or missing webhook: ask Stripe, at most once per interval for each transaction
+    now = datetime.utcnow()
+    check_before = now - timedelta(seconds=STRIPE_STATUS_RECONCILE_SECONDS)
+    if payment_transaction["payment_status"] == "pending" and payment_transaction["created_at"] <= check_before:
+        claimed = await db.payment_transactions.find_one_and_update(
+            {"session_id": session_id, "payment_status": "pending",
+             "$or": [{"checked_at": None}, {"checked_at": {"$lte": check_before}}]},
+            {"$set": {"checked_at": now}}
+        )
+        if claimed:
+            status = await stripe_checkout.get_checkout_status(session_id)
+            if status.payment_status == "paid":
+                await confirm_order_payment(session_id, payment_transaction.get("order_id"))
+            return status
+
+    return CheckoutStatusResponse(
+        payment_status=payment_transaction["payment_status"],
+        amount_total=payment_transaction.get("amount"),
+        metadata=payment_transaction.get("metadata") or {}
+    )
 
 @api_router.post("/test-email")
 async def test_email_system(email: str = "edupodeptptpt@gmail.com"):
@@ -2071,59 +4489,16 @@ async def list_customer_subscriptions(customer_id: str):
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@api_router.post("/subscriptions/webhook")
-async def handle_subscription_webhook(request: Request):
-    """Handle Stripe subscription webhooks"""
-    try:
-        payload = await request.body()
-        sig_header = request.headers.get('stripe-signature')
-        
-        # In production, you should verify the webhook signature
-        # event = stripe.Webhook.construct_event(payload, sig_header, webhook_secret)
-        
-        # For now, just parse the payload directly
-        event = json.loads(payload)
-        
-        if event['type'] == 'customer.subscription.created':
-            subscription = event['data']['object']
-            # Handle subscription created
-            print(f"Subscription created: {subscription['id']}")
-            
-        elif event['type'] == 'customer.subscription.updated':
-            subscription = event['data']['object']
-            # Handle subscription updated
-            print(f"Subscription updated: {subscription['id']}")
-            
-        elif event['type'] == 'customer.subscription.deleted':
-            subscription = event['data']['object']
-            # Handle subscription cancelled
-            print(f"Subscription cancelled: {subscription['id']}")
-            
-        elif event['type'] == 'invoice.payment_succeeded':
-            invoice = event['data']['object']
-            # Handle successful payment
-            print(f"Payment succeeded for subscription: {invoice['subscription']}")
-            
-        elif event['type'] == 'invoice.payment_failed':
-            invoice = event['data']['object']
-            # Handle failed payment
-            print(f"Payment failed for subscription: {invoice['subscription']}")
-        
-        return {"status": "success"}
-    except Exception as e:
-        print(f"Webhook error: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
-
 # Admin endpoints
 @api_router.get("/admin/dashboard")
 async def admin_dashboard(admin_user: User = Depends(get_admin_user)):
-    total_orders = await db.orders.count_documents({})
-    total_users = await db.users.count_documents({})
+    # Order counts and revenue come from the materialized stats document
+    stats = await get_dashboard_stats()
+    total_users = await db.users.estimated_document_count()
     total_products = await db.products.count_documents({"is_active": True})
 
-    # Calculate total revenue (only paid orders)
-    paid_orders = await db.orders.find({"payment_status": "paid"}).to_list(1000)
-    total_revenue = sum(order.get("total_amount", 0) for order in paid_orders)
+    revenue_daily = await db.revenue_daily.find().sort("_id", -1).limit(30).to_list(30)
+    revenue_monthly = await db.revenue_monthly.find().sort("_id", -1).limit(12).to_list(12)
 
     # Get recent orders
     recent_orders = await db.orders.find().sort("created_at", -1).limit(10).to_list(10)
@@ -2134,73 +4509,154 @@ async def admin_dashboard(admin_user: User = Depends(get_admin_user)):
 
     return {
         "stats": {
-            "total_orders": total_orders,
+            "total_orders": stats.get("total_orders", 0),
             "total_users": total_users,
             "total_products": total_products,
-            "total_revenue": total_revenue
+            "total_revenue": round(stats.get("total_revenue", 0), 2),
+            "paid_orders": stats.get("paid_orders", 0),
+            "orders_by_status": {status: count for status, count in stats.get("orders_by_status", {}).items() if count}
         },
+        "revenue_daily": [{"date": row["_id"], "revenue": round(row["revenue"], 2), "orders": row["orders"]} for row in revenue_daily],
+        "revenue_monthly": [{"month": row["_id"], "revenue": round(row["revenue"], 2), "orders": row["orders"]} for row in revenue_monthly],
         "recent_orders": recent_orders
     }
 
+@api_router.post("/admin/dashboard/rebuild-stats")
+async def admin_rebuild_stats(admin_user: User = Depends(get_admin_user)):
+    """Recompute the dashboard counters from the orders collection"""
+    stats = await rebuild_dashboard_stats()
+    if stats is None:
+        raise HTTPException(status_code=409, detail="As estatísticas já estão a ser recalculadas")
+    return {"message": "Estatísticas recalculadas", "total_orders": stats["total_orders"], "total_revenue": round(stats["total_revenue"], 2)}
+
+@api_router.get("/admin/metrics")
+async def admin_metrics(admin_user: User = Depends(get_admin_user)):
+    """Runtime performance counters for the worker serving the request"""
+    return {
+        "cache": cache_backend.stats(),
+        "catalog_snapshot": catalog_snapshot.stats(),
+        "promotions": promotion_index.stats(),
+        "password_hashing": password_hasher.stats(),
+        "user_cache": user_cache.stats(),
+        "stripe": stripe_gateway.stats(),
+        "stripe_events": stripe_event_processor.stats(),
+        "chat_pubsub": chat_pubsub.stats(),
+        "scheduler": scheduler.stats(),
+        "email_outbox": email_outbox.stats(),
+        "email_campaigns": campaign_sender.stats(),
+        "google_tokens": google_token_verifier.stats()
+    }
+
+# Admin orders list - priority buckets are pushed into the query (one indexed query per
+# bucket on (order_status, created_at)); pages are continued with an opaque cursor token.
+ORDER_STATUSES = ["pending", "confirmed", "processing", "shipped", "delivered", "cancelled"]
+SHIPPED_ORDER_STATUSES = ["shipped"]
+CLOSED_ORDER_STATUSES = ["cancelled", "delivered"]  # Hidden unless requested
+ADMIN_ORDERS_PAGE_SIZE = 50
+ADMIN_ORDERS_MAX_PAGE_SIZE = 200
+
+def order_priority_buckets(statuses: Optional[List[str]], include_closed: bool, by_priority: bool) -> List[Optional[dict]]:
+    """order_status conditions, highest priority first: open orders, shipped, closed (None = any status)"""
+    if not by_priority:
+        if statuses is not None:
+            return [{"$in": statuses}]
+        return [None] if include_closed else [{"$nin": CLOSED_ORDER_STATUSES}]
+
+    if statuses is None:
+        buckets = [{"$nin": SHIPPED_ORDER_STATUSES + CLOSED_ORDER_STATUSES}, {"$in": SHIPPED_ORDER_STATUSES}]
+        if include_closed:
+            buckets.append({"$in": CLOSED_ORDER_STATUSES})
+        return buckets
+
+    groups = [
+        [value for value in statuses if value not in SHIPPED_ORDER_STATUSES + CLOSED_ORDER_STATUSES],
+        [value for value in statuses if value in SHIPPED_ORDER_STATUSES],
+        [value for value in statuses if value in CLOSED_ORDER_STATUSES]
+    ]
+    return [{"$in": group} for group in groups if group]
+
+def encode_orders_cursor(bucket: int, created_at: datetime, order_id: str) -> str:
+    token = json.dumps({"b": bucket, "t": created_at.isoformat(), "i": order_id})
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+def decode_orders_cursor(cursor: str) -> tuple:
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(token["b"]), (datetime.fromisoformat(token["t"]), str(token["i"]))
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
 @api_router.get("/admin/orders")
-async def get_all_orders(admin_user: User = Depends(get_admin_user)):
-    orders = await db.orders.find().sort("created_at", -1).to_list(1000)
-    
-    # Convert ObjectId to string
-    for order in orders:
+async def get_all_orders(
+    response: Response,
+    status: Optional[str] = None,
+    include_closed: bool = False,
+    sort: str = "priority",
+    cursor: Optional[str] = None,
+    limit: int = Query(ADMIN_ORDERS_PAGE_SIZE, ge=1, le=ADMIN_ORDERS_MAX_PAGE_SIZE),
+    admin_user: User = Depends(get_admin_user)
+):
+    """Orders page, newest first within each priority bucket; the next page's token is in X-Next-Cursor"""
+    if sort not in ("priority", "recent"):
+        raise HTTPException(status_code=400, detail="Ordenação inválida")
+    statuses = [value.strip() for value in status.split(",") if value.strip()] if status else None
+    if statuses and any(value not in ORDER_STATUSES for value in statuses):
+        raise HTTPException(status_code=400, detail="Status inválido")
+
+    buckets = order_priority_buckets(statuses, include_closed, sort == "priority")
+    start_bucket, position = decode_orders_cursor(cursor) if cursor else (0, None)
+
+    # Fill the page bucket by bucket; one extra document tells whether there is a next page
+    page = []
+    for bucket in range(start_bucket, len(buckets)):
+        query = {"order_status": buckets[bucket]} if buckets[bucket] is not None else {}
+        if bucket == start_bucket and position:
+            created_at, order_id = position
+            query["$or"] = [
+                {"created_at": {"$lt": created_at}},
+                {"created_at": created_at, "id": {"$lt": order_id}}
+            ]
+        remaining = limit + 1 - len(page)
+        orders = await db.orders.find(query).sort([("created_at", -1), ("id", -1)]).limit(remaining).to_list(remaining)
+        page.extend((bucket, order) for order in orders)
+        if len(page) > limit:
+            break
+
+    if len(page) > limit:
+        page = page[:limit]
+        last_bucket, last_order = page[-1]
+        response.headers["X-Next-Cursor"] = encode_orders_cursor(last_bucket, last_order["created_at"], last_order["id"])
+
+    result = []
+    for _, order in page:
         if "_id" in order:
             order["_id"] = str(order["_id"])
-    
-    # Separate orders by status and priority
-    # Top priority: processing, pending, confirmed
-    # Bottom priority: shipped
-    # Hidden: cancelled, delivered
-    
-    top_priority_orders = []
-    bottom_priority_orders = []
-    
-    for order in orders:
-        status = order.get("order_status", "pending")
-        
-        # Skip cancelled and delivered orders (hide them)
-        if status in ["cancelled", "delivered"]:
-            continue
-        
-        # Top priority orders (new and processing)
-        if status in ["pending", "processing", "confirmed"]:
-            top_priority_orders.append(order)
-        # Bottom priority orders (shipped)
-        elif status == "shipped":
-            bottom_priority_orders.append(order)
-        else:
-            # Any other status goes to top by default
-            top_priority_orders.append(order)
-    
-    # Combine: top priority first, then bottom priority
-    organized_orders = top_priority_orders + bottom_priority_orders
-    
-    return organized_orders
+        result.append(order)
+    return result
 
 @api_router.put("/admin/orders/{order_id}/status")
 async def update_order_status(order_id: str, status: str, admin_user: User = Depends(get_admin_user)):
     # Validate status
-    valid_statuses = ["pending", "confirmed", "processing", "shipped", "delivered", "cancelled"]
-    if status not in valid_statuses:
+    if status not in ORDER_STATUSES:
         raise HTTPException(status_code=400, detail="Status inválido")
     
-    # Update order status
-    result = await db.orders.update_one(
+    # Update order status (the previous one is kept for dashboard stats rebuilds)
+    now = datetime.utcnow()
+    previous = await db.orders.find_one_and_update(
         {"id": order_id},
-        {"$set": {"order_status": status, "updated_at": datetime.utcnow()}}
+        [{"$set": {"order_status": {"$literal": status}, "previous_order_status": "$order_status",
+                   "status_changed_at": now, "updated_at": now}}],
+        projection={"order_status": 1}
     )
     
-    if result.matched_count == 0:
+    if previous is None:
         raise HTTPException(status_code=404, detail="Pedido não encontrado")
+    await record_order_status_change(previous.get("order_status") or "pending", status)
     
     return {"message": "Status atualizado com sucesso", "status": status}
 
 @api_router.get("/admin/orders/{order_id}")
-async def get_order_details(order_id: str, admin_user: User = Depends(get_admin_user)):
+async def get_order_details(order_id: str, admin_user: User = Depends(get_admin_user), product_loader: ProductLoader = Depends(get_product_loader)):
     """Get detailed order information including products"""
     # Get order
     order = await db.orders.find_one({"id": order_id})
@@ -2213,15 +4669,13 @@ async def get_order_details(order_id: str, admin_user: User = Depends(get_admin_
     
     # Get product details for each item
     detailed_items = []
+    products = await product_loader.load_many(item["product_id"] for item in order.get("items", []))
     for item in order.get("items", []):
-        product = await db.products.find_one({"id": item.product_id})
+        product = products.get(item["product_id"])
         if product:
-            if "_id" in product:
-                product["_id"] = str(product["_id"])
-            
             detailed_item = {
-                "product_id": item.product_id,
-                "quantity": item.quantity,
+                "product_id": item["product_id"],
+                "quantity": item["quantity"],
                 "subscription_type": item.get("subscription_type"),
                 "product": {
                     "id": product["id"],
@@ -2301,7 +4755,7 @@ async def make_user_admin(admin_data: AdminUser, admin_user: User = Depends(get_
             email=admin_data.email,
             name=admin_data.name,
             is_admin=True,
-            password_hash=hash_password("admin123")  # Default password
+            password_hash=await hash_password("admin123")  # Default password
         )
         await db.users.insert_one(new_admin.dict())
         return {"message": f"Novo admin criado: {admin_data.email} (senha: admin123)"}
@@ -2311,6 +4765,7 @@ async def make_user_admin(admin_data: AdminUser, admin_user: User = Depends(get_
             {"email": admin_data.email},
             {"$set": {"is_admin": True}}
         )
+        await invalidate_user_cache(admin_data.email)
         return {"message": f"Usuário {admin_data.email} agora é admin"}
 
 @api_router.delete("/admin/users/{user_id}/remove-admin")
@@ -2327,6 +4782,8 @@ async def remove_admin(user_id: str, admin_user: User = Depends(get_admin_user))
         {"id": user_id},
         {"$set": {"is_admin": False}}
     )
+    if user:
+        await invalidate_user_cache(user["email"])
     return {"message": "Admin removido"}
 
 # New admin user management endpoints
@@ -2346,7 +4803,7 @@ async def change_user_password(user_id: str, request: dict, admin_user: User = D
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
     
     # Update password
-    hashed_password = hash_password(new_password)
+    hashed_password = await hash_password(new_password)
     result = await db.users.update_one(
         {"id": user_id},
         {"$set": {"password_hash": hashed_password, "updated_at": datetime.utcnow()}}
@@ -2354,6 +4811,7 @@ async def change_user_password(user_id: str, request: dict, admin_user: User = D
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
+    await invalidate_user_cache(user["email"])
     
     return {"message": f"Senha do usuário alterada com sucesso"}
 
@@ -2381,6 +4839,7 @@ async def delete_user(user_id: str, admin_user: User = Depends(get_admin_user)):
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
+    await invalidate_user_cache(user["email"])
     
     return {"message": f"Usuário {user['name']} ({user['email']}) deletado com sucesso"}
 
@@ -2399,6 +4858,7 @@ async def bulk_make_admin(request: dict, admin_user: User = Depends(get_admin_us
         {"id": {"$in": user_ids}},
         {"$set": {"is_admin": True, "updated_at": datetime.utcnow()}}
     )
+    await invalidate_user_cache()
     
     return {"message": f"{result.modified_count} usuários promovidos a admin com sucesso"}
 
@@ -2433,6 +4893,7 @@ async def bulk_delete_users(request: dict, admin_user: User = Depends(get_admin_
     
     # Delete valid users
     result = await db.users.delete_many({"id": {"$in": valid_ids}})
+    await invalidate_user_cache()
     
     message = f"{result.deleted_count} usuários deletados com sucesso"
     if skipped_users:
@@ -2463,6 +4924,7 @@ async def create_coupon(coupon_data: CouponCreate, admin_user: User = Depends(ge
     
     coupon = CouponCode(**coupon_dict)
     await db.coupons.insert_one(coupon.dict())
+    await invalidate_cache_key(f"coupon_{coupon.code}")
     return coupon
 
 @api_router.put("/admin/coupons/{coupon_id}")
@@ -2471,6 +4933,7 @@ async def update_coupon(coupon_id: str, coupon_data: CouponCreate, admin_user: U
         {"id": coupon_id},
         {"$set": coupon_data.dict()}
     )
+    await invalidate_cache_pattern("coupon_")
     return {"message": "Cupão atualizado"}
 
 @api_router.delete("/admin/coupons/{coupon_id}")
@@ -2479,9 +4942,51 @@ async def delete_coupon(coupon_id: str, admin_user: User = Depends(get_admin_use
         {"id": coupon_id},
         {"$set": {"is_active": False}}
     )
+    await invalidate_cache_pattern("coupon_")
     return {"message": "Cupão desativado"}
 
+# Bulk coupon generation endpoints
+coupon_batch_tasks = set()
+
+@api_router.post("/admin/coupons/batches")
+async def create_coupon_batch_admin(batch_data: CouponBatchCreate, admin_user: User = Depends(get_admin_user)):
+    """Start generating a batch of unique coupons; poll the batch for progress"""
+    validate_coupon_batch(batch_data)
+    batch = await create_coupon_batch(batch_data, created_by=admin_user.id)
+    task = asyncio.create_task(run_coupon_batch(batch))
+    coupon_batch_tasks.add(task)
+    task.add_done_callback(coupon_batch_tasks.discard)
+    return {"message": f"A gerar {batch['quantity']} cupões", "batch": batch}
+
+@api_router.get("/admin/coupons/batches")
+async def list_coupon_batches(limit: int = Query(20, ge=1, le=100), admin_user: User = Depends(get_admin_user)):
+    return await db.coupon_batches.find({}, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+
+@api_router.get("/admin/coupons/batches/{batch_id}")
+async def get_coupon_batch(batch_id: str, admin_user: User = Depends(get_admin_user)):
+    batch = await db.coupon_batches.find_one({"id": batch_id}, {"_id": 0})
+    if not batch:
+        raise HTTPException(status_code=404, detail="Lote de cupões não encontrado")
+    batch["progress"] = round(batch["created"] / batch["quantity"] * 100, 1)
+    return batch
+
+@api_router.get("/admin/coupons/batches/{batch_id}/export")
+async def export_coupon_batch(batch_id: str, admin_user: User = Depends(get_admin_user)):
+    """The batch's codes as CSV, streamed while reading the cursor"""
+    batch = await db.coupon_batches.find_one({"id": batch_id}, {"_id": 0, "prefix": 1, "created_at": 1})
+    if not batch:
+        raise HTTPException(status_code=404, detail="Lote de cupões não encontrado")
+    filename = f"cupoes_{batch['prefix'].strip('-') or 'lote'}_{batch['created_at'].strftime('%Y%m%d')}_{batch_id[:8]}.csv"
+    return StreamingResponse(coupon_batch_csv(batch_id), media_type="text/csv",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
 # Promotion management endpoints
+async def reload_promotions():
+    """Apply a promotion write to this worker's sale prices now and to the others through the broadcast"""
+    promotion_index.invalidate()
+    await refresh_promotions()
+    await invalidate_cache_key("promotions")
+
 @api_router.get("/admin/promotions")
 async def get_all_promotions(admin_user: User = Depends(get_admin_user)):
     promotions = await db.promotions.find().sort("created_at", -1).to_list(1000)
@@ -2498,6 +5003,7 @@ async def create_promotion(promotion_data: PromotionCreate, admin_user: User = D
         created_by=admin_user.id
     )
     await db.promotions.insert_one(promotion.dict())
+    await reload_promotions()
     return promotion
 
 @api_router.put("/admin/promotions/{promotion_id}")
@@ -2506,6 +5012,7 @@ async def update_promotion(promotion_id: str, promotion_data: PromotionCreate, a
         {"id": promotion_id},
         {"$set": promotion_data.dict()}
     )
+    await reload_promotions()
     return {"message": "Promoção atualizada"}
 
 @api_router.delete("/admin/promotions/{promotion_id}")
@@ -2514,6 +5021,7 @@ async def delete_promotion(promotion_id: str, admin_user: User = Depends(get_adm
         {"id": promotion_id},
         {"$set": {"is_active": False}}
     )
+    await reload_promotions()
     return {"message": "Promoção desativada"}
 
 # Email management endpoints
@@ -2534,7 +5042,8 @@ async def send_discount_email_admin(
         coupon_code, 
         discount_value, 
         discount_type, 
-        expiry_date
+        expiry_date,
+        queue=True
     )
     return result
 
@@ -2551,10 +5060,101 @@ async def send_birthday_email_admin(
         user_email, 
         user_name, 
         coupon_code, 
-        discount_value
+        discount_value,
+        queue=True
     )
     return result
 
+@api_router.get("/admin/emails/outbox")
+async def get_email_outbox(status: str = "dead", limit: int = Query(50, ge=1, le=500), admin_user: User = Depends(get_admin_user)):
+    """Outbox messages by status (dead letters by default) plus per-status counts"""
+    counts = await db.email_outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list(None)
+    messages = await db.email_outbox.find(
+        {"status": status}, {"_id": 0, "html": 0, "text": 0}
+    ).sort("created_at", -1).limit(limit).to_list(limit)
+    return {"counts": {row["_id"]: row["count"] for row in counts}, "messages": messages}
+
+@api_router.post("/admin/emails/outbox/{message_id}/retry")
+async def retry_email(message_id: str, admin_user: User = Depends(get_admin_user)):
+    """Put a dead-lettered email back in the queue"""
+    result = await db.email_outbox.update_one(
+        {"id": message_id, "status": "dead"},
+        {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.utcnow()}, "$unset": {"expires_at": ""}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Email não encontrado na fila de falhas")
+    email_outbox.wakeup.set()
+    return {"message": "Email colocado novamente na fila"}
+
+# Email campaign endpoints
+@api_router.post("/admin/emails/campaigns")
+async def create_email_campaign(campaign_data: EmailCampaignCreate, admin_user: User = Depends(get_admin_user)):
+    """Queue a discount/birthday email for every user of a segment"""
+    if campaign_data.template not in CAMPAIGN_TEMPLATES:
+        raise HTTPException(status_code=400, detail=f"Modelo inválido. Use: {', '.join(CAMPAIGN_TEMPLATES)}")
+    if campaign_data.segment not in CAMPAIGN_SEGMENTS:
+        raise HTTPException(status_code=400, detail=f"Segmento inválido. Use: {', '.join(CAMPAIGN_SEGMENTS)}")
+    if campaign_data.discount_type not in ("percentage", "fixed"):
+        raise HTTPException(status_code=400, detail="Tipo de desconto inválido")
+
+    campaign = await campaign_sender.create_campaign(campaign_data, created_by=admin_user.id)
+    return {"message": f"Campanha criada para {campaign['total']} utilizadores", "campaign": campaign}
+
+@api_router.get("/admin/emails/campaigns")
+async def list_email_campaigns(limit: int = Query(20, ge=1, le=100), admin_user: User = Depends(get_admin_user)):
+    """Recent campaigns with their progress counters"""
+    return await db.email_campaigns.find({}, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+
+@api_router.get("/admin/emails/campaigns/{campaign_id}")
+async def get_email_campaign(campaign_id: str, admin_user: User = Depends(get_admin_user)):
+    """Campaign progress: recipients per status"""
+    campaign = await db.email_campaigns.find_one({"id": campaign_id}, {"_id": 0})
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campanha não encontrada")
+    counts = await db.email_campaign_recipients.aggregate([
+        {"$match": {"campaign_id": campaign_id}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    campaign["recipients"] = {row["_id"]: row["count"] for row in counts}
+    done = campaign["sent"] + campaign["failed"] + campaign.get("unconfirmed", 0)
+    campaign["progress"] = round(done / campaign["total"] * 100, 1) if campaign["total"] else 100.0
+    return campaign
+
+@api_router.get("/admin/emails/campaigns/{campaign_id}/recipients")
+async def get_email_campaign_recipients(
+    campaign_id: str,
+    status: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    admin_user: User = Depends(get_admin_user)
+):
+    """Per-recipient send status of a campaign (optionally only one status, e.g. failed)"""
+    query = {"campaign_id": campaign_id}
+    if status:
+        query["status"] = status
+    return await db.email_campaign_recipients.find(query, {"_id": 0}).limit(limit).to_list(limit)
+
+@api_router.post("/admin/emails/campaigns/{campaign_id}/cancel")
+async def cancel_email_campaign(campaign_id: str, admin_user: User = Depends(get_admin_user)):
+    """Stop a campaign; recipients not sent yet stay pending"""
+    result = await db.email_campaigns.update_one(
+        {"id": campaign_id, "status": {"$in": ["draft", "queued", "running"]}},
+        {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}, "$unset": {"locked_by": "", "locked_until": ""}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Campanha não encontrada ou já terminada")
+    return {"message": "Campanha cancelada"}
+
+scheduler.add_task("email_campaigns", 10, campaign_sender.run_pending, lease_seconds=EMAIL_CAMPAIGN_LEASE_SECONDS)
+
+@api_router.post("/admin/emails/birthday-rewards/run")
+async def run_birthday_rewards_admin(admin_user: User = Depends(get_admin_user)):
+    """Run today's birthday job now (users already rewarded this year are skipped)"""
+    result = await run_birthday_rewards()
+    return {"message": f"{result['queued']} emails de aniversário colocados na fila", **result}
+
+# Hourly, so a day is not missed when the leader restarts; each user is rewarded once per year
+scheduler.add_task("birthday_rewards", 3600, run_birthday_rewards)
+
 # Test email endpoint
 @api_router.post("/admin/emails/test-welcome")
 async def test_welcome_email(admin_user: User = Depends(get_admin_user)):
@@ -2563,9 +5163,10 @@ async def test_welcome_email(admin_user: User = Depends(get_admin_user)):
     return {"message": "Test welcome email sent", "result": result}
 
 @api_router.post("/admin/products", response_model=Product)
-async def create_product(product_data: ProductCreate, admin_user: User = Depends(get_admin_user)):
-    # Prioritize base64 image over URL if both are provided
-    image_url = product_data.image_base64 if product_data.image_base64 else product_data.image_url
+async def create_product(request: Request, product_data: ProductCreate, admin_user: User = Depends(get_admin_user)):
+    # Prioritize base64 image over URL if both are provided; inline images go to the blob store
+    base_url = public_base_url(request)
+    image_url, image_variants = await prepare_product_image(product_data.image_base64 or product_data.image_url, base_url)
     
     # Handle multiple images
     images = []
@@ -2573,6 +5174,7 @@ async def create_product(product_data: ProductCreate, admin_user: User = Depends
         images.extend(product_data.images_base64)
     if product_data.images:
         images.extend(product_data.images)
+    gallery = [await prepare_product_image(image, base_url) for image in images]
     
     # Set subscription prices with defaults
     subscription_prices = product_data.subscription_prices or calculate_subscription_prices(product_data.price)
@@ -2584,23 +5186,27 @@ async def create_product(product_data: ProductCreate, admin_user: User = Depends
         price=product_data.price,
         subscription_prices=subscription_prices,
         image_url=image_url,
-        images=images,
+        images=[url for url, _ in gallery],
+        image_variants=image_variants,
+        images_variants=[variants for _, variants in gallery],
         stock_quantity=product_data.stock_quantity,
         featured=product_data.featured
     )
     await db.products.insert_one(product.dict())
     
-    # Invalidate products cache
-    invalidate_cache_pattern("products_")
+    # Update the catalog snapshot and invalidate products cache
+    await refresh_catalog_product(product.id)
     
     return product
 
 @api_router.put("/admin/products/{product_id}")
-async def update_product(product_id: str, product_data: ProductCreate, admin_user: User = Depends(get_admin_user)):
-    # Prioritize base64 image over URL if both are provided
+async def update_product(request: Request, product_id: str, product_data: ProductCreate, admin_user: User = Depends(get_admin_user)):
+    # Prioritize base64 image over URL if both are provided; inline images go to the blob store
+    base_url = public_base_url(request)
     update_data = product_data.dict()
     if update_data.get("image_base64"):
         update_data["image_url"] = update_data["image_base64"]
+    update_data["image_url"], update_data["image_variants"] = await prepare_product_image(update_data["image_url"], base_url)
     
     # Handle multiple images
     images = []
@@ -2609,8 +5215,10 @@ async def update_product(product_id: str, product_data: ProductCreate, admin_use
     if product_data.images:
         images.extend(product_data.images)
     
-    if images:
-        update_data["images"] = images
+    # The gallery and its variants are always replaced together so they stay aligned
+    gallery = [await prepare_product_image(image, base_url) for image in images]
+    update_data["images"] = [url for url, _ in gallery]
+    update_data["images_variants"] = [variants for _, variants in gallery]
     
     # Calculate subscription prices automatically based on the base price
     update_data["subscription_prices"] = calculate_subscription_prices(product_data.price)
@@ -2631,9 +5239,8 @@ async def update_product(product_id: str, product_data: ProductCreate, admin_use
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
     
-    # Invalidate products cache
-    invalidate_cache_pattern("products_")
-    cache.pop(f"product_{product_id}", None)  # Invalidate specific product cache
+    # Update the catalog snapshot and invalidate products cache
+    await refresh_catalog_product(product_id)
     
     return {"message": "Produto atualizado com sucesso"}
 
@@ -2644,9 +5251,8 @@ async def delete_product(product_id: str, admin_user: User = Depends(get_admin_u
         {"$set": {"is_active": False}}
     )
     
-    # Invalidate products cache
-    invalidate_cache_pattern("products_")
-    cache.pop(f"product_{product_id}", None)  # Invalidate specific product cache
+    # Update the catalog snapshot and invalidate products cache
+    await refresh_catalog_product(product_id)
     
     return {"message": "Produto removido"}
 
@@ -2659,7 +5265,8 @@ async def create_category(category_data: CategoryCreate, admin_user: User = Depe
     await db.categories.insert_one(category.dict())
     
     # Invalidate categories cache
-    cache.pop("categories_active", None)
+    catalog_snapshot.drop_categories()
+    await invalidate_cache_key("categories_active")
     
     return category
 
@@ -2683,6 +5290,10 @@ async def delete_category(category_id: str, admin_user: User = Depends(get_admin
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Categoria não encontrada")
     
+    # Invalidate categories cache
+    catalog_snapshot.drop_categories()
+    await invalidate_cache_key("categories_active")
+    
     return {"message": "Categoria removida com sucesso"}
 
 # Chat System Endpoints
@@ -2696,6 +5307,7 @@ async def create_chat_session(session_data: ChatSessionCreate, current_user: Use
         subject=session_data.subject
     )
     await db.chat_sessions.insert_one(chat_session.dict())
+    await chat_pubsub.publish(CHAT_ADMIN_CHANNEL, "session", {**chat_session.dict(), "session_id": chat_session.id})
     return chat_session
 
 @api_router.get("/chat/sessions")
@@ -2710,8 +5322,21 @@ async def get_user_chat_sessions(current_user: User = Depends(get_current_user))
             session["_id"] = str(session["_id"])
     return sessions
 
+CHAT_MESSAGES_PAGE_SIZE = 200  # Pages after a cursor
+CHAT_MESSAGES_MAX_PAGE_SIZE = 1000  # Also the default without a cursor (the latest messages)
+
 @api_router.get("/chat/sessions/{session_id}/messages")
-async def get_chat_messages(session_id: str, current_user: User = Depends(get_current_user)):
+async def get_chat_messages(
+    session_id: str,
+    response: Response,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=CHAT_MESSAGES_MAX_PAGE_SIZE),
+    current_user: User = Depends(get_current_user)
+):
+    """Messages in order; pass X-Next-Cursor back as `after` to fetch only newer ones
+
+    Without `after` the latest messages are returned (up to 1000 by default).
+    """
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
@@ -2723,11 +5348,42 @@ async def get_chat_messages(session_id: str, current_user: User = Depends(get_cu
     if session["user_id"] != current_user.id and not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Acesso negado")
     
-    messages = await db.chat_messages.find({"chat_session_id": session_id}).sort("timestamp", 1).to_list(1000)
+    # `after` is a message id (exclusive, ties broken by id) or an ISO timestamp
+    query = {"chat_session_id": session_id}
+    if after:
+        try:
+            query["timestamp"] = {"$gt": datetime.fromisoformat(after.replace("Z", "+00:00")).replace(tzinfo=None)}
+        except ValueError:
+            anchor = await db.chat_messages.find_one({"chat_session_id": session_id, "id": after}, {"timestamp": 1})
+            if not anchor:
+                raise HTTPException(status_code=400, detail="Cursor inválido")
+            query["$or"] = [
+                {"timestamp": {"$gt": anchor["timestamp"]}},
+                {"timestamp": anchor["timestamp"], "id": {"$gt": after}}
+            ]
+
+    # Served by the (chat_session_id, timestamp) index; one extra message tells whether more follow
+    if after:
+        limit = limit or CHAT_MESSAGES_PAGE_SIZE
+        messages = await db.chat_messages.find(query).sort([("timestamp", 1), ("id", 1)]).limit(limit + 1).to_list(limit + 1)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+    else:
+        # First load: the newest page, so nothing newer is left to fetch
+        limit = limit or CHAT_MESSAGES_MAX_PAGE_SIZE
+        messages = await db.chat_messages.find(query).sort([("timestamp", -1), ("id", -1)]).limit(limit).to_list(limit)
+        messages.reverse()
+        has_more = False
+
     # Convert ObjectId to string
     for message in messages:
         if "_id" in message:
             message["_id"] = str(message["_id"])
+
+    next_cursor = messages[-1]["id"] if messages else after
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    response.headers["X-Has-More"] = "true" if has_more else "false"
     return messages
 
 @api_router.post("/chat/sessions/{session_id}/messages")
@@ -2767,6 +5423,8 @@ async def send_chat_message(session_id: str, message_data: ChatMessageCreate, cu
             {"id": session_id},
             {"$set": {"agent_id": current_user.id}}
         )
+
+    await publish_chat_event(session, "message", chat_message.dict())
     
     return chat_message
 
@@ -2787,46 +5445,83 @@ async def close_chat_session(session_id: str, current_user: User = Depends(get_c
         {"id": session_id},
         {"$set": {"status": "closed", "updated_at": datetime.utcnow()}}
     )
+    await publish_chat_event(session, "status", {"status": "closed"})
     
     return {"message": "Sessão de chat encerrada"}
 
+# Auto-close sessions inactive for more than 10 minutes (scheduled, one worker at a time)
+CHAT_INACTIVITY_MINUTES = 10
+
+async def close_inactive_chat_sessions():
+    inactive_threshold = datetime.utcnow() - timedelta(minutes=CHAT_INACTIVITY_MINUTES)
+    stale = await db.chat_sessions.find(
+        {"status": {"$in": ["pending", "active"]}, "updated_at": {"$lt": inactive_threshold}},
+        {"_id": 0, "id": 1, "user_id": 1}
+    ).to_list(1000)
+    if not stale:
+        return
+    # Re-checked at close time: a session that got a message since the find stays open
+    stale_ids = [session["id"] for session in stale]
+    closed_at = datetime.utcnow()
+    await db.chat_sessions.update_many(
+        {"id": {"$in": stale_ids}, "status": {"$in": ["pending", "active"]}, "updated_at": {"$lt": inactive_threshold}},
+        {"$set": {"status": "auto_closed", "updated_at": closed_at}}
+    )
+    # Only the sessions this run actually closed are announced
+    closed = await db.chat_sessions.find(
+        {"id": {"$in": stale_ids}, "status": "auto_closed", "updated_at": closed_at},
+        {"_id": 0, "id": 1, "user_id": 1}
+    ).to_list(1000)
+    for session in closed:
+        await publish_chat_event(session, "status", {"status": "auto_closed"})
+
+scheduler.add_task("chat_auto_close", 60, close_inactive_chat_sessions)
+
 # Admin Chat Endpoints
+def chat_message_lookup(direction: int, name: str) -> dict:
+    return {"$lookup": {
+        "from": "chat_messages",
+        "let": {"session_id": "$id"},
+        "pipeline": [
+            {"$match": {"$expr": {"$eq": ["$chat_session_id", "$$session_id"]}}},
+            {"$sort": {"timestamp": direction}},
+            {"$limit": 1},
+            {"$project": {"_id": 0, "message": 1, "timestamp": 1}}
+        ],
+        "as": name
+    }}
+
+CHAT_SESSIONS_ADMIN_PIPELINE = [
+    {"$sort": {"updated_at": -1}},
+    {"$limit": 1000},
+    {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "id", "as": "user"}},
+    chat_message_lookup(1, "first_message"),
+    chat_message_lookup(-1, "last_message")
+]
+
 @api_router.get("/admin/chat/sessions")
 async def get_all_chat_sessions(admin_user: User = Depends(get_admin_user)):
-    # Auto-close sessions inactive for more than 10 minutes
-    inactive_threshold = datetime.utcnow() - timedelta(minutes=10)
-    await db.chat_sessions.update_many(
-        {
-            "status": {"$in": ["pending", "active"]},
-            "updated_at": {"$lt": inactive_threshold}
-        },
-        {"$set": {"status": "auto_closed", "updated_at": datetime.utcnow()}}
-    )
+    # Inactive sessions are auto-closed by the scheduler (close_inactive_chat_sessions)
+    # One aggregation joins the user and the first/last message of every session
+    # (served by the (chat_session_id, timestamp) index) instead of 3 queries per session
+    sessions = await db.chat_sessions.aggregate(CHAT_SESSIONS_ADMIN_PIPELINE).to_list(1000)
     
-    sessions = await db.chat_sessions.find().sort("updated_at", -1).to_list(1000)
-    
-    # Get user info for each session
     result = []
     for session in sessions:
-        if "_id" in session:
-            session["_id"] = str(session["_id"])
+        session["_id"] = str(session["_id"])
         
-        user = await db.users.find_one({"id": session["user_id"]})
-        session["user_name"] = user["name"] if user else "Usuário desconhecido"
-        session["user_email"] = user["email"] if user else ""
+        user = session.pop("user")
+        session["user_name"] = user[0]["name"] if user else "Usuário desconhecido"
+        session["user_email"] = user[0]["email"] if user else ""
         
-        # Get first message (subject/initial request)
-        first_message = await db.chat_messages.find_one(
-            {"chat_session_id": session["id"]},
-            sort=[("timestamp", 1)]
-        )
+        # First message (subject/initial request)
+        first_message = session.pop("first_message")
+        first_message = first_message[0] if first_message else None
         session["subject"] = first_message["message"][:100] + "..." if first_message and len(first_message["message"]) > 100 else (first_message["message"] if first_message else "Sem mensagem inicial")
         
-        # Get last message
-        last_message = await db.chat_messages.find_one(
-            {"chat_session_id": session["id"]},
-            sort=[("timestamp", -1)]
-        )
+        # Last message
+        last_message = session.pop("last_message")
+        last_message = last_message[0] if last_message else None
         session["last_message"] = last_message["message"] if last_message else ""
         session["last_message_time"] = last_message["timestamp"] if last_message else session["created_at"]
         
@@ -2858,6 +5553,8 @@ async def assign_chat_session(session_id: str, admin_user: User = Depends(get_ad
         message=f"Olá {user_name}, estou a verificar a mensagem e já darei apoio."
     )
     await db.chat_messages.insert_one(welcome_message.dict())
+    await publish_chat_event(session, "status", {"status": "active", "agent_id": admin_user.id})
+    await publish_chat_event(session, "message", welcome_message.dict())
     
     return {"message": "Sessão atribuída"}
 
@@ -2867,6 +5564,7 @@ async def reject_chat_session(session_id: str, admin_user: User = Depends(get_ad
         {"id": session_id},
         {"$set": {"status": "rejected", "updated_at": datetime.utcnow()}}
     )
+    await publish_chat_event({"id": session_id}, "status", {"status": "rejected"})
     return {"message": "Sessão rejeitada"}
 
 @api_router.put("/admin/chat/sessions/{session_id}/close")
@@ -2876,8 +5574,54 @@ async def close_chat_session(session_id: str, admin_user: User = Depends(get_adm
         {"id": session_id},
         {"$set": {"status": "closed", "updated_at": datetime.utcnow()}}
     )
+    await publish_chat_event({"id": session_id}, "status", {"status": "closed"})
     return {"message": "Sessão fechada"}
 
+# Chat event streams (Server-Sent Events). EventSource cannot send an Authorization
+# header, so the access token is passed as a query parameter.
+def chat_event_stream(request: Request, channel: str) -> StreamingResponse:
+    async def events():
+        queue = chat_pubsub.subscribe(channel)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=CHAT_EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"  # Keeps proxies from closing an idle stream
+                    continue
+                yield f"event: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+        finally:
+            chat_pubsub.unsubscribe(channel, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@api_router.get("/events/chat/{session_id}")
+async def stream_chat_session_events(request: Request, session_id: str, token: str):
+    """New messages and status changes of one chat session"""
+    current_user = await resolve_user_from_token(token)
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    session = await db.chat_sessions.find_one({"id": session_id}, {"user_id": 1})
+    if not session:
+        raise HTTPException(status_code=404, detail="Sessão de chat não encontrada")
+    if session["user_id"] != current_user.id and not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Acesso negado")
+
+    return chat_event_stream(request, chat_session_channel(session_id))
+
+@api_router.get("/events/admin/chat")
+async def stream_admin_chat_events(request: Request, token: str):
+    """Every chat event, for the admin chat list and pending counter"""
+    current_user = await resolve_user_from_token(token)
+    if not current_user or not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return chat_event_stream(request, CHAT_ADMIN_CHANNEL)
+
 # OTP and password change endpoints
 @api_router.post("/auth/send-otp")
 async def send_otp(request: dict, current_user: User = Depends(get_current_user)):
@@ -2894,7 +5638,7 @@ async def send_otp(request: dict, current_user: User = Depends(get_current_user)
         expiry_time = datetime.utcnow() + timedelta(minutes=10)
         
         # Create encrypted OTP (store hash, not plain text)
-        otp_hash = pwd_context.hash(otp_code)
+        otp_hash = await hash_password(otp_code)
         
         await db.otps.insert_one({
             "user_id": current_user.id,
@@ -2915,15 +5659,10 @@ async def send_otp(request: dict, current_user: User = Depends(get_current_user)
         <p>Se não solicitou esta alteração, ignore este email.</p>
         """
         
-        try:
-            resend.Emails.send({
-                "from": "Mystery Box Store <noreply@mysteryboxes.pt>",
-                "to": [email],
-                "subject": subject,
-                "html": html_content
-            })
-        except Exception as e:
-            logger.warning(f"Email send failed: {str(e)}")
+        # Sent directly, not through the outbox, so the plain code is never stored
+        email_result = await send_email(email, subject, html_content)
+        if not email_result.get("success"):
+            logger.warning(f"Email send failed: {email_result.get('error')}")
             # Continue anyway - user might still have OTP for testing
             
         return {"message": "Código OTP enviado para seu email"}
@@ -2944,7 +5683,7 @@ async def change_password(request: dict, current_user: User = Depends(get_curren
             raise HTTPException(status_code=400, detail="Todos os campos são obrigatórios")
         
         # Verify current password
-        if not pwd_context.verify(current_password, current_user.password):
+        if not current_user.password_hash or not await verify_password(current_password, current_user.password_hash):
             raise HTTPException(status_code=400, detail="Senha atual incorreta")
         
         # Find and verify OTP
@@ -2958,7 +5697,7 @@ async def change_password(request: dict, current_user: User = Depends(get_curren
             raise HTTPException(status_code=400, detail="Código OTP inválido ou expirado")
         
         # Verify OTP code
-        if not pwd_context.verify(otp_code, otp_record["otp_hash"]):
+        if not await verify_password(otp_code, otp_record["otp_hash"]):
             raise HTTPException(status_code=400, detail="Código OTP incorreto")
         
         # Mark OTP as used
@@ -2968,11 +5707,12 @@ async def change_password(request: dict, current_user: User = Depends(get_curren
         )
         
         # Update password
-        new_password_hash = pwd_context.hash(new_password)
+        new_password_hash = await hash_password(new_password)
         await db.users.update_one(
             {"id": current_user.id},
-            {"$set": {"password": new_password_hash, "updated_at": datetime.utcnow()}}
+            {"$set": {"password_hash": new_password_hash, "updated_at": datetime.utcnow()}}
         )
+        await invalidate_user_cache(current_user.email)
         
         return {"message": "Senha alterada com sucesso"}
         
@@ -3287,6 +6027,7 @@ async def process_monthly_subscriptions():
             
             # Insert the order
             await db.orders.insert_one(order)
+            await record_order_created(order)
             
             # Create delivery record
             delivery = SubscriptionDelivery(
@@ -3349,7 +6090,14 @@ async def health_check():
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await scheduler.stop()
+    email_outbox.stop()
+    stripe_event_processor.stop()
+    google_token_verifier.stop()
     client.close()
+    if image_process_pool is not None:
+        image_process_pool.shutdown(wait=False, cancel_futures=True)
+    stripe_gateway.shutdown()
 
 # Configure CORS with performance optimizations
 app.add_middleware(
@@ -3365,6 +6113,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "PATCH"],  # Specific methods for better security
     allow_headers=["Authorization", "Content-Type", "X-Requested-With"],  # Specific headers
+    expose_headers=["X-Next-Cursor", "X-Has-More", "ETag"],  # Pagination tokens and catalog validators
     max_age=3600  # Cache preflight requests for 1 hour
 )
 
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import sys
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Import the backend in-process; no database connection is opened by these tests
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+try:
+    import fakeredis.aioredis as fakeredis_aioredis
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# Test results
+test_results = {}
+
+def log_test_result(test_name, success, message=""):
+    """Log test result and store in results dictionary"""
+    status = "PASSED" if success else "FAILED"
+    logger.info(f"{test_name}: {status} {message}")
+    test_results[test_name] = {"success": success, "message": message}
+    return success
+
+async def test_in_process_backend():
+    """Hit/miss counters and prefix invalidation on the in-process backend"""
+    backend = server.create_cache_backend(backend="memory", redis_url=None)
+
+    await backend.get("products_all_all")
+    await backend.set("products_all_all", [{"id": "1"}])
+    await backend.set("product_1", {"id": "1"})
+    cached = await backend.get("products_all_all")
+    await backend.invalidate("products_")
+    after = await backend.get("products_all_all")
+    single = await backend.get("product_1")
+
+    stats = backend.stats()
+    success = (
+        cached == [{"id": "1"}] and after is None and single == {"id": "1"}
+        and stats["hits"] == 2 and stats["misses"] == 2 and stats["invalidations"] == 1
+    )
+    return log_test_result("In-process cache backend", success, str(stats))
+
+async def test_broadcast_invalidation():
+    """Invalidation on one worker clears the in-process cache of another worker"""
+    if fakeredis is None:
+        return log_test_result("Broadcast invalidation", True, "skipped - fakeredis not installed")
+
+    redis_server = fakeredis.FakeServer()
+    worker_a = server.create_cache_backend(backend="memory", redis_client=fakeredis_aioredis.FakeRedis(server=redis_server, decode_responses=True))
+    worker_b = server.create_cache_backend(backend="memory", redis_client=fakeredis_aioredis.FakeRedis(server=redis_server, decode_responses=True))
+
+    # Both backends live in this process, so give worker B its own origin id
+    worker_b.worker_id = "worker-b"
+    received = asyncio.Event()
+    worker_b.add_invalidation_listener(lambda pattern, exact: received.set())
+
+    listener = asyncio.create_task(worker_b.listen_for_invalidations())
+    await asyncio.sleep(0.1)
+
+    await worker_b.set("products_all_all", [{"id": "1", "price": 10.0}])
+    await worker_a.invalidate("products_")
+
+    try:
+        await asyncio.wait_for(received.wait(), timeout=2)
+    except asyncio.TimeoutError:
+        pass
+    listener.cancel()
+
+    stale = await worker_b.get("products_all_all")
+    success = stale is None and worker_b.remote_invalidations == 1
+    return log_test_result("Broadcast invalidation", success, f"worker B entry after invalidation: {stale}")
+
+async def test_shared_redis_backend():
+    """Entries written by one worker are served to another from the shared store"""
+    if fakeredis is None:
+        return log_test_result("Shared Redis backend", True, "skipped - fakeredis not installed")
+
+    redis_server = fakeredis.FakeServer()
+    worker_a = server.create_cache_backend(backend="redis", redis_client=fakeredis_aioredis.FakeRedis(server=redis_server, decode_responses=True))
+    worker_b = server.create_cache_backend(backend="redis", redis_client=fakeredis_aioredis.FakeRedis(server=redis_server, decode_responses=True))
+
+    await worker_a.set("product_1", {"id": "1", "price": 10.0})
+    shared = await worker_b.get("product_1")
+    await worker_b.invalidate("product_1", exact=True)
+    gone = await worker_a.get("product_1")
+
+    success = shared == {"id": "1", "price": 10.0} and gone is None
+    return log_test_result("Shared Redis backend", success, f"worker B read {shared}")
+
+async def test_user_cache_invalidation():
+    """A privilege change on one worker drops the resolved user on another worker"""
+    if fakeredis is None:
+        return log_test_result("User cache invalidation", True, "skipped - fakeredis not installed")
+
+    redis_server = fakeredis.FakeServer()
+    worker_a = server.create_cache_backend(backend="memory", redis_client=fakeredis_aioredis.FakeRedis(server=redis_server, decode_responses=True))
+    worker_b = server.create_cache_backend(backend="memory", redis_client=fakeredis_aioredis.FakeRedis(server=redis_server, decode_responses=True))
+    worker_b.worker_id = "worker-b"
+
+    users_b = server.UserCache(maxsize=10, ttl=60)
+    worker_b.add_invalidation_listener(users_b.on_invalidation)
+    users_b.put("cliente@example.com", server.User(email="cliente@example.com", name="Cliente"), users_b.generation)
+
+    listener = asyncio.create_task(worker_b.listen_for_invalidations())
+    await asyncio.sleep(0.1)
+
+    cached = users_b.get("cliente@example.com")
+    await worker_a.invalidate("user_cliente@example.com", exact=True)
+    for _ in range(20):
+        if users_b.get("cliente@example.com") is None:
+            break
+        await asyncio.sleep(0.1)
+    listener.cancel()
+
+    success = cached is not None and users_b.get("cliente@example.com") is None
+    return log_test_result("User cache invalidation", success, str(users_b.stats()))
+
+async def test_user_cache_without_broadcast():
+    """Without a broadcast backend the user cache stays off, so every worker reads the database"""
+    backend = server.create_cache_backend(backend="memory", redis_url=None)
+    users = server.UserCache(maxsize=10, ttl=60, enabled=backend.redis is not None)
+    users.put("cliente@example.com", server.User(email="cliente@example.com", name="Cliente"), users.generation)
+
+    success = users.get("cliente@example.com") is None and users.stats()["entries"] == 0
+    return log_test_result("User cache off without broadcast", success, str(users.stats()))
+
+def run_cache_backend_tests():
+    """Run catalog cache backend tests"""
+    logger.info("Starting catalog cache backend tests")
+
+    async def run_all():
+        await test_in_process_backend()
+        await test_broadcast_invalidation()
+        await test_shared_redis_backend()
+        await test_user_cache_invalidation()
+        await test_user_cache_without_broadcast()
+
+    asyncio.run(run_all())
+
+    # Print summary
+    logger.info("\n=== CACHE BACKEND TEST SUMMARY ===")
+    for test_name, result in test_results.items():
+        status = "✅ PASSED" if result["success"] else "❌ FAILED"
+        logger.info(f"{status}: {test_name}")
+
+    return test_results
+
+if __name__ == "__main__":
+    run_cache_backend_tests()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Cart concurrency test - parallel cart mutations must not lose updates.
+
+Fires concurrent add-to-cart calls for the same cart (as two browser tabs or repeated
+clicks would) through the backend's cart endpoints and checks that every quantity is
+accounted for, that each product/subscription line exists once and that only one cart
+document is created. For comparison it runs the same load through the previous
+read-modify-replace implementation and reports how many units it lost.
+
+Needs a MongoDB reachable at TEST_MONGO_URL (a throwaway database is used and dropped).
+
+Usage:
+    python cart_concurrency_test.py [parallel_adds]
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+import logging
+from datetime import datetime
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+PARALLEL_ADDS = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+TEST_DB_NAME = "mystery_box_cart_concurrency_test"
+
+# Test results
+test_results = {}
+
+def log_test_result(test_name, success, message=""):
+    """Log test result and store in results dictionary"""
+    status = "PASSED" if success else "FAILED"
+    logger.info(f"{test_name}: {status} {message}")
+    test_results[test_name] = {"success": success, "message": message}
+    return success
+
+async def legacy_add_to_cart(session_id, item):
+    """Previous implementation: find_one, mutate in Python, replace_one"""
+    cart = await server.db.carts.find_one({"session_id": session_id})
+    cart = server.Cart(**cart) if cart else server.Cart(session_id=session_id)
+    for cart_item in cart.items:
+        if cart_item.product_id == item.product_id and cart_item.subscription_type == item.subscription_type:
+            cart_item.quantity += item.quantity
+            break
+    else:
+        cart.items.append(item)
+    cart.updated_at = datetime.utcnow()
+    await server.db.carts.replace_one({"session_id": session_id}, cart.dict(), upsert=True)
+
+def quantities(cart):
+    return {(item["product_id"], item.get("subscription_type")): item["quantity"] for item in cart["items"]}
+
+async def test_parallel_adds():
+    """Concurrent adds to a new cart: no lost quantity, no duplicate lines or carts"""
+    session_id = f"tab-{uuid.uuid4()}"
+    items = [server.CartItem(product_id="p1", quantity=1) for _ in range(PARALLEL_ADDS)]
+    items += [server.CartItem(product_id="p2", quantity=2) for _ in range(PARALLEL_ADDS // 2)]
+    items += [server.CartItem(product_id="p1", quantity=1, subscription_type="monthly_3") for _ in range(PARALLEL_ADDS // 4)]
+    results = await asyncio.gather(*(server.add_to_cart(session_id, item) for item in items), return_exceptions=True)
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    carts = await server.db.carts.find({"session_id": session_id}).to_list(None)
+    expected = {("p1", None): PARALLEL_ADDS, ("p2", None): PARALLEL_ADDS, ("p1", "monthly_3"): PARALLEL_ADDS // 4}
+    got = quantities(carts[0]) if carts else {}
+
+    success = not errors and len(carts) == 1 and len(carts[0]["items"]) == 3 and got == expected
+    return log_test_result("Parallel adds", success, f"expected {expected}, got {got}, {len(errors)} errors, {len(carts)} carts")
+
+async def test_parallel_add_and_remove():
+    """Removing a line while other lines are being added keeps the other lines intact"""
+    session_id = f"tab-{uuid.uuid4()}"
+    await server.add_to_cart(session_id, server.CartItem(product_id="gone", quantity=1))
+    adds = [server.add_to_cart(session_id, server.CartItem(product_id="kept", quantity=1)) for _ in range(PARALLEL_ADDS)]
+    await asyncio.gather(server.remove_from_cart(session_id, "gone"), *adds)
+
+    cart = await server.db.carts.find_one({"session_id": session_id})
+    success = quantities(cart) == {("kept", None): PARALLEL_ADDS}
+    return log_test_result("Parallel add and remove", success, str(quantities(cart)))
+
+async def test_legacy_lost_updates():
+    """Reference: the read-modify-replace implementation under the same load"""
+    session_id = f"tab-{uuid.uuid4()}"
+    await asyncio.gather(*(legacy_add_to_cart(session_id, server.CartItem(product_id="p1", quantity=1)) for _ in range(PARALLEL_ADDS)),
+                         return_exceptions=True)
+    cart = await server.db.carts.find_one({"session_id": session_id})
+    kept = quantities(cart).get(("p1", None), 0) if cart else 0
+    logger.info(f"Read-modify-replace kept {kept} of {PARALLEL_ADDS} units ({PARALLEL_ADDS - kept} lost)")
+    return kept
+
+def run_cart_concurrency_tests():
+    """Run cart concurrency tests"""
+    logger.info(f"Starting cart concurrency tests ({PARALLEL_ADDS} parallel adds)")
+    client = server.AsyncIOMotorClient(os.environ["MONGO_URL"])
+    original_db = server.db
+
+    async def run_all():
+        server.db = client[TEST_DB_NAME]
+        await server.db.carts.drop()
+        await server.db.carts.create_index([("session_id", 1)], unique=True)
+        await test_parallel_adds()
+        await test_parallel_add_and_remove()
+        await test_legacy_lost_updates()
+        await server.db.carts.drop()
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        server.db = original_db
+
+    # Print summary
+    logger.info("\n=== CART CONCURRENCY TEST SUMMARY ===")
+    for test_name, result in test_results.items():
+        status = "✅ PASSED" if result["success"] else "❌ FAILED"
+        logger.info(f"{status}: {test_name}")
+
+    return test_results
+
+if __name__ == "__main__":
+    run_cart_concurrency_tests()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Cart pricing benchmark - cost of pricing carts with hundreds of lines.
+
+Prices carts of growing size with the backend's price_cart (the engine behind GET /cart and
+checkout) against in-memory collections that add a fixed latency per database round trip.
+Reports per-cart time and round trips with a cold catalog cache (one batched products
+query), a warm cache (no products query) and, for reference, loading every line's product
+with its own find_one as a per-item implementation would. Active promotions come from the
+in-memory promotion index, loaded once per cart size.
+
+Usage:
+    python cart_pricing_benchmark.py [round_trip_ms] [promotions]
+"""
+
+import asyncio
+import copy
+import os
+import sys
+import time
+import statistics
+import logging
+from datetime import datetime, timedelta
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+ROUND_TRIP_MS = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+PROMOTIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+CART_SIZES = [10, 100, 300, 500]
+RUNS = 20
+
+def matches(doc, query):
+    for key, value in query.items():
+        if isinstance(value, dict):
+            if "$in" in value and doc.get(key) not in value["$in"]:
+                return False
+            if "$lte" in value and not doc.get(key) <= value["$lte"]:
+                return False
+            if "$gte" in value and not doc.get(key) >= value["$gte"]:
+                return False
+            if "$gt" in value and not doc.get(key) > value["$gt"]:
+                return False
+        elif doc.get(key) != value:
+            return False
+    return True
+
+class LatencyCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        await asyncio.sleep(ROUND_TRIP_MS / 1000)
+        return copy.deepcopy(self.docs)
+
+class LatencyCollection:
+    """In-memory collection with a fixed latency per round trip"""
+
+    def __init__(self, docs=None):
+        self.docs = docs or []
+        self.round_trips = 0
+
+    def find(self, query=None, *args, **kwargs):
+        self.round_trips += 1
+        return LatencyCursor([d for d in self.docs if matches(d, query or {})])
+
+    async def find_one(self, query, *args, **kwargs):
+        self.round_trips += 1
+        await asyncio.sleep(ROUND_TRIP_MS / 1000)
+        return next((copy.deepcopy(d) for d in self.docs if matches(d, query)), None)
+
+class FakeDatabase:
+    def __init__(self, **collections):
+        self.collections = collections
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self.collections.setdefault(name, LatencyCollection())
+
+def build_database(product_count):
+    now = datetime.utcnow()
+    categories = ["geek", "terror", "pets", "lifestyle", "tech"]
+    products = [{"id": f"p{i}", "name": f"Mystery Box {i}", "category": categories[i % 5], "price": 19.99 + i % 30,
+                 "subscription_prices": {"3_months": 17.99, "6_months": 16.99}, "image_url": "", "is_active": True}
+                for i in range(product_count)]
+    promotions = [{"id": f"promo{i}", "name": f"Promo {i}", "description": "", "discount_type": "percentage",
+                   "discount_value": 5 + i % 10, "applicable_categories": [categories[i % 5]], "applicable_products": [],
+                   "valid_from": now - timedelta(days=1), "valid_until": now + timedelta(days=1), "is_active": True,
+                   "created_by": "admin"} for i in range(PROMOTIONS)]
+    coupons = [{"id": "c1", "code": "BENCH10", "description": "", "discount_type": "percentage", "discount_value": 10,
+                "valid_from": now - timedelta(days=1), "valid_until": now + timedelta(days=1), "is_active": True,
+                "created_by": "admin", "current_uses": 0}]
+    return FakeDatabase(products=LatencyCollection(products), promotions=LatencyCollection(promotions),
+                        coupons=LatencyCollection(coupons))
+
+def cart_items(lines):
+    return [server.CartItem(product_id=f"p{i}", quantity=1 + i % 3, subscription_type="3_months" if i % 7 == 0 else None)
+            for i in range(lines)]
+
+async def per_item_lookups(items):
+    """Reference: one find_one per line"""
+    subtotal = 0.0
+    for item in items:
+        product = await server.db.products.find_one({"id": item.product_id})
+        if product:
+            subtotal += server.product_unit_price(product, item.subscription_type) * item.quantity
+    return subtotal
+
+async def measure(name, lines, price):
+    timings = []
+    round_trips = []
+    for _ in range(RUNS):
+        before = sum(c.round_trips for c in server.db.collections.values())
+        start = time.perf_counter()
+        await price()
+        timings.append((time.perf_counter() - start) * 1000)
+        round_trips.append(sum(c.round_trips for c in server.db.collections.values()) - before)
+    result = {"mean_ms": round(statistics.mean(timings), 2), "round_trips": round(statistics.mean(round_trips), 1)}
+    logger.info(f"{lines:>4} lines - {name}: {result}")
+    return result
+
+async def main():
+    logger.info(f"Cart pricing benchmark: {ROUND_TRIP_MS} ms per round trip, {PROMOTIONS} active promotions")
+    original_db, original_cache = server.db, server.cache_backend
+    summary = []
+    try:
+        for lines in CART_SIZES:
+            server.db = build_database(lines)
+            server.cache_backend = server.InProcessCacheBackend(maxsize=10000, ttl=300)
+            server.promotion_index.invalidate()
+            items = cart_items(lines)
+
+            async def cold():
+                server.cache_backend.store.clear()
+                return await server.price_cart(items, "BENCH10", "standard", server.ProductLoader(cache=server.cache_backend))
+
+            async def warm():
+                return await server.price_cart(items, "BENCH10", "standard", server.ProductLoader(cache=server.cache_backend))
+
+            reference = await measure("one find_one per line", lines, lambda: per_item_lookups(items))
+            cold_result = await measure("price_cart, cold cache", lines, cold)
+            warm_result = await measure("price_cart, warm cache", lines, warm)
+            pricing = await warm()
+            summary.append((lines, reference, cold_result, warm_result, pricing["total_amount"]))
+    finally:
+        server.db, server.cache_backend = original_db, original_cache
+
+    logger.info("\n=== CART PRICING BENCHMARK SUMMARY ===")
+    for lines, reference, cold_result, warm_result, total in summary:
+        logger.info(f"{lines:>4} lines: per-line lookups {reference['mean_ms']} ms -> price_cart {cold_result['mean_ms']} ms cold / "
+                    f"{warm_result['mean_ms']} ms warm ({warm_result['round_trips']:.0f} round trips, total €{total})")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,153 @@
+import asyncio
+import copy
+import json
+import os
+import sys
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Import the backend in-process; the database is replaced by an in-memory fake below
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+try:
+    import fakeredis.aioredis as fakeredis_aioredis
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# Test results
+test_results = {}
+
+def log_test_result(test_name, success, message=""):
+    """Log test result and store in results dictionary"""
+    status = "PASSED" if success else "FAILED"
+    logger.info(f"{test_name}: {status} {message}")
+    test_results[test_name] = {"success": success, "message": message}
+    return success
+
+class MemoryCollection:
+    def __init__(self, docs=None):
+        self.docs = docs or []
+
+    async def find_one(self, query, *args, **kwargs):
+        for doc in self.docs:
+            if all(doc.get(key) == value for key, value in query.items()):
+                return copy.deepcopy(doc)
+        return None
+
+    async def insert_one(self, doc):
+        self.docs.append(copy.deepcopy(doc))
+
+    async def update_one(self, query, update, upsert=False):
+        for doc in self.docs:
+            if all(doc.get(key) == value for key, value in query.items()):
+                doc.update(update.get("$set", {}))
+                break
+
+class FakeDatabase:
+    def __init__(self, **collections):
+        self.collections = collections
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self.collections.setdefault(name, MemoryCollection())
+
+class FakeRequest:
+    async def is_disconnected(self):
+        return False
+
+async def test_in_process_delivery():
+    """Subscribers of a channel receive its events; other channels do not"""
+    hub = server.create_chat_pubsub(backend="memory")
+    session_queue = hub.subscribe("chat:session:s1")
+    other_queue = hub.subscribe("chat:session:s2")
+
+    await hub.publish("chat:session:s1", "message", {"message": "Olá"})
+    received = session_queue.get_nowait()
+    hub.unsubscribe("chat:session:s1", session_queue)
+
+    success = received == {"event": "message", "data": {"message": "Olá"}} and other_queue.empty() and hub.stats()["subscribers"] == 1
+    return log_test_result("In-process chat delivery", success, str(hub.stats()))
+
+async def test_cross_worker_delivery():
+    """An event published on one worker reaches a subscriber connected to another"""
+    if fakeredis is None:
+        return log_test_result("Cross-worker chat delivery", True, "skipped - fakeredis not installed")
+
+    redis_server = fakeredis.FakeServer()
+    worker_a = server.create_chat_pubsub(backend="redis", redis_client=fakeredis_aioredis.FakeRedis(server=redis_server, decode_responses=True))
+    worker_b = server.create_chat_pubsub(backend="redis", redis_client=fakeredis_aioredis.FakeRedis(server=redis_server, decode_responses=True))
+    worker_b.worker_id = "worker-b"
+
+    queue = worker_b.subscribe(server.CHAT_ADMIN_CHANNEL)
+    listener = asyncio.create_task(worker_b.listen())
+    await asyncio.sleep(0.1)
+
+    await worker_a.publish(server.CHAT_ADMIN_CHANNEL, "session", {"session_id": "s1"})
+    try:
+        received = await asyncio.wait_for(queue.get(), timeout=2)
+    except asyncio.TimeoutError:
+        received = None
+    listener.cancel()
+
+    success = received == {"event": "session", "data": {"session_id": "s1"}}
+    return log_test_result("Cross-worker chat delivery", success, f"worker B received {received}")
+
+async def test_send_message_streams_event():
+    """send_chat_message pushes the new message to the session's event stream"""
+    server.chat_pubsub = server.create_chat_pubsub(backend="memory")
+    server.db = FakeDatabase(chat_sessions=MemoryCollection([{"id": "s1", "user_id": "u1", "status": "active"}]))
+
+    response = server.chat_event_stream(FakeRequest(), server.chat_session_channel("s1"))
+    stream = response.body_iterator
+    first = await stream.__anext__()
+    admin_queue = server.chat_pubsub.subscribe(server.CHAT_ADMIN_CHANNEL)
+
+    user = server.User(id="u1", email="cliente@example.com", name="Cliente")
+    await server.send_chat_message("s1", server.ChatMessageCreate(message="Onde está a minha encomenda?"), current_user=user)
+
+    chunk = await asyncio.wait_for(stream.__anext__(), timeout=2)
+    await stream.aclose()
+    event_line, data_line = chunk.strip().split("\n")
+    payload = json.loads(data_line[len("data: "):])
+    admin_event = admin_queue.get_nowait()
+
+    success = (
+        first.startswith("retry:") and event_line == "event: message"
+        and payload["message"] == "Onde está a minha encomenda?" and payload["chat_session_id"] == "s1"
+        and admin_event["data"]["session_id"] == "s1"
+        and server.chat_session_channel("s1") not in server.chat_pubsub.subscribers
+    )
+    return log_test_result("Chat message event stream", success, chunk.strip()[:80])
+
+def run_chat_events_tests():
+    """Run chat push channel tests"""
+    logger.info("Starting chat event tests")
+    original_db, original_pubsub = server.db, server.chat_pubsub
+
+    async def run_all():
+        await test_in_process_delivery()
+        await test_cross_worker_delivery()
+        await test_send_message_streams_event()
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        server.db, server.chat_pubsub = original_db, original_pubsub
+
+    # Print summary
+    logger.info("\n=== CHAT EVENTS TEST SUMMARY ===")
+    for test_name, result in test_results.items():
+        status = "✅ PASSED" if result["success"] else "❌ FAILED"
+        logger.info(f"{status}: {test_name}")
+
+    return test_results
+
+if __name__ == "__main__":
+    run_chat_events_tests()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Coupon redemption test - a capped coupon is never redeemed more than max_uses times.
+
+Runs concurrent checkouts (through the backend's create_checkout, against
+fake_stripe_server.py) for carts that all carry the same coupon with a low max_uses, and
+checks that exactly max_uses checkouts got the discount, the rest were refused and
+current_uses ends at the cap. Also checks that a checkout whose Stripe session fails, or
+that fails after it before the order is recorded, gives its use back exactly once, and reports how far the previous validate-then-$inc flow over-redeems under
+the same load.
+
+Needs a MongoDB reachable at TEST_MONGO_URL (a throwaway database is used and dropped).
+
+Usage:
+    python coupon_redemption_test.py [checkouts] [max_uses]
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+import logging
+from datetime import datetime, timedelta
+
+from fake_stripe_server import start_fake_stripe
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+CHECKOUTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+MAX_USES = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+TEST_DB_NAME = "mystery_box_coupon_redemption_test"
+
+# Point the backend at the fake server before importing it
+fake_server, fake_state, fake_base_url = start_fake_stripe(latency_ms=50)
+os.environ["STRIPE_API_BASE"] = fake_base_url
+os.environ["STRIPE_SECRET_KEY"] = "sk_test_fake"
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+# Test results
+test_results = {}
+
+def log_test_result(test_name, success, message=""):
+    """Log test result and store in results dictionary"""
+    status = "PASSED" if success else "FAILED"
+    logger.info(f"{test_name}: {status} {message}")
+    test_results[test_name] = {"success": success, "message": message}
+    return success
+
+async def create_coupon(code, max_uses):
+    now = datetime.utcnow()
+    coupon = server.CouponCode(code=code, description="Teste", discount_type="percentage", discount_value=10,
+                               max_uses=max_uses, valid_from=now - timedelta(days=1),
+                               valid_until=now + timedelta(days=1), created_by="test")
+    await server.db.coupons.insert_one(coupon.dict())
+    return coupon
+
+async def create_cart(coupon_code):
+    cart = server.Cart(session_id=f"cart-{uuid.uuid4()}", items=[server.CartItem(product_id="p1", quantity=1)],
+                       coupon_code=coupon_code)
+    await server.db.carts.insert_one(cart.dict())
+    return cart.session_id
+
+async def checkout(cart_id, user):
+    request = server.CheckoutRequest(cart_id=cart_id, shipping_address="Rua das Flores 10, Lisboa", phone="912345678",
+                                     payment_method="stripe", origin_url="http://localhost:3000")
+    return await server.create_checkout(request, current_user=user, product_loader=server.ProductLoader())
+
+async def test_capped_coupon(user):
+    """Concurrent checkouts with one coupon: exactly max_uses succeed"""
+    await create_coupon("CAP", MAX_USES)
+    carts = [await create_cart("CAP") for _ in range(CHECKOUTS)]
+    results = await asyncio.gather(*(checkout(cart_id, user) for cart_id in carts), return_exceptions=True)
+
+    succeeded = [r for r in results if isinstance(r, dict)]
+    refused = [r for r in results if isinstance(r, server.HTTPException) and r.detail == "Cupão esgotado"]
+    coupon = await server.db.coupons.find_one({"code": "CAP"})
+    orders = await server.db.orders.count_documents({"coupon_code": "CAP"})
+
+    success = (len(succeeded) == MAX_USES and len(refused) == CHECKOUTS - MAX_USES
+               and coupon["current_uses"] == MAX_USES and orders == MAX_USES)
+    return log_test_result("Capped coupon under concurrent checkouts", success,
+                           f"{len(succeeded)} succeeded, {len(refused)} refused, current_uses={coupon['current_uses']}, "
+                           f"orders={orders}")
+
+async def test_failed_session_releases_use(user):
+    """A checkout whose Stripe session cannot be created does not consume a use"""
+    await create_coupon("RELEASE", 1)
+    cart_id = await create_cart("RELEASE")
+    fake_state.fail_rate = 1.0
+    try:
+        await checkout(cart_id, user)
+        failed = False
+    except Exception:
+        failed = True
+    finally:
+        fake_state.fail_rate = 0.0
+    released = (await server.db.coupons.find_one({"code": "RELEASE"}))["current_uses"]
+
+    result = await checkout(cart_id, user)
+    used = (await server.db.coupons.find_one({"code": "RELEASE"}))["current_uses"]
+    success = failed and released == 0 and "order_id" in result and used == 1
+    return log_test_result("Failed session releases the coupon use", success, f"after failure {released}, after retry {used}")
+
+async def test_failure_after_session_releases_use(user):
+    """A checkout failing after the Stripe session gives its use back once, expiry included"""
+    def fail(*args, **kwargs):
+        raise RuntimeError("database unavailable")
+
+    released = []
+    for name in ("PaymentTransaction", "record_order_created"):  # Before and after the order insert
+        code = f"LATE{len(released)}"
+        await create_coupon(code, 1)
+        original = getattr(server, name)
+        setattr(server, name, fail)
+        try:
+            await checkout(await create_cart(code), user)
+        except RuntimeError:
+            pass
+        finally:
+            setattr(server, name, original)
+        # Stripe later expires the abandoned session
+        order = await server.db.orders.find_one({"coupon_code": code})
+        if order:
+            await server.close_unpaid_checkout(order["stripe_session_id"], order["id"], "expired")
+        released.append((await server.db.coupons.find_one({"code": code}))["current_uses"])
+
+    success = released == [0, 0]
+    return log_test_result("Failure after the session releases the coupon use once", success, f"current_uses {released}")
+
+async def test_legacy_over_redemption():
+    """Reference: validate with find_one, then a separate $inc"""
+    await create_coupon("LEGACY", MAX_USES)
+
+    async def legacy_redeem():
+        coupon = await server.db.coupons.find_one({"code": "LEGACY", "is_active": True})
+        if coupon["max_uses"] and coupon["current_uses"] >= coupon["max_uses"]:
+            return False
+        await asyncio.sleep(0.05)  # Stripe session creation happened in between
+        await server.db.coupons.update_one({"code": "LEGACY"}, {"$inc": {"current_uses": 1}})
+        return True
+
+    results = await asyncio.gather(*(legacy_redeem() for _ in range(CHECKOUTS)))
+    coupon = await server.db.coupons.find_one({"code": "LEGACY"})
+    logger.info(f"Validate-then-$inc redeemed {sum(results)} times with max_uses={MAX_USES} "
+                f"(current_uses={coupon['current_uses']})")
+
+def run_coupon_redemption_tests():
+    """Run coupon redemption tests"""
+    logger.info(f"Starting coupon redemption tests ({CHECKOUTS} checkouts, max_uses={MAX_USES})")
+    client = server.AsyncIOMotorClient(os.environ["MONGO_URL"])
+    original_db = server.db
+    user = server.User(email="cliente@example.com", name="Cliente")
+
+    async def run_all():
+        server.db = client[TEST_DB_NAME]
+        await client.drop_database(TEST_DB_NAME)
+        await server.db.coupons.create_index([("code", 1)], unique=True)
+        await server.db.products.insert_one({"id": "p1", "name": "Mystery Box", "category": "geek", "price": 29.99, "is_active": True})
+        await test_capped_coupon(user)
+        await test_failed_session_releases_use(user)
+        await test_failure_after_session_releases_use(user)
+        await test_legacy_over_redemption()
+        await client.drop_database(TEST_DB_NAME)
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        server.db = original_db
+        fake_server.shutdown()
+
+    # Print summary
+    logger.info("\n=== COUPON REDEMPTION TEST SUMMARY ===")
+    for test_name, result in test_results.items():
+        status = "✅ PASSED" if result["success"] else "❌ FAILED"
+        logger.info(f"{status}: {test_name}")
+
+    return test_results
+
+if __name__ == "__main__":
+    run_coupon_redemption_tests()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Dashboard stats test - a rebuild never double counts or loses concurrent order writes.
+
+Places orders through the backend's own writers (record_order_created, confirm_order_payment,
+update_order_status), then runs rebuild_dashboard_stats with an order created, paid or moved
+to another status between the rebuild's read of the counters and its aggregation. After each
+rebuild the stats document and the daily/monthly revenue rows must match what the orders
+collection says. Also checks that drifted counters are corrected and that a rebuild is refused
+while another one holds the lease.
+
+Needs a MongoDB reachable at TEST_MONGO_URL (a throwaway database is used and dropped).
+
+Usage:
+    python dashboard_stats_test.py
+"""
+
+import asyncio
+import os
+import sys
+import logging
+from datetime import datetime
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+os.environ["EMAIL_PROVIDER"] = "fake"
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+TEST_DB_NAME = "mystery_box_dashboard_stats_test"
+ADMIN = server.User(email="admin@example.com", name="Admin", is_admin=True)
+
+# Test results
+test_results = {}
+
+def log_test_result(test_name, success, message=""):
+    """Log test result and store in results dictionary"""
+    status = "PASSED" if success else "FAILED"
+    logger.info(f"{test_name}: {status} {message}")
+    test_results[test_name] = {"success": success, "message": message}
+    return success
+
+class InterleavedCursor:
+    def __init__(self, database, collection, pipeline):
+        self.database = database
+        self.collection = collection
+        self.pipeline = pipeline
+
+    async def to_list(self, length):
+        await self.database.run_interleaved_write()
+        return await self.collection.aggregate(self.pipeline).to_list(length)
+
+class InterleavedOrders:
+    """orders collection whose next aggregation first runs a concurrent write"""
+
+    def __init__(self, database, collection):
+        self.database = database
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def aggregate(self, pipeline):
+        return InterleavedCursor(self.database, self.collection, pipeline)
+
+class InterleavedDatabase:
+    """Database whose orders aggregation runs a write after the rebuild has read the counters"""
+
+    def __init__(self, database):
+        self.database = database
+        self.write = None
+
+    def __getattr__(self, name):
+        collection = getattr(self.database, name)
+        return InterleavedOrders(self, collection) if name == "orders" else collection
+
+    async def run_interleaved_write(self):
+        write, self.write = self.write, None
+        if write:
+            await asyncio.sleep(0.01)  # Stored dates have millisecond precision
+            await write()
+
+async def place_order(total_amount, paid=False):
+    """A new order counted the way checkout and subscription deliveries count it"""
+    order = server.Order(session_id=f"cart-{datetime.utcnow().timestamp()}", items=[], subtotal=total_amount, vat_amount=0,
+                         shipping_cost=0, total_amount=total_amount, shipping_address="Rua das Flores 10, Lisboa",
+                         phone="912345678", payment_method="stripe").dict()
+    if paid:
+        order.update({"payment_status": "paid", "order_status": "confirmed"})
+    await server.db.orders.insert_one(order)
+    await server.record_order_created(order)
+    return order["id"]
+
+async def expected_stats():
+    """Counters computed straight from the orders collection"""
+    orders = await server.db.orders.find().to_list(None)
+    by_status = {}
+    daily = {}
+    for order in orders:
+        by_status[order["order_status"]] = by_status.get(order["order_status"], 0) + 1
+        if order["payment_status"] == "paid":
+            day = server.revenue_periods(order.get("paid_at") or order["created_at"])[0]
+            row = daily.setdefault(day, {"revenue": 0.0, "orders": 0})
+            row["revenue"] = round(row["revenue"] + order["total_amount"], 2)
+            row["orders"] += 1
+    return {
+        "total_orders": len(orders),
+        "paid_orders": sum(row["orders"] for row in daily.values()),
+        "total_revenue": round(sum(row["revenue"] for row in daily.values()), 2),
+        "orders_by_status": by_status,
+        "daily": daily
+    }
+
+async def stored_stats():
+    stats = await server.db.stats.find_one({"_id": server.DASHBOARD_STATS_ID}) or {}
+    daily = await server.db.revenue_daily.find().to_list(None)
+    return {
+        "total_orders": stats.get("total_orders", 0),
+        "paid_orders": stats.get("paid_orders", 0),
+        "total_revenue": round(stats.get("total_revenue", 0), 2),
+        "orders_by_status": {status: count for status, count in stats.get("orders_by_status", {}).items() if count},
+        "daily": {row["_id"]: {"revenue": round(row["revenue"], 2), "orders": row["orders"]} for row in daily}
+    }
+
+async def check_rebuild(name, write=None):
+    """Rebuild with an optional write between the counters read and the aggregation"""
+    server.db.write = write
+    await server.rebuild_dashboard_stats()
+    expected, stored = await expected_stats(), await stored_stats()
+    return log_test_result(name, stored == expected, f"stored {stored}, expected {expected}")
+
+async def test_order_created_during_rebuild():
+    async def write():
+        await place_order(30.0, paid=True)
+    return await check_rebuild("Order created during rebuild", write)
+
+async def test_payment_during_rebuild():
+    order_id = await place_order(20.0)
+
+    async def write():
+        await server.confirm_order_payment(f"cs_{order_id}", order_id)
+    return await check_rebuild("Payment confirmed during rebuild", write)
+
+async def test_status_change_during_rebuild():
+    order_id = await place_order(15.0, paid=True)
+
+    async def write():
+        await server.update_order_status(order_id, "shipped", admin_user=ADMIN)
+    return await check_rebuild("Status changed during rebuild", write)
+
+async def test_drift_corrected():
+    await server.db.stats.update_one({"_id": server.DASHBOARD_STATS_ID},
+                                     {"$inc": {"total_orders": 7, "total_revenue": 99.0, "orders_by_status.cancelled": 2}})
+    await server.db.revenue_daily.insert_one({"_id": "2001-01-01", "revenue": 10.0, "orders": 1})
+    return await check_rebuild("Drifted counters corrected")
+
+async def test_rebuild_lease():
+    await server.scheduler.acquire_lease(server.DASHBOARD_REBUILD_LEASE, 60, owner="other-worker")
+    refused = await server.rebuild_dashboard_stats()
+    await server.scheduler.release_lease(server.DASHBOARD_REBUILD_LEASE, owner="other-worker")
+    return log_test_result("Concurrent rebuild refused", refused is None, f"rebuild returned {refused}")
+
+def run_dashboard_stats_tests():
+    """Run dashboard stats tests"""
+    logger.info("Starting dashboard stats tests")
+    client = server.AsyncIOMotorClient(os.environ["MONGO_URL"])
+    original_db = server.db
+
+    async def run_all():
+        server.db = InterleavedDatabase(client[TEST_DB_NAME])
+        await client.drop_database(TEST_DB_NAME)
+        for total_amount, paid in ((10.0, False), (25.0, True), (40.0, True)):
+            await place_order(total_amount, paid)
+        await check_rebuild("Initial rebuild")
+        await test_order_created_during_rebuild()
+        await test_payment_during_rebuild()
+        await test_status_change_during_rebuild()
+        await test_drift_corrected()
+        await test_rebuild_lease()
+        await client.drop_database(TEST_DB_NAME)
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        server.db = original_db
+
+    # Print summary
+    logger.info("\n=== DASHBOARD STATS TEST SUMMARY ===")
+    for test_name, result in test_results.items():
+        status = "✅ PASSED" if result["success"] else "❌ FAILED"
+        logger.info(f"{status}: {test_name}")
+
+    return test_results
+
+if __name__ == "__main__":
+    run_dashboard_stats_tests()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Email campaign load test - offline, with the fake email provider.
+
+Creates users, queues a discount campaign for a segment and lets the campaign sender
+deliver it through the fake provider's batch endpoint with a provider-side rate limit and
+injected failures. Checks that every recipient ends up sent (or failed after retries),
+that nobody got the email twice, that only the segment was targeted and that the
+throttle kept the sender under the provider's rate limit.
+
+Needs a MongoDB reachable at TEST_MONGO_URL (a throwaway database is used and dropped).
+
+Usage:
+    python email_campaign_load_test.py [users] [requests_per_second] [failure_rate]
+"""
+
+import asyncio
+import os
+import sys
+import time
+import logging
+from datetime import datetime
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+REQUESTS_PER_SECOND = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+FAILURE_RATE = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+TEST_DB_NAME = "mystery_box_campaign_load_test"
+
+async def run_load_test(database):
+    server.db = database
+    for name in ("users", "orders", "email_campaigns", "email_campaign_recipients"):
+        await database[name].drop()
+    await database.email_campaign_recipients.create_index([("campaign_id", 1), ("user_id", 1)], unique=True)
+    await database.email_campaign_recipients.create_index([("campaign_id", 1), ("status", 1)])
+
+    # Every third user already ordered, so the "no_orders" segment is two thirds of the users
+    await database.users.insert_many([
+        {"id": f"u{i}", "email": f"user{i}@example.com", "name": f"Cliente {i}", "created_at": datetime.utcnow()}
+        for i in range(USERS)
+    ])
+    await database.orders.insert_many([{"id": f"o{i}", "user_id": f"u{i}"} for i in range(0, USERS, 3)])
+    segment_size = USERS - len(range(0, USERS, 3))
+
+    # The provider allows one request more per second than the sender is configured for
+    provider = server.FakeEmailProvider(latency_ms=100, failure_rate=FAILURE_RATE, requests_per_second=REQUESTS_PER_SECOND + 1)
+    sender = server.CampaignSender(provider, requests_per_second=REQUESTS_PER_SECOND)
+    sender.retry_seconds = 0.2
+    server.campaign_sender = sender
+    logger.info(f"Email campaign load test: {USERS} users, {REQUESTS_PER_SECOND} req/s, failure rate {FAILURE_RATE}")
+
+    start = time.perf_counter()
+    campaign = await sender.create_campaign(server.EmailCampaignCreate(
+        template="discount", segment="no_orders", coupon_code="VOLTA15", discount_value=15, expiry_date="31/12/2026"
+    ))
+    queue_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await sender.run_pending()
+    elapsed = time.perf_counter() - start
+
+    stored = await database.email_campaigns.find_one({"id": campaign["id"]})
+    sent = await database.email_campaign_recipients.count_documents({"campaign_id": campaign["id"], "status": "sent"})
+    failed = await database.email_campaign_recipients.count_documents({"campaign_id": campaign["id"], "status": "failed"})
+    recipients = [message["to"][0] for message in provider.sent]
+    customers = {f"user{i}@example.com" for i in range(0, USERS, 3)}
+    personalised = all(message["html"].count("Cliente ") >= 1 for message in provider.sent)
+
+    logger.info(f"Queued {campaign['total']} recipients in {queue_time:.2f}s")
+    logger.info(f"Sent {sent} emails ({failed} failed) in {provider.batch_calls} batch calls, {elapsed:.2f}s "
+                f"({sent / elapsed:.0f} emails/s, {provider.batch_calls / elapsed:.1f} req/s)")
+    logger.info(f"Sender stats: {sender.stats()}, provider rate-limit rejections: {provider.rate_limited}")
+
+    success = (
+        campaign["total"] == segment_size and stored["status"] == "completed"
+        and sent + failed == segment_size and stored["sent"] == sent and stored["failed"] == failed
+        and len(recipients) == len(set(recipients)) == sent
+        and not customers.intersection(recipients) and personalised
+    )
+    logger.info(f"\n=== EMAIL CAMPAIGN LOAD TEST: {'✅ PASSED' if success else '❌ FAILED'} === sent={sent} failed={failed}")
+    for name in ("users", "orders", "email_campaigns", "email_campaign_recipients"):
+        await database[name].drop()
+    return success
+
+if __name__ == "__main__":
+    client = server.AsyncIOMotorClient(os.environ["MONGO_URL"])
+    asyncio.run(run_load_test(client[TEST_DB_NAME]))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Email outbox load test - offline, with the fake email provider.
+
+Compares what a request handler pays to send an email inline versus queueing it in
+the outbox, then drains the queue with the background worker pool and checks that
+every message ends up sent (or dead-lettered), that retries happened for injected
+provider failures, and that repeated idempotency keys were not queued twice.
+
+Needs a MongoDB reachable at TEST_MONGO_URL (a throwaway database is used and dropped).
+
+Usage:
+    python email_outbox_load_test.py [emails] [provider_latency_ms] [failure_rate]
+"""
+
+import asyncio
+import os
+import sys
+import time
+import statistics
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+EMAILS = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+LATENCY_MS = float(sys.argv[2]) if len(sys.argv) > 2 else 300
+FAILURE_RATE = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+TEST_DB_NAME = "mystery_box_outbox_load_test"
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summary(latencies):
+    return {"p50_ms": round(statistics.median(latencies), 2), "p99_ms": round(percentile(latencies, 99), 2)}
+
+async def run_load_test(database):
+    server.db = database
+    await database.email_outbox.drop()
+    await database.email_outbox.create_index([("idempotency_key", 1)], unique=True)
+    await database.email_outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+
+    provider = server.FakeEmailProvider(latency_ms=LATENCY_MS, failure_rate=FAILURE_RATE)
+    server.email_provider = provider
+    outbox = server.EmailOutbox(provider, workers=server.EMAIL_WORKERS, max_attempts=4, retry_base_seconds=0.05)
+    server.email_outbox = outbox
+    logger.info(f"Email outbox load test: {EMAILS} emails, provider latency {LATENCY_MS} ms, failure rate {FAILURE_RATE}")
+
+    # What a handler paid before: waiting on the provider inline (sample of 20)
+    provider.failure_rate = 0.0
+    inline = []
+    for i in range(20):
+        start = time.perf_counter()
+        await server.send_email(f"inline{i}@example.com", "Teste", "<p>Olá</p>")
+        inline.append((time.perf_counter() - start) * 1000)
+    provider.failure_rate = FAILURE_RATE
+
+    # What a handler pays now: one outbox insert
+    queued = []
+    for i in range(EMAILS):
+        start = time.perf_counter()
+        await server.send_email(f"user{i}@example.com", "Bem-vindo", "<p>Olá</p>", queue=True, idempotency_key=f"welcome_{i}")
+        queued.append((time.perf_counter() - start) * 1000)
+
+    # Retried requests (double submit, repeated payment polls) must not queue twice
+    for i in range(0, EMAILS, 10):
+        await server.send_email(f"user{i}@example.com", "Bem-vindo", "<p>Olá</p>", queue=True, idempotency_key=f"welcome_{i}")
+
+    start = time.perf_counter()
+    outbox.start()
+    while True:
+        remaining = await database.email_outbox.count_documents({"status": {"$in": ["pending", "sending"]}})
+        if remaining == 0:
+            break
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    outbox.stop()
+
+    sent = await database.email_outbox.count_documents({"status": "sent"})
+    dead = await database.email_outbox.count_documents({"status": "dead"})
+    unique_recipients = len({message["to"][0] for message in provider.sent if message["to"][0].startswith("user")})
+
+    logger.info(f"Inline send latency: {summary(inline)}")
+    logger.info(f"Outbox enqueue latency: {summary(queued)}")
+    logger.info(f"Drained {sent + dead} emails in {elapsed:.2f}s ({(sent + dead) / elapsed:.1f}/s with {outbox.workers} workers)")
+    logger.info(f"Outbox stats: {outbox.stats()}, provider attempts: {provider.attempts}")
+
+    success = sent + dead == EMAILS and outbox.duplicates == len(range(0, EMAILS, 10)) and unique_recipients == sent
+    logger.info(f"\n=== EMAIL OUTBOX LOAD TEST: {'✅ PASSED' if success else '❌ FAILED'} === sent={sent} dead={dead}")
+    await database.email_outbox.drop()
+    return success
+
+if __name__ == "__main__":
+    client = server.AsyncIOMotorClient(os.environ["MONGO_URL"])
+    asyncio.run(run_load_test(client[TEST_DB_NAME]))
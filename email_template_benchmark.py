@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Email template benchmark - per-render cost of the transactional email templates.
+
+Compares the old approaches (a Jinja2 Template compiled from the HTML literal on every send,
+as the discount/birthday emails did, and the str.replace chain plus string concatenation used
+by the order confirmation email) with the compiled, cached templates of the backend's
+EmailTemplates. Also checks that user-supplied fields are autoescaped in the HTML body.
+
+Usage:
+    python email_template_benchmark.py [renders] [order_items]
+"""
+
+import os
+import sys
+import time
+import statistics
+import logging
+from datetime import datetime
+
+from jinja2 import Template
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+RENDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+ORDER_ITEMS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+def read_template(name):
+    with open(server.EMAIL_TEMPLATES_DIR / name, encoding="utf-8") as f:
+        return f.read()
+
+def sample_order():
+    items = [server.CartItem(product_id=f"p{i}", quantity=1 + i % 3) for i in range(ORDER_ITEMS)]
+    products = [{"id": f"p{i}", "name": f"Mystery Box {i}", "description": "Uma caixa cheia de surpresas",
+                 "category": "geek", "price": 19.99 + i} for i in range(ORDER_ITEMS)]
+    order = server.Order(
+        user_id="u1", session_id="s1", items=items, subtotal=120.0, vat_amount=4.96, shipping_cost=4.99,
+        total_amount=129.95, shipping_address="Rua das Flores 10, 1000-100 Lisboa", phone="912345678",
+        payment_method="card", shipping_method="standard", created_at=datetime.utcnow()
+    )
+    return order, products
+
+def legacy_discount(source):
+    """Old discount/birthday emails: the template is parsed and compiled on every send"""
+    return Template(source).render(user_name="Ana Silva", discount_text="15% OFF",
+                                   coupon_code="PROMO15", expiry_date="31/12/2026")
+
+def legacy_order(source, order, products):
+    """Old order email: row HTML concatenated in a loop plus a str.replace chain"""
+    products_html = ""
+    for item in order.items:
+        product = next((p for p in products if p["id"] == item.product_id), None)
+        if product:
+            total_price = product.get("price", 0) * item.quantity
+            products_html += f"""
+            <div class="product-item">
+                <div class="product-emoji">🎮</div>
+                <div class="product-info">
+                    <div class="product-name">{product.get("name", "Produto")}</div>
+                    <div style="color: #666; font-size: 14px;">{product.get("description", "")}</div>
+                    <div style="margin-top: 5px;">
+                        <span style="color: #666;">Quantidade: {item.quantity}</span>
+                        <span class="product-price" style="float: right;">€{total_price:.2f}</span>
+                    </div>
+                </div>
+            </div>
+            """
+    html = source.replace("{{ order_id }}", order.id[:8])
+    html = html.replace("{{ order_status }}", order.order_status.title())
+    html = html.replace("{{ order_date }}", order.created_at.strftime("%d/%m/%Y às %H:%M"))
+    html = html.replace("{{ payment_method }}", order.payment_method.title())
+    html = html.replace("{{ shipping_method }}", order.shipping_method.title())
+    html = html.replace("{{ products_list }}", products_html)
+    html = html.replace("{{ total_amount }}", f"{order.total_amount:.2f}")
+    html = html.replace("{{ customer_name }}", "Ana Silva")
+    html = html.replace("{{ shipping_address }}", order.shipping_address)
+    return html.replace("{{ phone }}", order.phone)
+
+def order_context(order, products):
+    return dict(order_id=order.id[:8], order_status=order.order_status.title(),
+                order_date=order.created_at.strftime("%d/%m/%Y às %H:%M"),
+                payment_method=order.payment_method.title(), shipping_method=order.shipping_method.title(),
+                items=server.order_email_items(order, products), total_amount=order.total_amount,
+                customer_name="Ana Silva", shipping_address=order.shipping_address, phone=order.phone)
+
+def measure(name, render):
+    timings = []
+    for _ in range(RENDERS):
+        start = time.perf_counter()
+        render()
+        timings.append((time.perf_counter() - start) * 1_000_000)
+    result = {"mean_us": round(statistics.mean(timings), 1), "p50_us": round(statistics.median(timings), 1),
+              "renders_per_s": round(1_000_000 / statistics.mean(timings))}
+    logger.info(f"{name}: {result}")
+    return result
+
+def check_autoescape():
+    html, text = server.email_templates.render("welcome", user_name='<script>alert("x")</script>')
+    return "<script>" not in html and "&lt;script&gt;" in html and '<script>alert("x")</script>' in text
+
+def main():
+    logger.info(f"Email template benchmark: {RENDERS} renders per scenario, {ORDER_ITEMS} order items")
+    discount_source = read_template("discount.html")
+    # The old order template had a {{ products_list }} slot where the loop now is
+    order_source = read_template("order_confirmation.html")
+    loop = order_source[order_source.index("{% for"):order_source.index("{% endfor %}") + len("{% endfor %}")]
+    order_source = order_source.replace(loop, "{{ products_list }}")
+    order, products = sample_order()
+    templates = server.email_templates
+
+    discount_legacy = measure("Discount - Template() compiled per send", lambda: legacy_discount(discount_source))
+    discount_cached = measure("Discount - compiled template (html + text)", lambda: templates.render(
+        "discount", user_name="Ana Silva", discount_text="15% OFF", coupon_code="PROMO15", expiry_date="31/12/2026"))
+    order_legacy = measure("Order - str.replace chain", lambda: legacy_order(order_source, order, products))
+    order_cached = measure("Order - compiled template (html + text)", lambda: templates.render(
+        "order_confirmation", **order_context(order, products)))
+
+    escaped = check_autoescape()
+
+    logger.info("\n=== EMAIL TEMPLATE BENCHMARK SUMMARY ===")
+    logger.info(f"Discount email: {discount_legacy['mean_us']} us -> {discount_cached['mean_us']} us per render "
+                f"({discount_legacy['mean_us'] / discount_cached['mean_us']:.0f}x)")
+    logger.info(f"Order email: {order_legacy['mean_us']} us -> {order_cached['mean_us']} us per render")
+    logger.info(f"{'✅' if escaped else '❌'} User-supplied fields autoescaped in HTML, kept verbatim in text")
+
+if __name__ == "__main__":
+    main()
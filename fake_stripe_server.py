@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Fake Stripe API server for offline checkout benchmarks and tests.
+
+Implements the handful of endpoints the backend uses (checkout sessions, payment intents,
+customers, billing portal, subscriptions, products) with a configurable response latency
+and failure rate, and replays responses for repeated Idempotency-Key headers like Stripe.
+
+Usage:
+    python fake_stripe_server.py [--port 12111] [--latency-ms 150] [--fail-rate 0.0]
+
+Then start the backend with STRIPE_API_BASE=http://localhost:12111
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+class FakeStripeState:
+    def __init__(self, latency_ms: float = 150, fail_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.customers = {}
+        self.idempotent_responses = {}
+        self.requests = 0
+        self.failures = 0
+        self.replays = 0
+
+def parse_form(body: str) -> dict:
+    """Decode stripe's form encoding (metadata[key]=value, line_items[0][quantity]=1)"""
+    params = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = re.findall(r"[^\[\]]+", key)
+        target = params
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return params
+
+def line_items_total(params: dict) -> int:
+    total = 0
+    for item in params.get("line_items", {}).values():
+        unit_amount = int(item.get("price_data", {}).get("unit_amount", 0))
+        total += unit_amount * int(item.get("quantity", 1))
+    return total
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so client connection reuse is visible
+    state: FakeStripeState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self, path: str):
+        self.send_json(404, {"error": {"type": "invalid_request_error", "message": f"No such resource: {path}"}})
+
+    def handle_request(self, method: str):
+        state = self.state
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else ""
+        url = urlparse(self.path)
+        params = parse_form(body if method == "POST" else url.query)
+
+        with state.lock:
+            state.requests += 1
+        time.sleep(state.latency_ms / 1000)
+
+        idempotency_key = self.headers.get("Idempotency-Key")
+        if method == "POST" and idempotency_key:
+            with state.lock:
+                replay = state.idempotent_responses.get(idempotency_key)
+                if replay:
+                    state.replays += 1
+            if replay:
+                return self.send_json(*replay)
+
+        if state.fail_rate and random.random() < state.fail_rate:
+            with state.lock:
+                state.failures += 1
+            return self.send_json(503, {"error": {"type": "api_error", "message": "Fake Stripe: service unavailable"}})
+
+        status, payload = self.route(method, url.path, params)
+        if payload is None:
+            return self.not_found(url.path)
+        if method == "POST" and idempotency_key:
+            with state.lock:
+                state.idempotent_responses[idempotency_key] = (status, payload)
+        self.send_json(status, payload)
+
+    def route(self, method: str, path: str, params: dict):
+        state = self.state
+        if method == "POST" and path == "/v1/checkout/sessions":
+            session_id = f"cs_test_{uuid.uuid4().hex}"
+            session = {
+                "id": session_id,
+                "object": "checkout.session",
+                "url": f"https://checkout.stripe.com/c/pay/{session_id}",
+                "mode": params.get("mode", "payment"),
+                "payment_status": "unpaid",
+                "status": "open",
+                "amount_total": line_items_total(params),
+                "currency": "eur",
+                "customer": params.get("customer"),
+                "customer_details": None,
+                "payment_intent": None,
+                "metadata": params.get("metadata", {})
+            }
+            with state.lock:
+                state.sessions[session_id] = session
+            return 200, session
+
+        match = re.fullmatch(r"/v1/checkout/sessions/([^/]+)", path)
+        if method == "GET" and match:
+            return 200, state.sessions.get(match.group(1))
+
+        match = re.fullmatch(r"/v1/payment_intents/([^/]+)", path)
+        if method == "GET" and match:
+            return 200, {"id": match.group(1), "object": "payment_intent", "status": "succeeded"}
+
+        if method == "POST" and path == "/v1/customers":
+            customer = {"id": f"cus_{uuid.uuid4().hex[:14]}", "object": "customer",
+                        "email": params.get("email"), "metadata": params.get("metadata", {})}
+            with state.lock:
+                state.customers[customer["id"]] = customer
+            return 200, customer
+
+        match = re.fullmatch(r"/v1/customers/([^/]+)", path)
+        if method == "GET" and match:
+            return 200, state.customers.get(match.group(1))
+
+        if method == "POST" and path == "/v1/billing_portal/sessions":
+            return 200, {"id": f"bps_{uuid.uuid4().hex[:14]}", "object": "billing_portal.session",
+                         "url": "https://billing.stripe.com/p/session/test"}
+
+        if method == "GET" and path == "/v1/subscriptions":
+            return 200, {"object": "list", "data": [], "has_more": False, "url": "/v1/subscriptions"}
+
+        match = re.fullmatch(r"/v1/products/([^/]+)", path)
+        if method == "GET" and match:
+            return 200, {"id": match.group(1), "object": "product", "name": "Mystery Box"}
+
+        return 404, None
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+def start_fake_stripe(port: int = 0, latency_ms: float = 150, fail_rate: float = 0.0):
+    """Start the fake server on a background thread; returns (server, state, base_url)"""
+    state = FakeStripeState(latency_ms=latency_ms, fail_rate=fail_rate)
+    handler = type("BoundFakeStripeHandler", (FakeStripeHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://127.0.0.1:{server.server_address[1]}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Stripe API server")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency-ms", type=float, default=150)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, state, base_url = start_fake_stripe(args.port, args.latency_ms, args.fail_rate)
+    print(f"Fake Stripe listening on {base_url} (latency {args.latency_ms} ms, fail rate {args.fail_rate})")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -244,8 +244,21 @@ const Header = () => {
       };
 
       loadPendingChats();
-      const interval = setInterval(loadPendingChats, 30000);
-      return () => clearInterval(interval);
+
+      // Chat events are pushed by the server; a slow poll remains as a safety net
+      const token = localStorage.getItem('token');
+      const events = window.EventSource && token
+        ? new EventSource(`${API}/events/admin/chat?token=${encodeURIComponent(token)}`)
+        : null;
+      if (events) {
+        events.addEventListener('session', loadPendingChats);
+        events.addEventListener('status', loadPendingChats);
+      }
+      const interval = setInterval(loadPendingChats, events ? 120000 : 30000);
+      return () => {
+        clearInterval(interval);
+        if (events) events.close();
+      };
     }
   }, [user]);
 
@@ -1517,6 +1530,7 @@ const UserProfile = () => {
 const AdminOrders = () => {
   const { user } = useDeviceContext();
   const [orders, setOrders] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
   const navigate = useNavigate();
 
@@ -1528,10 +1542,13 @@ const AdminOrders = () => {
     loadOrders();
   }, [user, navigate]);
 
-  const loadOrders = async () => {
+  const loadOrders = async (cursor = null) => {
     try {
-      const response = await axios.get(`${API}/admin/orders`);
-      setOrders(response.data);
+      const response = await axios.get(`${API}/admin/orders`, {
+        params: cursor ? { cursor } : {}
+      });
+      setOrders(cursor ? [...orders, ...response.data] : response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
       console.error('Error loading orders:', error);
     } finally {
@@ -1617,6 +1634,16 @@ const AdminOrders = () => {
                 </tbody>
               </table>
             </div>
+            {nextCursor && (
+              <div className="text-center py-4">
+                <button
+                  onClick={() => loadOrders(nextCursor)}
+                  className="bg-purple-600 hover:bg-purple-700 text-white px-4 py-2 rounded-lg"
+                >
+                  Carregar mais pedidos
+                </button>
+              </div>
+            )}
           </div>
         )}
       </div>
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Generate a batch of unique coupon codes and export them to CSV.
+
+Same generator as POST /api/admin/coupons/batches: codes are drawn collision-free in memory,
+written with unordered insert_many chunks and recorded in coupon_batches, so the batch also
+shows up (and can be exported again) in the admin API.
+
+Usage:
+    python generate_coupons.py --quantity 50000 --prefix NATAL --discount 10 --days 30
+    python generate_coupons.py --quantity 500 --prefix VIP --discount 5 --type fixed --max-uses 1 --output vip.csv
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv('backend/.env')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+from fastapi import HTTPException  # noqa: E402
+from server import (  # noqa: E402
+    client, CouponBatchCreate, validate_coupon_batch, create_coupon_batch, run_coupon_batch, coupon_batch_csv
+)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate unique coupon codes")
+    parser.add_argument("--quantity", type=int, required=True)
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--length", type=int, default=8, help="random characters after the prefix")
+    parser.add_argument("--discount", type=float, required=True)
+    parser.add_argument("--type", choices=["percentage", "fixed"], default="percentage")
+    parser.add_argument("--description", default=None)
+    parser.add_argument("--min-order", type=float, default=None)
+    parser.add_argument("--max-uses", type=int, default=1)
+    parser.add_argument("--days", type=int, default=30, help="valid from now for this many days")
+    parser.add_argument("--output", default=None, help="CSV file (default: cupoes_<prefix>_<batch>.csv)")
+    return parser.parse_args()
+
+async def generate_coupons(args):
+    now = datetime.utcnow()
+    batch_data = CouponBatchCreate(
+        quantity=args.quantity,
+        prefix=args.prefix,
+        code_length=args.length,
+        description=args.description or f"Cupão {args.prefix or 'campanha'}",
+        discount_type=args.type,
+        discount_value=args.discount,
+        min_order_value=args.min_order,
+        max_uses=args.max_uses,
+        valid_from=now,
+        valid_until=now + timedelta(days=args.days)
+    )
+    try:
+        validate_coupon_batch(batch_data)
+    except HTTPException as e:
+        print(f"❌ {e.detail}")
+        return
+
+    batch = await create_coupon_batch(batch_data, created_by="cli")
+    print(f"🎫 Generating {batch['quantity']} coupons (batch {batch['id']})...")
+    start = time.perf_counter()
+
+    def progress(created, quantity):
+        print(f"\r   {created}/{quantity} ({created / quantity:.0%})", end="", flush=True)
+
+    batch = await run_coupon_batch(batch, progress=progress)
+    elapsed = time.perf_counter() - start
+    print()
+    if batch["status"] != "completed":
+        print(f"❌ Batch failed after {batch['created']} coupons: {batch['error']}")
+        return
+    print(f"✅ {batch['created']} coupons created in {elapsed:.1f}s ({batch['created'] / elapsed:.0f}/s)")
+
+    output = args.output or f"cupoes_{batch['prefix'].strip('-') or 'lote'}_{batch['id'][:8]}.csv"
+    with open(output, "w", encoding="utf-8", newline="") as f:
+        async for chunk in coupon_batch_csv(batch["id"]):
+            f.write(chunk)
+    print(f"📄 Codes exported to {output}")
+
+async def main():
+    await generate_coupons(parse_args())
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import sys
+import time
+import logging
+
+import aiohttp
+import rsa
+from fastapi import HTTPException
+from jose import jwk, jwt
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Import the backend in-process; Google's key set is replaced by locally generated keys
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+CLIENT_ID = "test-client.apps.googleusercontent.com"
+
+# Test results
+test_results = {}
+
+def log_test_result(test_name, success, message=""):
+    """Log test result and store in results dictionary"""
+    status = "PASSED" if success else "FAILED"
+    logger.info(f"{test_name}: {status} {message}")
+    test_results[test_name] = {"success": success, "message": message}
+    return success
+
+def generate_signing_key(kid):
+    """(private PEM, public JWK) of a fresh RSA key"""
+    public_key, private_key = rsa.newkeys(2048)
+    public_jwk = jwk.construct(public_key.save_pkcs1().decode(), "RS256").to_dict()
+    public_jwk.update({"kid": kid, "use": "sig", "alg": "RS256"})
+    return private_key.save_pkcs1().decode(), public_jwk
+
+def google_token(private_pem, kid, audience=CLIENT_ID, issuer="https://accounts.google.com", expires_in=3600):
+    now = int(time.time())
+    claims = {"iss": issuer, "aud": audience, "sub": "1234567890", "email": "cliente@example.com",
+              "name": "Cliente", "picture": "", "iat": now, "exp": now + expires_in}
+    return jwt.encode(claims, private_pem, algorithm="RS256", headers={"kid": kid})
+
+class FakeJwksVerifier(server.GoogleTokenVerifier):
+    """Serves a local key set instead of fetching Google's, counting fetches"""
+
+    def __init__(self, jwks, max_age=3600):
+        super().__init__(CLIENT_ID, jwks_url="http://unused.invalid")
+        self.served_jwks = jwks
+        self.max_age = max_age
+
+    async def fetch(self):
+        await asyncio.sleep(0.05)
+        if isinstance(self.served_jwks, Exception):
+            raise self.served_jwks
+        return self.served_jwks, self.max_age
+
+def rejects(verifier, token):
+    async def check():
+        try:
+            await verifier.verify(token)
+            return False
+        except ValueError:
+            return True
+    return check()
+
+async def test_local_verification():
+    """Valid tokens verify locally; wrong audience, issuer, expiry and signature are rejected"""
+    private_pem, public_jwk = generate_signing_key("k1")
+    other_pem, _ = generate_signing_key("k1")
+    verifier = server.GoogleTokenVerifier(CLIENT_ID, jwks={"keys": [public_jwk]})
+
+    claims = await verifier.verify(google_token(private_pem, "k1"))
+    rejected = [
+        await rejects(verifier, google_token(private_pem, "k1", audience="another-client")),
+        await rejects(verifier, google_token(private_pem, "k1", issuer="https://evil.example.com")),
+        await rejects(verifier, google_token(private_pem, "k1", expires_in=-60)),
+        await rejects(verifier, google_token(other_pem, "k1")),
+        await rejects(verifier, "not-a-token"),
+    ]
+
+    success = claims["email"] == "cliente@example.com" and all(rejected) and verifier.fetches == 0
+    return log_test_result("Local token verification", success, f"rejected {sum(rejected)}/5 bad tokens, {verifier.stats()}")
+
+async def test_keys_cached():
+    """Concurrent sign-ins share one key fetch; the key set is reused until max-age expires"""
+    private_pem, public_jwk = generate_signing_key("k1")
+    verifier = FakeJwksVerifier({"keys": [public_jwk]}, max_age=3600)
+
+    tokens = [google_token(private_pem, "k1") for _ in range(50)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(verifier.verify(token) for token in tokens))
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    cached_fetches = verifier.fetches
+
+    verifier.expires_at = time.monotonic() - 1  # max-age elapsed
+    await verifier.verify(tokens[0])
+
+    success = len(results) == 50 and cached_fetches == 1 and verifier.fetches == 2
+    return log_test_result("Key set caching", success, f"50 sign-ins in {elapsed_ms:.0f} ms with {cached_fetches} fetch")
+
+async def test_key_rotation():
+    """A token signed with a new key id triggers one refresh, rate limited afterwards"""
+    old_pem, old_jwk = generate_signing_key("old")
+    new_pem, new_jwk = generate_signing_key("new")
+    verifier = FakeJwksVerifier({"keys": [old_jwk]})
+    await verifier.verify(google_token(old_pem, "old"))
+
+    verifier.served_jwks = {"keys": [old_jwk, new_jwk]}
+    verifier.fetched_at -= server.GOOGLE_JWKS_MIN_REFRESH_INTERVAL
+    rotated = await verifier.verify(google_token(new_pem, "new"))
+    fetches_after_rotation = verifier.fetches
+
+    unknown_rejected = await rejects(verifier, google_token(new_pem, "unknown"))
+
+    success = rotated["sub"] == "1234567890" and fetches_after_rotation == 2 and unknown_rejected and verifier.fetches == 2
+    return log_test_result("Signing key rotation", success, f"{verifier.fetches} fetches")
+
+async def test_fetch_failure():
+    """An unreachable Google serves the cached keys, or 503 without any, and backs off"""
+    private_pem, public_jwk = generate_signing_key("k1")
+    verifier = FakeJwksVerifier({"keys": [public_jwk]})
+    await verifier.verify(google_token(private_pem, "k1"))
+
+    verifier.served_jwks = aiohttp.ClientConnectionError("Google unreachable")
+    verifier.expires_at = time.monotonic() - 1  # max-age elapsed
+    stale = [await verifier.verify(google_token(private_pem, "k1")) for _ in range(3)]
+
+    cold = FakeJwksVerifier(asyncio.TimeoutError())
+    statuses = []
+    for _ in range(3):
+        try:
+            await cold.verify(google_token(private_pem, "k1"))
+        except HTTPException as e:
+            statuses.append(e.status_code)
+
+    success = len(stale) == 3 and verifier.fetches == 2 and statuses == [503] * 3 and cold.fetches == 1
+    return log_test_result("Key fetch failure", success, f"stale keys served {len(stale)}x, without keys {statuses}, {verifier.stats()}")
+
+async def test_background_refresh():
+    """The refresh loop replaces the keys before they expire, never more often than the minimum interval"""
+    _, public_jwk = generate_signing_key("k1")
+    min_refresh_interval = server.GOOGLE_JWKS_MIN_REFRESH_INTERVAL
+    server.GOOGLE_JWKS_MIN_REFRESH_INTERVAL = 0.5
+    # max-age within the refresh margin: every key set is already due for refresh
+    verifier = FakeJwksVerifier({"keys": [public_jwk]}, max_age=server.GOOGLE_JWKS_REFRESH_MARGIN)
+    try:
+        await verifier.start()
+        await asyncio.sleep(1.6)
+        verifier.stop()
+    finally:
+        server.GOOGLE_JWKS_MIN_REFRESH_INTERVAL = min_refresh_interval
+
+    success = 2 <= verifier.fetches <= 4
+    return log_test_result("Background key refresh", success, f"{verifier.fetches} fetches in 1.6 s")
+
+def test_cache_control_parsing():
+    """max-age is read from Google's Cache-Control header"""
+    success = (
+        server.cache_control_max_age("public, max-age=19645, must-revalidate, no-transform") == 19645
+        and server.cache_control_max_age("no-cache") is None
+        and server.cache_control_max_age(None) is None
+    )
+    return log_test_result("Cache-Control max-age parsing", success)
+
+def run_google_token_verifier_tests():
+    """Run Google ID token verifier tests"""
+    logger.info("Starting Google token verifier tests")
+
+    async def run_all():
+        await test_local_verification()
+        await test_keys_cached()
+        await test_key_rotation()
+        await test_fetch_failure()
+        await test_background_refresh()
+
+    test_cache_control_parsing()
+    asyncio.run(run_all())
+
+    # Print summary
+    logger.info("\n=== GOOGLE TOKEN VERIFIER TEST SUMMARY ===")
+    for test_name, result in test_results.items():
+        status = "✅ PASSED" if result["success"] else "❌ FAILED"
+        logger.info(f"{status}: {test_name}")
+
+    return test_results
+
+if __name__ == "__main__":
+    run_google_token_verifier_tests()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Login storm benchmark - p99 latency of GET /api/products while bcrypt runs.
+
+Runs the API in-process and fires concurrent catalog requests during a burst of
+password verifications, once with bcrypt called inline on the event loop (the old
+behaviour) and once through the bounded password hashing pool.
+
+Usage:
+    python login_storm_benchmark.py [logins] [product_requests]
+"""
+
+import asyncio
+import os
+import sys
+import time
+import statistics
+import logging
+
+import httpx
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Import the backend in-process; the catalog is served from the snapshot, no database needed
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+LOGINS = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+PRODUCT_REQUESTS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def inline_login(password_hash):
+    """Old behaviour: bcrypt verification directly inside the async handler"""
+    return server.pwd_context.verify("wrong-password", password_hash)
+
+async def pooled_login(password_hash):
+    """New behaviour: verification on the bounded password hashing pool"""
+    return await server.verify_password("wrong-password", password_hash)
+
+async def run_scenario(name, login_func, password_hash):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        latencies = []
+
+        async def fetch_products():
+            start = time.perf_counter()
+            response = await client.get("/api/products")
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 200, response.status_code
+
+        async def login_storm():
+            # Logins keep arriving while customers browse
+            logins = []
+            for _ in range(LOGINS):
+                logins.append(asyncio.create_task(login_func(password_hash)))
+                await asyncio.sleep(0.01)
+            await asyncio.gather(*logins)
+
+        async def browsing():
+            requests = []
+            for _ in range(PRODUCT_REQUESTS):
+                requests.append(asyncio.create_task(fetch_products()))
+                await asyncio.sleep(0.01)
+            await asyncio.gather(*requests)
+
+        start = time.perf_counter()
+        await asyncio.gather(login_storm(), browsing())
+        elapsed = time.perf_counter() - start
+
+    result = {
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(max(latencies), 2),
+        "elapsed_s": round(elapsed, 2)
+    }
+    logger.info(f"{name}: {result}")
+    return result
+
+async def main():
+    # Serve /api/products from the pre-serialized snapshot and lift the rate limit
+    server.limiter.enabled = False
+    sample = [server.map_product_document({**product, "id": str(i), "created_at": server.datetime.utcnow()})
+              for i, product in enumerate(server.SAMPLE_PRODUCTS)]
+    server.catalog_snapshot.put_view(None, None, sample)
+
+    password_hash = server.pwd_context.hash("benchmark-password")
+    logger.info(f"Login storm: {LOGINS} bcrypt verifications, {PRODUCT_REQUESTS} concurrent /api/products requests")
+
+    baseline = await run_scenario("Inline bcrypt (blocking)", inline_login, password_hash)
+    pooled = await run_scenario(f"Password hashing pool ({server.PASSWORD_HASH_WORKERS} workers)", pooled_login, password_hash)
+
+    logger.info("\n=== LOGIN STORM BENCHMARK SUMMARY ===")
+    logger.info(f"p99 /api/products latency: {baseline['p99_ms']} ms -> {pooled['p99_ms']} ms")
+    logger.info(f"Password hashing pool stats: {server.password_hasher.stats()}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
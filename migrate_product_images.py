@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Move inline base64 product images into the content-addressed image store.
+
+Covers image_url and gallery images of every product, including the rows written by
+update_products_images.py, and renders the thumbnail/card/detail variants for products
+already pointing at the store. Safe to re-run: identical images are stored only once.
+
+Usage:
+    python migrate_product_images.py          # migrate
+    python migrate_product_images.py --dry-run
+"""
+
+import asyncio
+import os
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv('backend/.env')
+
+# Reuse the backend's image store so hashes and URLs match what the API writes
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+from server import db, client, is_inline_image, prepare_product_image, invalidate_cache_pattern, PUBLIC_API_URL  # noqa: E402
+
+async def migrate_product_images(dry_run: bool = False):
+    """Replace inline images with blob store URLs and backfill their variants"""
+    query = {"$or": [
+        {"image_url": {"$regex": "^data:"}},
+        {"images": {"$elemMatch": {"$regex": "^data:"}}},
+        {"image_url": {"$regex": "/api/images/"}, "image_variants": {"$in": [None, {}]}}
+    ]}
+    products = await db.products.find(query, {"id": 1, "name": 1, "image_url": 1, "images": 1}).to_list(None)
+    print(f"Found {len(products)} products with inline images or missing variants")
+    
+    migrated = 0
+    saved_bytes = 0
+    for product in products:
+        try:
+            image_url = product.get("image_url") or ""
+            images = product.get("images") or []
+            inline_size = sum(len(value) for value in [image_url, *images] if is_inline_image(value))
+            
+            if dry_run:
+                print(f"Would migrate {product['name']} ({inline_size} inline chars)")
+                continue
+            
+            image_url, image_variants = await prepare_product_image(image_url)
+            gallery = [await prepare_product_image(image) for image in images]
+            update = {
+                "image_url": image_url,
+                "image_variants": image_variants,
+                "images": [url for url, _ in gallery],
+                "images_variants": [variants for _, variants in gallery]
+            }
+            await db.products.update_one({"id": product["id"]}, {"$set": update})
+            
+            migrated += 1
+            saved_bytes += inline_size
+            print(f"✅ Migrated {product['name']} -> {update['image_url']}")
+        except Exception as e:
+            print(f"❌ Failed to migrate {product.get('name')}: {e}")
+    
+    if migrated:
+        # Running workers drop their cached catalog (broadcast when REDIS_URL is set)
+        await invalidate_cache_pattern("products_")
+        await invalidate_cache_pattern("product_")
+    
+    print(f"\n🎉 Migrated {migrated} products, removed {saved_bytes / 1024 / 1024:.2f} MB of inline image data")
+
+async def main():
+    """Main function"""
+    # There is no request to take the base URL from, and the frontend needs absolute image URLs
+    if not PUBLIC_API_URL:
+        print("❌ Set PUBLIC_API_URL (e.g. https://your-backend.onrender.com) before migrating images")
+        client.close()
+        return
+    await migrate_product_images(dry_run="--dry-run" in sys.argv)
+    
+    # Close the connection
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
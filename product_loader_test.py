@@ -0,0 +1,143 @@
+import asyncio
+import copy
+import os
+import sys
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Import the backend in-process; the database is replaced by an in-memory fake below
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+# Test results
+test_results = {}
+
+def log_test_result(test_name, success, message=""):
+    """Log test result and store in results dictionary"""
+    status = "PASSED" if success else "FAILED"
+    logger.info(f"{test_name}: {status} {message}")
+    test_results[test_name] = {"success": success, "message": message}
+    return success
+
+def matches(doc, query):
+    for key, value in query.items():
+        if isinstance(value, dict) and "$in" in value:
+            if doc.get(key) not in value["$in"]:
+                return False
+        elif doc.get(key) != value:
+            return False
+    return True
+
+class CountingCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        self.docs = sorted(self.docs, key=lambda d: d.get(key), reverse=direction == -1)
+        return self
+
+    async def to_list(self, length):
+        return copy.deepcopy(self.docs if length is None else self.docs[:length])
+
+class CountingCollection:
+    """In-memory collection counting every round trip to the database"""
+
+    def __init__(self, docs=None):
+        self.docs = docs or []
+        self.queries = 0
+
+    def find(self, query=None, *args, **kwargs):
+        self.queries += 1
+        return CountingCursor([d for d in self.docs if matches(d, query or {})])
+
+    async def find_one(self, query, *args, **kwargs):
+        self.queries += 1
+        for doc in self.docs:
+            if matches(doc, query):
+                return copy.deepcopy(doc)
+        return None
+
+class FakeDatabase:
+    def __init__(self, **collections):
+        self.collections = collections
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self.collections.setdefault(name, CountingCollection())
+
+def sample_products(count):
+    return [{"id": f"p{i}", "name": f"Mystery Box {i}", "category": "geek", "price": 10.0 + i,
+             "subscription_prices": {}, "image_url": ""} for i in range(count)]
+
+def sample_order(order_id, product_ids, user_id="u1"):
+    return {"id": order_id, "user_id": user_id, "created_at": server.datetime.utcnow(),
+            "items": [{"product_id": pid, "quantity": 1, "subscription_type": None} for pid in product_ids]}
+
+async def test_user_orders_single_query():
+    """/auth/orders resolves every product of every order with one query"""
+    products = CountingCollection(sample_products(6))
+    orders = [sample_order(f"o{i}", [f"p{i % 6}", f"p{(i + 1) % 6}", f"p{(i + 2) % 6}"]) for i in range(10)]
+    server.db = FakeDatabase(products=products, orders=CountingCollection(orders))
+
+    user = server.User(id="u1", email="cliente@example.com", name="Cliente")
+    result = await server.get_user_orders(current_user=user, product_loader=server.ProductLoader())
+
+    items = sum(len(order["items"]) for order in result)
+    success = products.queries == 1 and len(result) == 10 and items == 30
+    return log_test_result("User orders product lookups", success, f"{products.queries} product queries for {items} items")
+
+async def test_order_details_single_query():
+    """Admin order details resolves its items with one query"""
+    products = CountingCollection(sample_products(5))
+    order = sample_order("o1", ["p0", "p1", "p2", "p3", "missing"])
+    server.db = FakeDatabase(products=products, orders=CountingCollection([order]), users=CountingCollection())
+
+    admin = server.User(email="admin@example.com", name="Admin", is_admin=True)
+    result = await server.get_order_details("o1", admin_user=admin, product_loader=server.ProductLoader())
+
+    success = products.queries == 1 and len(result["detailed_items"]) == 4
+    return log_test_result("Order details product lookups", success, f"{products.queries} product queries, {len(result['detailed_items'])} items")
+
+async def test_loader_memoization():
+    """Ids already resolved in the request (found or not) are not queried again"""
+    products = CountingCollection(sample_products(3))
+    loader = server.ProductLoader(products)
+
+    first = await loader.load_many(["p0", "p1", "p1", "missing"])
+    again = await loader.load_many(["p1", "p0", "missing"])
+    single = await loader.load("p0")
+    await loader.load("p2")
+
+    success = products.queries == 2 and set(first) == {"p0", "p1"} and set(again) == {"p0", "p1"} and single["id"] == "p0"
+    return log_test_result("Product loader memoization", success, f"{products.queries} queries")
+
+def run_product_loader_tests():
+    """Run product loader N+1 regression tests"""
+    logger.info("Starting product loader tests")
+    original_db = server.db
+
+    async def run_all():
+        await test_user_orders_single_query()
+        await test_order_details_single_query()
+        await test_loader_memoization()
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        server.db = original_db
+
+    # Print summary
+    logger.info("\n=== PRODUCT LOADER TEST SUMMARY ===")
+    for test_name, result in test_results.items():
+        status = "✅ PASSED" if result["success"] else "❌ FAILED"
+        logger.info(f"{status}: {test_name}")
+
+    return test_results
+
+if __name__ == "__main__":
+    run_product_loader_tests()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Stripe checkout benchmark - checkout session throughput against fake_stripe_server.py.
+
+Creates checkout sessions concurrently, once calling the stripe SDK inline in the async
+handler (the old behaviour) and once through the backend's StripeGateway, and reports
+throughput plus how long the event loop was stalled. A last run injects 503s from the
+fake server to exercise retries with idempotency keys.
+
+Usage:
+    python stripe_checkout_benchmark.py [sessions] [latency_ms]
+"""
+
+import asyncio
+import os
+import sys
+import time
+import logging
+
+from fake_stripe_server import start_fake_stripe
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SESSIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+LATENCY_MS = float(sys.argv[2]) if len(sys.argv) > 2 else 150
+
+# Point the backend at the fake server before importing it
+fake_server, fake_state, fake_base_url = start_fake_stripe(latency_ms=LATENCY_MS)
+os.environ["STRIPE_API_BASE"] = fake_base_url
+os.environ["STRIPE_SECRET_KEY"] = "sk_test_fake"
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+def checkout_request(i):
+    return server.CheckoutSessionRequest(
+        amount=29.99,
+        currency="eur",
+        success_url="http://localhost:3000/success?session_id={CHECKOUT_SESSION_ID}",
+        cancel_url="http://localhost:3000/cart",
+        metadata={"order_id": f"bench-{i}"}
+    )
+
+async def inline_checkout(i):
+    """Old behaviour: synchronous SDK call inside the coroutine"""
+    request = checkout_request(i)
+    return server.stripe.checkout.Session.create(
+        payment_method_types=["card"],
+        line_items=[{"price_data": {"currency": "eur", "product_data": {"name": "Mystery Box Order"},
+                                    "unit_amount": int(request.amount * 100)}, "quantity": 1}],
+        mode="payment",
+        success_url=request.success_url,
+        cancel_url=request.cancel_url,
+        metadata=request.metadata
+    )
+
+async def gateway_checkout(i):
+    """New behaviour: StripeGateway thread pool with retries"""
+    return await server.stripe_checkout.create_checkout_session(checkout_request(i), idempotency_key=f"bench_{i}_{time.time()}")
+
+async def run_scenario(name, checkout_func):
+    stalls = []
+    done = asyncio.Event()
+
+    async def heartbeat():
+        # Measures how late a 10 ms timer fires - the event loop stall other requests would see
+        while not done.is_set():
+            expected = time.perf_counter() + 0.01
+            await asyncio.sleep(0.01)
+            stalls.append(max(0.0, (time.perf_counter() - expected) * 1000))
+
+    monitor = asyncio.create_task(heartbeat())
+    start = time.perf_counter()
+    results = await asyncio.gather(*(checkout_func(i) for i in range(SESSIONS)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    done.set()
+    await monitor
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    result = {
+        "sessions_per_s": round((SESSIONS - len(errors)) / elapsed, 1),
+        "elapsed_s": round(elapsed, 2),
+        "errors": len(errors),
+        "max_loop_stall_ms": round(max(stalls) if stalls else elapsed * 1000, 1)
+    }
+    logger.info(f"{name}: {result}")
+    return result
+
+async def main():
+    logger.info(f"Stripe checkout benchmark: {SESSIONS} sessions, fake Stripe latency {LATENCY_MS} ms at {fake_base_url}")
+
+    baseline = await run_scenario("Inline stripe SDK (blocking)", inline_checkout)
+    pooled = await run_scenario(f"StripeGateway ({server.STRIPE_WORKERS} workers)", gateway_checkout)
+
+    # Transient failures: every 503 is retried with the same idempotency key
+    fake_state.fail_rate = 0.2
+    server.stripe_gateway.backoff_seconds = 0.05
+    flaky = await run_scenario("StripeGateway with 20% injected 503s", gateway_checkout)
+    fake_state.fail_rate = 0.0
+
+    logger.info("\n=== STRIPE CHECKOUT BENCHMARK SUMMARY ===")
+    logger.info(f"Throughput: {baseline['sessions_per_s']} -> {pooled['sessions_per_s']} sessions/s")
+    logger.info(f"Max event loop stall: {baseline['max_loop_stall_ms']} ms -> {pooled['max_loop_stall_ms']} ms")
+    logger.info(f"Injected failures: {fake_state.failures}, errors surfaced with retries: {flaky['errors']}")
+    logger.info(f"Gateway stats: {server.stripe_gateway.stats()}")
+    fake_server.shutdown()
+
+if __name__ == "__main__":
+    asyncio.run(main())
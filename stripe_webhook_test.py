@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Stripe webhook test - signed events are the source of truth for payments.
+
+Posts Stripe-signed events to the backend's webhook endpoint in-process and checks that
+unsigned, tampered and stale events are rejected, that a paid checkout event delivered many
+times at once confirms the order exactly once (one daily revenue update, one cleared cart, one
+queued confirmation email), that a confirmation failing after the order is marked paid still
+clears the cart and queues the email when the event is retried, that the checkout status
+endpoint then answers from the local transaction without calling Stripe, and that an expired
+checkout gives its coupon use back.
+
+Needs a MongoDB reachable at TEST_MONGO_URL (a throwaway database is used and dropped).
+
+Usage:
+    python stripe_webhook_test.py [deliveries]
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import uuid
+import logging
+from datetime import datetime, timedelta
+
+import httpx
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+WEBHOOK_SECRET = "whsec_test_secret"
+os.environ["STRIPE_WEBHOOK_SECRET"] = WEBHOOK_SECRET
+os.environ["EMAIL_PROVIDER"] = "fake"
+os.environ["MONGO_URL"] = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+DELIVERIES = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+TEST_DB_NAME = "mystery_box_stripe_webhook_test"
+
+# Test results
+test_results = {}
+
+def log_test_result(test_name, success, message=""):
+    """Log test result and store in results dictionary"""
+    status = "PASSED" if success else "FAILED"
+    logger.info(f"{test_name}: {status} {message}")
+    test_results[test_name] = {"success": success, "message": message}
+    return success
+
+def sign(payload, secret=WEBHOOK_SECRET, timestamp=None):
+    """Stripe-Signature header for a payload, as Stripe computes it"""
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+def checkout_event(event_type, session_id, order_id, payment_status="paid"):
+    return json.dumps({
+        "id": f"evt_{uuid.uuid4().hex}",
+        "type": event_type,
+        "created": int(time.time()),
+        "livemode": False,
+        "data": {"object": {"id": session_id, "object": "checkout.session", "payment_status": payment_status,
+                            "metadata": {"order_id": order_id}}}
+    })
+
+async def post_event(http, payload, signature):
+    return await http.post("/api/payments/webhook", content=payload,
+                           headers={"Content-Type": "application/json", "Stripe-Signature": signature})
+
+async def create_order(coupon_code=None):
+    """A pending order with its payment transaction and a non-empty cart, as create_checkout leaves them"""
+    user = server.User(email=f"{uuid.uuid4().hex[:8]}@example.com", name="Cliente")
+    await server.db.users.insert_one(user.dict())
+    session_id = f"cs_test_{uuid.uuid4().hex}"
+    cart_id = f"cart-{uuid.uuid4()}"
+    order = server.Order(user_id=user.id, session_id=cart_id, items=[server.CartItem(product_id="p1", quantity=2)],
+                         subtotal=59.98, vat_amount=13.8, shipping_cost=3.99, total_amount=77.77, coupon_code=coupon_code,
+                         shipping_address="Rua das Flores 10, Lisboa", phone="912345678", payment_method="stripe",
+                         shipping_method="standard", stripe_session_id=session_id)
+    await server.db.orders.insert_one(order.dict())
+    await server.db.payment_transactions.insert_one(server.PaymentTransaction(
+        session_id=session_id, payment_id=order.id, amount=order.total_amount, order_id=order.id,
+        metadata={"order_id": order.id, "user_id": user.id}).dict())
+    await server.db.carts.insert_one(server.Cart(session_id=cart_id, items=order.items).dict())
+    return order, session_id
+
+async def test_rejects_bad_signatures(http):
+    """Unsigned, tampered, wrongly signed and stale events are refused and not stored"""
+    payload = checkout_event("checkout.session.completed", "cs_test_x", "o1")
+    responses = [
+        await http.post("/api/payments/webhook", content=payload, headers={"Content-Type": "application/json"}),
+        await post_event(http, payload.replace("paid", "PAID"), sign(payload)),
+        await post_event(http, payload, sign(payload, secret="whsec_other")),
+        await post_event(http, payload, sign(payload, timestamp=time.time() - 3600)),
+    ]
+    stored = await server.db.stripe_events.count_documents({})
+    codes = [response.status_code for response in responses]
+    success = codes == [400, 400, 400, 400] and stored == 0
+    return log_test_result("Bad signatures rejected", success, f"status codes {codes}, {stored} stored")
+
+async def test_duplicate_deliveries(http):
+    """The same paid event delivered concurrently confirms the order once"""
+    order, session_id = await create_order()
+    day = server.revenue_periods(datetime.utcnow())[0]
+    revenue_before = await server.db.revenue_daily.find_one({"_id": day}) or {}
+    payload = checkout_event("checkout.session.completed", session_id, order.id)
+    responses = await asyncio.gather(*(post_event(http, payload, sign(payload)) for _ in range(DELIVERIES)))
+    await server.stripe_event_processor.drain()
+
+    stored = await server.db.stripe_events.find({"id": json.loads(payload)["id"]}).to_list(None)
+    saved_order = await server.db.orders.find_one({"id": order.id})
+    cart = await server.db.carts.find_one({"session_id": order.session_id})
+    emails = await server.db.email_outbox.count_documents({"idempotency_key": f"order_confirmation_{order.id}"})
+    revenue_after = await server.db.revenue_daily.find_one({"_id": day}) or {}
+    revenue = round(revenue_after.get("revenue", 0) - revenue_before.get("revenue", 0), 2)
+    duplicates = sum(response.json()["duplicate"] for response in responses)
+
+    success = (all(response.status_code == 200 for response in responses) and duplicates == DELIVERIES - 1
+               and len(stored) == 1 and stored[0]["status"] == "processed"
+               and saved_order["payment_status"] == "paid" and saved_order["order_status"] == "confirmed"
+               and cart["items"] == [] and emails == 1 and revenue == order.total_amount)
+    return log_test_result("Duplicate deliveries applied once", success,
+                           f"{DELIVERIES} deliveries, {duplicates} duplicates, order {saved_order['payment_status']}, "
+                           f"{emails} email(s), revenue +{revenue}")
+
+async def test_failed_followup_retried(http):
+    """A paid event whose email step fails is retried until the cart is cleared and the email queued"""
+    order, session_id = await create_order()
+    day = server.revenue_periods(datetime.utcnow())[0]
+    revenue_before = await server.db.revenue_daily.find_one({"_id": day}) or {}
+    send_order_confirmation_email = server.send_order_confirmation_email
+    retry_base_seconds = server.stripe_event_processor.retry_base_seconds
+
+    async def failing_once(*args, **kwargs):
+        server.send_order_confirmation_email = send_order_confirmation_email
+        raise RuntimeError("email outbox unavailable")
+
+    server.send_order_confirmation_email = failing_once
+    server.stripe_event_processor.retry_base_seconds = 0
+    try:
+        payload = checkout_event("checkout.session.completed", session_id, order.id)
+        await post_event(http, payload, sign(payload))
+        await server.stripe_event_processor.drain()
+    finally:
+        server.send_order_confirmation_email = send_order_confirmation_email
+        server.stripe_event_processor.retry_base_seconds = retry_base_seconds
+
+    stored = await server.db.stripe_events.find_one({"id": json.loads(payload)["id"]})
+    emails = await server.db.email_outbox.count_documents({"idempotency_key": f"order_confirmation_{order.id}"})
+    cart = await server.db.carts.find_one({"session_id": order.session_id})
+
+    # A later confirmation of the same session leaves the cart the customer filled again alone
+    await server.db.carts.update_one({"session_id": order.session_id}, {"$set": {"items": [{"product_id": "p1", "quantity": 1}]}})
+    payload = checkout_event("checkout.session.async_payment_succeeded", session_id, order.id)
+    await post_event(http, payload, sign(payload))
+    await server.stripe_event_processor.drain()
+    refilled = await server.db.carts.find_one({"session_id": order.session_id})
+    revenue_after = await server.db.revenue_daily.find_one({"_id": day}) or {}
+    revenue = round(revenue_after.get("revenue", 0) - revenue_before.get("revenue", 0), 2)
+
+    success = (stored["status"] == "processed" and stored["attempts"] == 2 and emails == 1 and cart["items"] == []
+               and len(refilled["items"]) == 1 and revenue == order.total_amount)
+    return log_test_result("Failed confirmation follow-up retried", success,
+                           f"event {stored['status']} after {stored['attempts']} attempts, {emails} email(s), "
+                           f"cart {len(cart['items'])} item(s) then {len(refilled['items'])}, revenue +{revenue}")
+
+async def test_local_status(http):
+    """The checkout status endpoint reads the local transaction instead of calling Stripe"""
+    order, session_id = await create_order()
+    pending = (await http.get(f"/api/payments/checkout/status/{session_id}")).json()
+    payload = checkout_event("checkout.session.completed", session_id, order.id)
+    await post_event(http, payload, sign(payload))
+    await server.stripe_event_processor.drain()
+    calls_before = server.stripe_gateway.calls + server.stripe_gateway.failures
+    paid = (await http.get(f"/api/payments/checkout/status/{session_id}")).json()
+    stripe_calls = server.stripe_gateway.calls + server.stripe_gateway.failures - calls_before
+
+    success = pending["payment_status"] == "pending" and paid["payment_status"] == "paid" and paid["amount_total"] == order.total_amount and stripe_calls == 0
+    return log_test_result("Local payment status", success, f"{pending['payment_status']} -> {paid['payment_status']}, {stripe_calls} Stripe calls")
+
+async def test_expired_checkout_releases_coupon(http):
+    """An expired checkout gives its coupon use back; a late expiry never unpays a paid order"""
+    now = datetime.utcnow()
+    await server.db.coupons.insert_one(server.CouponCode(
+        code="WEBHOOK1", description="Teste", discount_type="percentage", discount_value=10, max_uses=1, current_uses=1,
+        valid_from=now - timedelta(days=1), valid_until=now + timedelta(days=1), created_by="test").dict())
+    order, session_id = await create_order(coupon_code="WEBHOOK1")
+    for _ in range(2):  # Stripe may deliver the expiry under two event ids; the coupon is released once
+        payload = checkout_event("checkout.session.expired", session_id, order.id, payment_status="unpaid")
+        await post_event(http, payload, sign(payload))
+    await server.stripe_event_processor.drain()
+    expired = await server.db.orders.find_one({"id": order.id})
+    coupon = await server.db.coupons.find_one({"code": "WEBHOOK1"})
+
+    paid_order, paid_session = await create_order()
+    for event_type in ("checkout.session.completed", "checkout.session.expired"):
+        payload = checkout_event(event_type, paid_session, paid_order.id)
+        await post_event(http, payload, sign(payload))
+    await server.stripe_event_processor.drain()
+    still_paid = await server.db.orders.find_one({"id": paid_order.id})
+
+    success = expired["payment_status"] == "expired" and coupon["current_uses"] == 0 and still_paid["payment_status"] == "paid"
+    return log_test_result("Expired checkout releases coupon", success,
+                           f"order {expired['payment_status']}, coupon uses {coupon['current_uses']}, paid order stays {still_paid['payment_status']}")
+
+def run_stripe_webhook_tests():
+    """Run Stripe webhook tests"""
+    logger.info(f"Starting Stripe webhook tests ({DELIVERIES} duplicate deliveries)")
+    client = server.AsyncIOMotorClient(os.environ["MONGO_URL"])
+    original_db = server.db
+
+    async def run_all():
+        server.db = client[TEST_DB_NAME]
+        await client.drop_database(TEST_DB_NAME)
+        await server.db.stripe_events.create_index([("id", 1)], unique=True)
+        await server.db.email_outbox.create_index([("idempotency_key", 1)], unique=True)
+        await server.db.products.insert_one({"id": "p1", "name": "Mystery Box", "category": "geek", "price": 29.99, "is_active": True})
+        # The app's startup hooks are not run, so the background workers stay off and events are drained explicitly
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            await test_rejects_bad_signatures(http)
+            await test_duplicate_deliveries(http)
+            await test_failed_followup_retried(http)
+            await test_local_status(http)
+            await test_expired_checkout_releases_coupon(http)
+        await client.drop_database(TEST_DB_NAME)
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        server.db = original_db
+
+    # Print summary
+    logger.info("\n=== STRIPE WEBHOOK TEST SUMMARY ===")
+    for test_name, result in test_results.items():
+        status = "✅ PASSED" if result["success"] else "❌ FAILED"
+        logger.info(f"{status}: {test_name}")
+
+    return test_results
+
+if __name__ == "__main__":
+    run_stripe_webhook_tests()
@@ -226,10 +226,10 @@ def test_subscription_webhook():
                 headers={"Content-Type": "application/json"}
             )
         
-        # We expect a 200 response even for mock data since we're not verifying the signature
-        if response.status_code == 200:
+        # The mock event is not signed, so it must be rejected (503 while no webhook secret is configured)
+        if response.status_code in (400, 503):
             return log_test_result("Subscription Webhook", True, 
-                                  "Webhook handler processed the event")
+                                  "Webhook handler rejected the unsigned event")
         else:
             # Unexpected error
             return log_test_result("Subscription Webhook", False, 